@@ -1,4 +1,17 @@
 import abc
+import contextlib
+import datetime
+
+# parts of a chat that can be fetched together with load_chat_snapshot
+SNAPSHOT_PARTS = ("state", "groups")
+
+# log date_time format, sorts the same as the time it represents
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def format_log_time(time) -> str:
+    if isinstance(time, datetime.datetime):
+        return time.strftime(LOG_DATE_FORMAT)
+    return time
 
 class AbstractDatabase(abc.ABC):
     @abc.abstractmethod
@@ -17,6 +30,40 @@ class AbstractDatabase(abc.ABC):
     def save_groups(self, groups, chat_id):
         pass
 
+    # materialized stats, see MaterializedStats
+    def load_stats(self, chat_id) -> dict:
+        '''Stats aggregate saved with save_stats, None if there is none. Backends without a place for it always return None.'''
+        return None
+
+    def save_stats(self, stats, chat_id):
+        pass
+
+    def update_stats(self, chat_id, change):
+        '''
+        Replaces the stats aggregate with change(aggregate) (None if there is none), change returns None to keep it.
+        Backends without transactions should override this with a conditional write, this fallback is read-modify-write.
+        '''
+        with self.atomic():
+            stats = change(self.load_stats(chat_id))
+            if stats is not None:
+                self.save_stats(stats, chat_id)
+
+    def add_stats_counts(self, chat_id, counts: dict):
+        '''
+        Adds counts ({field: {key: count}}, see MaterializedStats.log_counts) to the stats aggregate.
+        Chats without a current aggregate are left as they are. Backends should override this with a write
+        that doesn't read the aggregate.
+        '''
+        # imported here, storage doesn't load the stats modules at cold start
+        import MaterializedStats
+
+        def change(stats):
+            if not MaterializedStats.usable(stats):
+                return None
+            MaterializedStats.add_counts(stats, counts)
+            return stats
+        self.update_stats(chat_id, change)
+
     @abc.abstractmethod
     def load_logs(self, chat_id, reverse_index) -> list:
         pass
@@ -26,21 +73,127 @@ class AbstractDatabase(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def save_log(self, message:str, sender_id, chat_id):
+    def save_log(self, chat_id, sender_id, command: str, transaction=None):
+        '''
+        transaction: structured record of a transaction command (see DebitHandler.record_transaction),
+        returned as log["transaction"] by the load methods
+        '''
         pass
-    
+
     @abc.abstractmethod
     def get_id_by_name(self, chat_name) -> str:
         pass
 
     @abc.abstractmethod
-    def load_log_after_time(self, chat_id, time, reverse_index, ) -> list:
+    def load_log_after_time(self, chat_id, time, end_time=None) -> list:
+        '''
+        Logs with time < date_time < end_time (no upper bound if end_time is None), newest first.
+        time and end_time are datetimes or LOG_DATE_FORMAT strings.
+        Cost should depend on the size of the window, not on the whole history.
+        '''
         pass
 
-    @abc.abstractmethod
     def save_transfer(self, code, chat_id, date_time) -> None:
-        pass
+        raise NotImplementedError("State transfer not supported")
 
-    @abc.abstractmethod
     def load_transfer(self, code) -> dict:
-        pass
\ No newline at end of file
+        raise NotImplementedError("State transfer not supported")
+
+    def atomic(self):
+        '''
+        Context manager grouping all reads and writes of one command into a transaction.
+        Backends without transactions don't need to override this.
+        '''
+        return contextlib.nullcontext()
+
+    def load_chat_snapshot(self, chat_id, parts=SNAPSHOT_PARTS, log_index=0) -> dict:
+        '''
+        Loads several parts of a chat at once.
+        parts can contain "state", "groups", "stats" and "log" (log at log_index, 0 is the newest).
+        Backends that can read everything in one round trip should override this.
+        '''
+        snapshot = dict()
+        if "state" in parts:
+            snapshot["state"] = self.load_state(chat_id)
+        if "groups" in parts:
+            snapshot["groups"] = self.load_groups(chat_id)
+        if "stats" in parts:
+            snapshot["stats"] = self.load_stats(chat_id)
+        if "log" in parts:
+            snapshot["log"] = self.load_log(chat_id, log_index)
+        return snapshot
+
+    def save_chat_snapshot(self, snapshot, chat_id):
+        '''
+        Writes back the parts present in snapshot ("state", "groups" and/or "stats").
+        Backends that can write everything in one round trip should override this.
+        '''
+        if "state" in snapshot:
+            self.save_state(snapshot["state"], chat_id)
+        if "groups" in snapshot:
+            self.save_groups(snapshot["groups"], chat_id)
+        if "stats" in snapshot:
+            self.save_stats(snapshot["stats"], chat_id)
+
+    def apply_balance_deltas(self, chat_id, deltas) -> dict:
+        '''
+        Adds deltas ({name: amount}) to the balances of the touched members.
+        Returns the new balances of those members.
+        Backends should override this with a single atomic write, this fallback is read-modify-write.
+        '''
+        state = self.load_state(chat_id)
+        for name, delta in deltas.items():
+            state[name] += delta
+        self.save_state(state, chat_id)
+        return {name: state[name] for name in deltas}
+
+    def apply_state_transfer(self, code, chat_id, deltas, source_chat_id, source_deltas) -> bool:
+        '''
+        In one atomic write: marks transfer code as used, adds deltas to chat_id and source_deltas to source_chat_id.
+        Returns False (and changes nothing) if the code was already used.
+        '''
+        raise NotImplementedError("State transfer not supported")
+
+    def load_log_by_seq(self, chat_id, seq) -> dict:
+        '''Log number seq of the chat, empty dict if there is none. Backends with a key on seq should override this.'''
+        for log in self.load_logs(chat_id, False):
+            if log.get("seq") == seq:
+                return log
+        return dict()
+
+    def apply_undo(self, chat_id, seqs: list, deltas) -> bool:
+        '''
+        In one atomic write: marks logs seqs as undone (log["undone"] is True afterwards) and adds deltas to the balances.
+        Returns False (and changes nothing) if one of the logs was already undone.
+        '''
+        raise NotImplementedError("Undo not supported")
+
+    # archive segments, see LogCompactor
+    def load_log_segments(self, chat_id) -> list:
+        '''Returns summaries of archived log segments, backends without an archive have none'''
+        return list()
+
+    def load_log_segment_data(self, chat_id, first_seq) -> bytes:
+        raise NotImplementedError("Log archive not supported")
+
+    def save_log_segment(self, chat_id, summary, data: bytes):
+        raise NotImplementedError("Log archive not supported")
+
+    def remove_logs(self, chat_id, seqs: list):
+        raise NotImplementedError("Log archive not supported")
+
+    # shared rate limit counters, see RateLimiter
+    def increment_rate_counter(self, key: str, limit: int, expires_at: int) -> bool:
+        '''
+        Increments counter key if it is below limit, in one conditional write.
+        Returns False when the counter already reached limit. Counters can be deleted after expires_at (unix time).
+        '''
+        raise NotImplementedError("Shared rate limit not supported")
+
+    # processed update markers, see UpdateDeduplicator
+    def mark_update(self, key: str, expires_at: int) -> bool:
+        '''
+        Stores marker key unless it exists, in one conditional write.
+        Returns False if the key was already marked. Markers can be deleted after expires_at (unix time).
+        '''
+        raise NotImplementedError("Update markers not supported")
@@ -0,0 +1,81 @@
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from TelegramClient import TelegramClient
+
+MAX_IN_FLIGHT = 8 # commands processed at the same time, across all chats
+
+class AsyncTelegramClient:
+    '''
+    Awaitable wrapper of TelegramClient, calls run in worker threads
+    so a slow request doesn't stop the event loop.
+    '''
+    def __init__(self, client: TelegramClient):
+        self.client = client
+
+    async def get_updates(self, offset=0, timeout=30) -> list:
+        return await asyncio.to_thread(self.client.get_updates, offset, timeout)
+
+    async def send_message(self, chat_id, text):
+        return await asyncio.to_thread(self.client.send_message, chat_id, text)
+
+class AsyncBotApi:
+    '''
+    Long polling runtime that processes a getUpdates batch concurrently across chats.
+
+    Updates of one chat run one after another in the order Telegram sent them, different chats run
+    in parallel with at most max_in_flight commands at once. process_event (command, storage and reply)
+    runs in a worker thread, so every chat gets its own storage calls without blocking the others.
+    The offset moves past a batch only after every update in it is finished.
+    '''
+    def __init__(self, process_event, client: TelegramClient, show=None, max_in_flight=MAX_IN_FLIGHT):
+        self.process_event = process_event
+        self.client = AsyncTelegramClient(client)
+        self.show = show
+        self.max_in_flight = max_in_flight
+        self.semaphore = None # created inside the running loop
+        self.new_offset = 0
+
+    @staticmethod
+    def chat_key(update):
+        if "message" in update and "chat" in update["message"]:
+            return update["message"]["chat"]["id"]
+        # not a chat message, nothing to keep in order with
+        return ("update", update["update_id"])
+
+    async def process_chat(self, updates: list, testMode=False):
+        for update in updates:
+            async with self.semaphore:
+                try:
+                    if self.show is not None:
+                        await asyncio.to_thread(self.show, update)
+                    await asyncio.to_thread(self.process_event, update, testMode=testMode)
+                except Exception:
+                    # a broken update doesn't hold back the rest of the chat
+                    print("ERROR:", traceback.format_exc())
+
+    async def process_updates(self, timeout=30, testMode=False):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        all_updates = await self.client.get_updates(self.new_offset, timeout=timeout)
+
+        if len(all_updates) == 0:
+            return False
+
+        chats = dict() # chat -> its updates, in arrival order
+        for update in all_updates:
+            chats.setdefault(self.chat_key(update), []).append(update)
+
+        await asyncio.gather(*(self.process_chat(updates, testMode=testMode) for updates in chats.values()))
+
+        # whole batch is done, Telegram can drop it
+        self.new_offset = all_updates[-1]["update_id"] + 1
+        return True
+
+    async def run(self, timeout=30, testMode=False):
+        # one worker thread per command in flight, plus one for the long poll
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(self.max_in_flight + 1))
+        while True:
+            await self.process_updates(timeout=timeout, testMode=testMode)
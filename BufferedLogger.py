@@ -0,0 +1,113 @@
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+MAX_BYTES = 10 * 1024 * 1024 # rotate when the file grows over this
+BACKUPS = 5 # rotated files kept as path.1 ... path.BACKUPS
+QUEUE_SIZE = 10000 # records waiting for the writer, newer ones are dropped when it is full
+FLUSH_SECONDS = 1.0 # longest time a record waits in the buffer
+BATCH_SIZE = 500 # records written with one write call
+FLUSH = object() # queued by flush(), the writer writes its batch without waiting for more records
+
+class BufferedLogger:
+    '''
+    Writes JSON lines from a background thread.
+
+    log() only puts the record on a bounded queue and never blocks, so logging doesn't slow down commands.
+    The writer keeps the file open, writes records in batches and rotates the file by size
+    (max_bytes) and optionally by age (rotate_seconds). When the queue is full records are dropped and counted.
+    '''
+    def __init__(self, path, max_bytes=MAX_BYTES, rotate_seconds=None, backups=BACKUPS,
+                 queue_size=QUEUE_SIZE, flush_seconds=FLUSH_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.file = None
+        self.opened_at = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def log(self, record: dict):
+        if self.thread is None:
+            self.start()
+        record = {"time": datetime.datetime.now().isoformat(timespec="milliseconds"), **record}
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="buffered-logger", daemon=True)
+                self.thread.start()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def should_rotate(self) -> bool:
+        if self.file.tell() >= self.max_bytes:
+            return True
+        return self.rotate_seconds is not None and time.time() - self.opened_at >= self.rotate_seconds
+
+    def rotate(self):
+        self.file.close()
+        # path.4 -> path.5, ..., path -> path.1
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, records: list):
+        if self.dropped:
+            records.append({"time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+                            "dropped": self.dropped})
+            self.dropped = 0
+
+        try:
+            if self.file is None:
+                self.open()
+            self.file.write("".join(json.dumps(i, ensure_ascii=False, default=str) + "\n" for i in records))
+            self.file.flush()
+            if self.should_rotate():
+                self.rotate()
+        except OSError as e:
+            # e.g. read-only file system, the records are lost but commands keep working
+            print("Failed to log message:", e)
+            self.file = None
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            # collect whatever arrives within flush_seconds, up to a batch
+            deadline = time.monotonic() + self.flush_seconds
+            while len(records) < BATCH_SIZE and records[-1] is not FLUSH:
+                try:
+                    records.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            count = len(records)
+            records = [i for i in records if i is not FLUSH]
+            if records:
+                self.write(records)
+            for _ in range(count):
+                self.queue.task_done()
+
+    def flush(self):
+        '''Blocks until every queued record is written'''
+        if self.thread is not None:
+            self.queue.put(FLUSH)
+            self.queue.join()
@@ -8,6 +8,8 @@ add new statistic types without modifying the core DebitHandler code.
 from StatsCalculator import StatCalculator
 from typing import Dict, List, Any
 from collections import defaultdict
+from DebitHandler import transaction_record
+from Util.money import from_cents
 
 class MostGenerousCalculator(StatCalculator):
     """Finds who gives money to others most frequently"""
@@ -17,19 +19,15 @@ class MostGenerousCalculator(StatCalculator):
         generosity_amount = defaultdict(float)
         
         for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] == "t":  # Only regular transactions
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                don = command[1].capitalize()
-                amounts = command[3::2]
+            record = transaction_record(log)
+            if record is not None and record["type"] == "t":  # Only regular transactions
+                don = record["donor"]
                 
                 # Count how many people they gave money to
-                generosity_count[don] += len(amounts)
+                generosity_count[don] += len(record["recipients"])
                 
                 # Total amount given
-                total_given = sum(float(amount) for amount in amounts)
-                generosity_amount[don] += total_given
+                generosity_amount[don] += from_cents(record["total"])
         
         # Combine count and amount for a generosity score
         generosity_score = {}
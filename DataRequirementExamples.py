@@ -5,6 +5,7 @@ Examples of statistics that require different combinations of data
 from StatsCalculator import StatCalculator
 from typing import Dict, List, Any, Optional
 from collections import defaultdict
+from DebitHandler import transaction_record
 
 class StateOnlyCalculator(StatCalculator):
     """Example of a statistic that only needs current state (no logs)"""
@@ -112,12 +113,9 @@ class BothNeededCalculator(StatCalculator):
         # Calculate "accuracy" - users who made transactions vs users with non-zero balance
         users_with_transactions = set()
         for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] in ["t", "td", "tg", "tdex", "tgex"]:
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                if len(command) > 1:
-                    users_with_transactions.add(command[1].capitalize())
+            record = transaction_record(log)
+            if record is not None:
+                users_with_transactions.add(record["donor"])
         
         users_with_balance = {user for user, balance in state.items() if balance != 0}
         
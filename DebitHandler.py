@@ -1,32 +1,88 @@
 import os
 import random
 import string
+import threading
 import time
 import datetime
+from functools import cached_property, lru_cache
 
-from AbstractDatabase import AbstractDatabase
+from AbstractDatabase import AbstractDatabase, SNAPSHOT_PARTS
 import Util.elo_util as elo_util
-from StatsCalculator import StatsCalculatorManager
-from ExtendedStatsCalculators import add_extended_calculators
+from Util.money import to_cents, from_cents, format_cents, split_cents, scale_cents
 
 MAX_NUM_NAMES = 40
 MAX_NUM_GROUPS = 15
 TRANS_CODE_TIMEOUT_SECONDS = 60 * 5 # 5 minutes
+STATE_SEPARATOR = "\n---------------------\n" # between success message and state in type 1 responses
+TRANSACTION_COMMANDS = ("t", "td", "tdex", "tg", "tgex") # commands that move money between members
+RECORDED_COMMANDS = TRANSACTION_COMMANDS + ("u",) # commands whose record is saved with their log
+MAX_UNDO = 20 # transactions undone by one /u N
+UNDO_SEARCH_LOGS = 100 # newest logs searched for transactions to undo
+STATS_READ_COMMANDS = ("stat", "statsall", "statslist") # logged, but don't change any stat worth recomputing
+STATS_VERSION_LOGS = 20 # newest logs searched for the stats version
+OPTIONAL_ARGS_COMMANDS = ("u", "statsall") # called with their (possibly empty) args, see commands_API
+
+class ChatSnapshot:
+    """
+    Per-command view of a chat: read from storage at most once (lazily, on first access)
+    and written back once, with only the parts that were changed.
+    """
+    def __init__(self, data_instance: AbstractDatabase, chat_id, data=None):
+        self.data_instance = data_instance
+        self.chat_id = chat_id
+        self.data = dict(data) if data else dict()
+        self.dirty = set()
+        self.deltas = dict() # balance changes not written yet, already applied to data["state"]
+        self.transaction = None # structured record of a transaction command, saved with its log
+        self.undone = list() # transaction records undone by the command, subtracted from the stats aggregate
+
+    def get(self, part):
+        if part not in self.data:
+            # parts given by the caller (possibly changed already) are not loaded again
+            missing = tuple(i for i in SNAPSHOT_PARTS if i not in self.data)
+            self.data.update(self.data_instance.load_chat_snapshot(self.chat_id, missing))
+        return self.data[part]
+
+    def set(self, part, value):
+        self.data[part] = value
+        self.dirty.add(part)
+
+    def add_deltas(self, deltas):
+        state = self.get("state")
+        for name, delta in deltas.items():
+            state[name] += delta
+            self.deltas[name] = self.deltas.get(name, 0) + delta
+
+    def commit(self):
+        if self.dirty:
+            # a full state write already contains the deltas
+            if "state" in self.dirty:
+                self.deltas = dict()
+            self.data_instance.save_chat_snapshot({i: self.data[i] for i in self.dirty}, self.chat_id)
+            self.dirty = set()
+
+        if self.deltas:
+            new_balances = self.data_instance.apply_balance_deltas(self.chat_id, self.deltas)
+            self.data["state"].update(new_balances)
+            self.deltas = dict()
 
 class DebitHandler:
     def __init__(self, data_instance: AbstractDatabase):
-        self.help_path = os.path.join(os.getcwd(), "help.txt")
-        self.disc_path = os.path.join(os.getcwd(), "BotDescription.txt")
+        # next to this file, so the handler can be created from any working directory
+        self.help_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "help.txt")
+        self.disc_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BotDescription.txt")
+        # static texts are read once, not on every /h
+        with open(self.help_path, "r", encoding="utf-8") as f:
+            self.help_str = f.read()
+        with open(self.disc_path, "r", encoding="utf-8") as f:
+            self.disc_str = f.read()
+
         self.data_instance = data_instance
-        self.stats_manager = StatsCalculatorManager()
-        
-        # Add extended calculators
-        try:
-            add_extended_calculators(self.stats_manager)
-        except ImportError:
-            # Extended calculators not available, continue with basic ones
-            pass
-            
+        self.snapshots = dict() # chat_id -> ChatSnapshot of the command being processed
+        self.transactions = dict() # chat_id -> transaction record of the last command, see pop_transaction
+        self.stats_updates = dict() # chat_id -> stats change of the last command, see update_stats_aggregate
+        self.lazy_lock = threading.RLock() # see build_once
+
         self.commands = {
             "t": self.transaction,
             "td": self.transaction_division,
@@ -55,6 +111,7 @@ class DebitHandler:
             "stat": self.get_specific_stat,
             "statsall": self.get_all_stats,
             "statslist": self.get_available_stats,
+            "statsrebuild": self.rebuild_stats,
         }
         # 0 - return succ message,         
         # 1 - return succ message and state 
@@ -65,7 +122,7 @@ class DebitHandler:
             "tg": ("Transaction successful",1),
             "tdex": ("Transaction successful",1),
             "tgex": ("Transaction successful",1),
-            "u" : ("Undo successful",1),
+            "u" : ("", 2),
             "na": ("Name added successfully",1),
             "nr": ("Name removed successfully",1),
             "nc": ("Name changed successfully",1),
@@ -88,6 +145,7 @@ class DebitHandler:
             "stat": ("", 2),
             "statsall": ("", 2),
             "statslist": ("", 2),
+            "statsrebuild": ("", 2),
         }
         self.exceptions_list = [
             self.unknown_username_exception,
@@ -99,6 +157,50 @@ class DebitHandler:
             self.forbidden_action_exception,
         ]
 
+    def build_once(self, name, build):
+        '''
+        Value of a lazily created member, built by only one thread:
+        AsyncBotApi runs commands of different chats in worker threads that can ask for it at the same time.
+        '''
+        with self.lazy_lock:
+            # stored before the lock is released, a waiting thread finds it instead of building another one
+            if name not in self.__dict__:
+                self.__dict__[name] = build()
+            return self.__dict__[name]
+
+    # stats modules are imported on the first /stat* command (or compaction), not at cold start
+    @cached_property
+    def stats_manager(self):
+        return self.build_once("stats_manager", self.build_stats_manager)
+
+    def build_stats_manager(self):
+        from StatsCalculator import StatsCalculatorManager
+        stats_manager = StatsCalculatorManager()
+
+        # Add extended calculators
+        try:
+            from ExtendedStatsCalculators import add_extended_calculators
+            add_extended_calculators(stats_manager)
+        except ImportError:
+            # Extended calculators not available, continue with basic ones
+            pass
+        return stats_manager
+
+    @cached_property
+    def log_compactor(self):
+        def build():
+            from LogCompactor import LogCompactor
+            return LogCompactor(self.data_instance, self.stats_manager)
+        return self.build_once("log_compactor", build)
+
+    # formatted results of /stat and /statsall, see stats_version
+    @cached_property
+    def stats_cache(self):
+        def build():
+            from StatsCache import StatsCache
+            return StatsCache()
+        return self.build_once("stats_cache", build)
+
     class unknown_username_exception(Exception):
         def __init__(self, name):
             self.message = "Unknown name"
@@ -191,6 +293,132 @@ class DebitHandler:
             return False
         return string[-1].isdigit()
     
+    # state and groups go through the snapshot of the running command, if there is one
+    def load_state(self, chat_id) -> dict:
+        if chat_id in self.snapshots:
+            return self.snapshots[chat_id].get("state")
+        return self.data_instance.load_state(chat_id)
+
+    def save_state(self, state, chat_id):
+        if chat_id in self.snapshots:
+            self.snapshots[chat_id].set("state", state)
+        else:
+            self.data_instance.save_state(state, chat_id)
+
+    def load_groups(self, chat_id) -> dict:
+        if chat_id in self.snapshots:
+            return self.snapshots[chat_id].get("groups")
+        return self.data_instance.load_groups(chat_id)
+
+    def save_groups(self, groups, chat_id):
+        if chat_id in self.snapshots:
+            self.snapshots[chat_id].set("groups", groups)
+        else:
+            self.data_instance.save_groups(groups, chat_id)
+
+    # balance changes (in cents) are written as deltas so concurrent commands don't overwrite each other
+    def apply_deltas(self, deltas, chat_id):
+        if chat_id in self.snapshots:
+            self.snapshots[chat_id].add_deltas(deltas)
+        else:
+            self.data_instance.apply_balance_deltas(chat_id, deltas)
+
+    # what a transaction did, in cents: stats and undo read this instead of parsing the command again
+    # amounts: one per recipient for t, the other commands have only the total
+    def record_transaction(self, chat_id, transaction_type, donor, recipients, total, deltas, amounts=None):
+        if chat_id in self.snapshots:
+            self.snapshots[chat_id].transaction = {
+                "type": transaction_type,
+                "donor": donor,
+                "recipients": list(recipients),
+                "total": total,
+                "amounts": list(amounts) if amounts is not None else [total],
+                "deltas": dict(deltas),
+            }
+
+    # materialized stats follow every logged command, written on their own so commands don't read them
+    def update_stats_aggregate(self, chat_id):
+        '''
+        Adds the last command run by commands_API in the chat to the stats aggregate.
+        Called once the command is logged, so the stats never count a command that failed to apply or to log.
+        '''
+        # like the stats modules, imported on first use instead of at cold start
+        import MaterializedStats
+        if chat_id not in self.stats_updates:
+            return
+        command, record, undone_records = self.stats_updates.pop(chat_id)
+        if record is None and not undone_records:
+            # only the command counters change
+            self.data_instance.add_stats_counts(chat_id, MaterializedStats.log_counts(command))
+            return
+
+        def change(aggregate):
+            if not MaterializedStats.usable(aggregate):
+                # backfilled by the first /stat* command
+                return None
+            for undone in undone_records:
+                MaterializedStats.add_transaction(aggregate, undone, -1)
+            MaterializedStats.add_log(aggregate, command, record)
+            return aggregate
+        self.data_instance.update_stats(chat_id, change)
+
+    def load_stats_aggregate(self, chat_id) -> dict:
+        '''Materialized stats of the chat, built from the logs if the chat has none yet'''
+        import MaterializedStats
+        aggregate = self.data_instance.load_stats(chat_id)
+        if not MaterializedStats.usable(aggregate):
+            aggregate, _ = self.build_stats_aggregate(chat_id)
+            # unless another command saved one meanwhile
+            self.data_instance.update_stats(chat_id, lambda stored: None if MaterializedStats.usable(stored) else aggregate)
+        return aggregate
+
+    def build_stats_aggregate(self, chat_id) -> tuple:
+        '''Aggregate of all logs of the chat, archived ones included, returns (aggregate, number of logs)'''
+        import MaterializedStats
+        logs = self.data_instance.load_logs(chat_id, False)
+        summaries = self.data_instance.load_log_segments(chat_id)
+        if summaries:
+            logs = logs + self.log_compactor.load_archived_logs(chat_id, summaries)
+
+        aggregate = MaterializedStats.empty()
+        for log in reversed(logs):
+            MaterializedStats.add_log(aggregate, log["command"], transaction_record(log))
+        return aggregate, len(logs)
+
+    def is_materialized(self, stat_type) -> bool:
+        '''True if stat_type is still the built-in calculator the aggregate stands in for'''
+        import MaterializedStats
+        calculator = self.stats_manager.get_stat_instance(stat_type)
+        return type(calculator).__name__ == MaterializedStats.MATERIALIZED_STATS.get(stat_type)
+
+    def stats_version(self, chat_id):
+        '''
+        seq of the newest log that can change stats, the version cached stats results are keyed by.
+        Stats reads are skipped (they are logged too, the version would change with every /stat),
+        so cached results don't count /stat* commands made since they were calculated.
+        None if the logs have no seq (text files), their stats aren't cached.
+        '''
+        logs = self.data_instance.load_logs(chat_id, STATS_VERSION_LOGS)
+        if logs and "seq" not in logs[0]:
+            return None
+        for log in logs:
+            if log["command"].split(" ", 1)[0] not in STATS_READ_COMMANDS:
+                return log["seq"]
+        # only stats reads in the searched logs, still a version nothing before it can change
+        return logs[-1]["seq"] if logs else 0
+
+    def stats_cache_key(self, chat_id, name, window=None, state=None):
+        '''Key of a cached stats result, None if it can't be cached'''
+        version = self.stats_version(chat_id)
+        if version is None:
+            return None
+        # balances can change without a log in the chat (/std moves them from another chat)
+        return (chat_id, name, version, window and window[:2], state and tuple(sorted(state.items())))
+
+    def pop_transaction(self, chat_id) -> dict:
+        '''Transaction record of the last command run by commands_API in the chat, None if it wasn't a transaction'''
+        return self.transactions.pop(chat_id, None)
+
     @staticmethod
     def resolvingAlgebraFormations(array: list) -> list:
         i = 0
@@ -201,7 +429,7 @@ class DebitHandler:
             if DebitHandler.contains_letters_only(arrayOut[i]) == False and DebitHandler.contains_mixed_letters_and_non_letters(arrayOut[i]) == False:
                 if isLastNum:
                     if arrayOut[i - 1][-1].isdigit() and arrayOut[i][0].isdigit():
-                        arrayOut[i - 1] = eval(arrayOut[i - 1])  
+                        arrayOut[i - 1] = DebitHandler.evaluate_amount(arrayOut[i - 1])
                         i += 1                      
                     else:
                         arrayOut[i - 1] = arrayOut[i - 1] + arrayOut[i]
@@ -211,21 +439,31 @@ class DebitHandler:
                 isLastNum = True
             else:
                 if isLastNum == True:  
-                    arrayOut[i-1] = eval(arrayOut[i-1])
+                    arrayOut[i-1] = DebitHandler.evaluate_amount(arrayOut[i-1])
                 isLastNum = False
                 i += 1
 
         if isLastNum == True:
-            arrayOut[-1] = eval(arrayOut[-1])
+            arrayOut[-1] = DebitHandler.evaluate_amount(arrayOut[-1])
 
         return arrayOut
 
+    @staticmethod
+    def evaluate_amount(expression: str):
+        from Util.arithmetic import evaluate, ExpressionError
+        try:
+            return evaluate(expression)
+        except ExpressionError:
+            raise DebitHandler.invalid_arguments_exception("Invalid expression", expression)
+        except ZeroDivisionError:
+            raise DebitHandler.invalid_arguments_exception("Division by zero", expression)
+
     def group_add(self, args, chat_id):
-        groups = self.data_instance.load_groups(chat_id)
+        groups = self.load_groups(chat_id)
 
         if len(groups) >= MAX_NUM_GROUPS:
             raise DebitHandler.forbidden_action_exception("Too many groups")
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
 
         key_word = args[0].upper()
     
@@ -255,23 +493,23 @@ class DebitHandler:
 
         groups[key_word] = members
 
-        self.data_instance.save_groups(groups, chat_id)
+        self.save_groups(groups, chat_id)
         return True
 
     def group_delete(self, args, chat_id):
         key_word = args[0].upper()
 
-        groups = self.data_instance.load_groups(chat_id)
+        groups = self.load_groups(chat_id)
         if key_word not in groups:
             raise DebitHandler.unknown_username_exception(key_word)
 
         del groups[key_word]
 
-        self.data_instance.save_groups(groups, chat_id)
+        self.save_groups(groups, chat_id)
         return True
 
     def get_groups_string(self, chat_id):
-        groups = self.data_instance.load_groups(chat_id)
+        groups = self.load_groups(chat_id)
 
         end_list = list()
         for i in groups:
@@ -283,14 +521,13 @@ class DebitHandler:
         return "\n".join(end_list)
 
     def name_change_groups_fix(self, old_name, new_name, chat_id):
-        groups = self.data_instance.load_groups(chat_id)
+        groups = self.load_groups(chat_id)
         key_words = groups.keys()
         for i in key_words:
             if old_name in groups[i]:
-                groups[i].remove(old_name)
-                groups[i].add(new_name)
+                groups[i][groups[i].index(old_name)] = new_name
 
-        self.data_instance.save_groups(groups, chat_id)
+        self.save_groups(groups, chat_id)
         return True
 
     def find_dest_chat_id(self, dest_group_name):
@@ -304,16 +541,22 @@ class DebitHandler:
         # create a random transfer code, includes ascii chars and numbers in caps
         code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
         date_time = datetime.datetime.now()
-        self.data_instance.save_transfer(code, chat_id, date_time)
+        try:
+            self.data_instance.save_transfer(code, chat_id, date_time)
+        except NotImplementedError:
+            raise DebitHandler.forbidden_action_exception("State transfer is not supported on this storage")
 
         msg = f"Paste this to destination chat:\n<code>/std {code}</code>"
         return msg
 
     def state_transfer_destination(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
 
         code = args[0]
-        transfer = self.data_instance.load_transfer(code)
+        try:
+            transfer = self.data_instance.load_transfer(code)
+        except NotImplementedError:
+            raise DebitHandler.forbidden_action_exception("State transfer is not supported on this storage")
 
         if not transfer:
             raise DebitHandler.invalid_arguments_exception("Invalid code", code)
@@ -329,28 +572,34 @@ class DebitHandler:
 
         state_src = self.data_instance.load_state(transfer["chat_id"])
 
-        members = state_src.items()
-        for member, value in members:
-            member = member.capitalize()
-
-            if state_src[member] == 0:
+        # source is emptied with negative deltas so concurrent changes there are kept
+        deltas = dict()
+        source_deltas = dict()
+        for member, value in state_src.items():
+            if value == 0:
                 continue
 
-            if member not in state:
-                raise DebitHandler.unknown_username_exception(member)
+            if member.capitalize() not in state:
+                raise DebitHandler.unknown_username_exception(member.capitalize())
             
-            state[member] += value
+            deltas[member.capitalize()] = value
+            source_deltas[member] = -value
+
+        # code, destination and source are written together
+        if not self.data_instance.apply_state_transfer(code, chat_id, deltas, transfer["chat_id"], source_deltas):
+            raise DebitHandler.invalid_arguments_exception("Transfer code already used", code)
 
-        self.data_instance.save_state(state, chat_id)
-        self.state_reset(transfer["chat_id"])
+        # the reply shows the new state without reading it again
+        for member, value in deltas.items():
+            state[member] += value
         return True
 
     def state_reset(self, chat_id):
-        data = self.data_instance.load_state(chat_id)
+        data = self.load_state(chat_id)
         for i in data:
             data[i] = 0
 
-        self.data_instance.save_state(data, chat_id)
+        self.save_state(data, chat_id)
         return True
 
     # Forces the state to be set, takes whole list of names and values
@@ -368,52 +617,47 @@ class DebitHandler:
             elif args[i].capitalize() in state:
                 raise DebitHandler.duplicate_name_exception("Duplicate name", args[i])
                 
-            state[args[i].capitalize()] = round(float(args[i + 1]), 2)
+            state[args[i].capitalize()] = to_cents(args[i + 1])
 
-        # if self.get_state_sum(state=state) != 0:
-        #     state = DebitHandler.fix_state_imbalance(state)
+        self.save_state(state, chat_id)
 
-        self.data_instance.save_state(state, chat_id)
-        
-    # state is better name for group state
-    @staticmethod
-    def fix_state_imbalance(state: dict) -> dict:
-        
-        state = state.copy()
-        state = {i: round(state[i], 2) for i in state}
-        difference = sum(list(state.values()))
-
-        if abs(difference) < 0.00001:
-            return state
-            
-        remainder = (100 * difference % len(state)) / 100
-        for i in state:
-            state[i] -= (100 * difference // len(state)) / 100
-
-        for i in range(0, int(remainder * 100)):
-            state[list(state.keys())[i]] -= 0.01
-    
-        return state
+    def commands_API(self, command_code: str, args: list, chat_id: int, snapshot: dict = None) -> bool:
+        '''
+        snapshot: parts of the chat already loaded by the caller (see AbstractDatabase.load_chat_snapshot),
+        anything missing is loaded on first use
+        '''
+        # the command as main.py logs it
+        command = " ".join([command_code] + [str(i) for i in args])
+        # stats arguments are stat names and dates, not amounts
+        if command_code not in STATS_READ_COMMANDS:
+            args = DebitHandler.resolvingAlgebraFormations(args)
+        self.snapshots[chat_id] = ChatSnapshot(self.data_instance, chat_id, snapshot)
+        try:
+            if args == list() and command_code not in OPTIONAL_ARGS_COMMANDS:
+                res = self.commands[command_code](chat_id)
+            else:
+                res = self.commands[command_code](args, chat_id)
 
-    def commands_API(self, command_code: str, args: list, chat_id: int) -> bool:
-        args = DebitHandler.resolvingAlgebraFormations(args)
-        if args == list():
-            res = self.commands[command_code](chat_id)
-        else:
-            res = self.commands[command_code](args, chat_id)
+            snapshot = self.snapshots[chat_id]
+            snapshot.commit()
+            self.transactions[chat_id] = snapshot.transaction if command_code in RECORDED_COMMANDS else None
+            record = transaction_record({"command": command, "transaction": snapshot.transaction})
+            self.stats_updates[chat_id] = (command, record, snapshot.undone)
 
-        succ_message = self.succ_respond[command_code][0]
-        if self.succ_respond[command_code][1] == 0:
-            return succ_message
+            succ_message = self.succ_respond[command_code][0]
+            if self.succ_respond[command_code][1] == 0:
+                return succ_message
 
-        elif self.succ_respond[command_code][1] == 1:
-            return succ_message + "\n---------------------\n" + self.get_state_string(chat_id)
+            elif self.succ_respond[command_code][1] == 1:
+                return succ_message + STATE_SEPARATOR + self.get_state_string(chat_id)
 
-        elif self.succ_respond[command_code][1] == 2:
-            return res
+            elif self.succ_respond[command_code][1] == 2:
+                return res
+        finally:
+            del self.snapshots[chat_id]
 
     def get_state_string_2(self, chat_id) -> tuple:
-        state = self.data_instance.load_state(chat_id)
+        state = {k: from_cents(v) for k, v in self.load_state(chat_id).items()}
         sorted_keys = sorted(state, key=state.get)
 
         if len(sorted_keys) == 0:
@@ -446,26 +690,26 @@ class DebitHandler:
         return "<pre>" + state_string + "</pre>"
     
     def get_state_string(self, chat_id) -> tuple:
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
         sorted_keys = sorted(state, key=state.get)
 
         if len(sorted_keys) == 0:
             raise DebitHandler.data_missing_exception()
             
         max_name_width = max([len(i) for i in sorted_keys])
-        max_num_width = max([len(str("%.2f" % abs(state[i]))) for i in sorted_keys])
+        max_num_width = max([len(format_cents(abs(state[i]))) for i in sorted_keys])
 
         state_string = ""
         for key in sorted_keys:
             value = state[key]
             if value < 0:
-                value = "%.2f" % abs(value)
+                value = format_cents(abs(value))
                 value = "- " + value.rjust(max_num_width)
             elif value > 0:
-                value = "%.2f" % value
+                value = format_cents(value)
                 value = "+ " + value.rjust(max_num_width)
             else:
-                value = "%.2f" % value
+                value = format_cents(value)
                 value = "  " + value.rjust(max_num_width)
 
             state_string += key.ljust(max_name_width) + " " + value + "\n"
@@ -473,21 +717,15 @@ class DebitHandler:
         return "<code>" + state_string + "</code>"
 
     def get_help_str(self, chat_id):
-        with open(self.help_path, "r", encoding="utf-8") as f:
-            disc_str = "".join(f.readlines())
-            
-        return disc_str
+        return self.help_str
 
     def get_disc_str(self, *args):
-        with open(self.disc_path, "r", encoding="utf-8") as f:
-            disc_str = "".join(f.readlines())
-            
-        return disc_str
+        return self.disc_str
     
     # Calculates the Elo rating of a player based on the result of a match
     # Args are list of players in order of losing: vrljo jura tomas
     def update_elo_rating(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
         players = args.copy()
         players = [x.capitalize() for x in players]
 
@@ -501,16 +739,14 @@ class DebitHandler:
             if i not in state:
                 raise DebitHandler.unknown_username_exception(i)
 
-        new_elo = elo_util.calc_order_elo(state, players)
-
-        for i in players:
-            state[i] = new_elo[i]
+        ratings = {i: from_cents(state[i]) for i in players}
+        new_elo = elo_util.calc_order_elo(ratings, players)
 
-        self.data_instance.save_state(state, chat_id)
+        self.apply_deltas({i: to_cents(new_elo[i]) - state[i] for i in players}, chat_id)
         return True
 
     def name_add(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
         if len(state.keys()) + len(args) > MAX_NUM_NAMES:
             raise DebitHandler.forbidden_action_exception(f"Too many names (max {MAX_NUM_NAMES})")
 
@@ -528,11 +764,11 @@ class DebitHandler:
                     raise DebitHandler.invalid_arguments_exception("Name is too long (20 chars max)", name)
                 state[name] = 0
 
-        self.data_instance.save_state(state, chat_id)
+        self.save_state(state, chat_id)
         return True
 
     def name_remove(self, args, chat_id):
-        data = self.data_instance.load_state(chat_id)
+        data = self.load_state(chat_id)
         names = [x.capitalize() for x in args]
 
         for name in names:
@@ -545,11 +781,11 @@ class DebitHandler:
             else:
                 del data[name]
 
-        self.data_instance.save_state(data, chat_id)
+        self.save_state(data, chat_id)
         return True
 
     def name_change(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
         if len(args) != 2:
             raise DebitHandler.invalid_command_format_exception("/nc takes 2 arguments", args)
 
@@ -569,12 +805,12 @@ class DebitHandler:
 
         state[new_name] = state.pop(name)
         self.name_change_groups_fix(name, new_name, chat_id)
-        self.data_instance.save_state(state, chat_id)
+        self.save_state(state, chat_id)
 
         return True
 
     def transaction(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
 
         don = args[0].capitalize()
         recs = list(map(lambda x: x.capitalize(), args[1::2]))
@@ -596,14 +832,16 @@ class DebitHandler:
             raise DebitHandler.invalid_command_format_exception()
 
 
-        amounts = [round(float(x), 2) for x in amounts]
+        amounts = [to_cents(x) for x in amounts]
 
+        deltas = dict()
         for i in range(len(recs)):
-            state[recs[i]] += -1 * amounts[i]
+            deltas[recs[i]] = deltas.get(recs[i], 0) - amounts[i]
 
-        state[don] += sum(amounts)
+        deltas[don] = deltas.get(don, 0) + sum(amounts)
 
-        self.data_instance.save_state(state, chat_id)
+        self.apply_deltas(deltas, chat_id)
+        self.record_transaction(chat_id, "t", don, recs, sum(amounts), deltas, amounts)
         return True
 
     def transaction_division(self, args, chat_id):
@@ -616,7 +854,7 @@ class DebitHandler:
                     if not specified it is 1 for that person
             money: The total amount of money to be divided.
         '''
-        # state = self.data_instance.load_state(chat_id)
+        # state = self.load_state(chat_id)
 
         # don = args[0].capitalize()
         # recs = list(map(lambda x: x.capitalize(), args[1:-1]))
@@ -635,10 +873,10 @@ class DebitHandler:
         #     state[i.capitalize()] += -1 * money_per_person
         # state[don] += money_per_person * len(recs)
 
-        # self.data_instance.save_state(state, chat_id)
+        # self.save_state(state, chat_id)
         # return True
 
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
         recs_starting_index = 1
         don = args[0].capitalize()
         don_mult = 1
@@ -669,7 +907,7 @@ class DebitHandler:
             
             i += 1
 
-        money = float(args[-1])
+        money = to_cents(args[-1])
 
         if don not in state:
             raise DebitHandler.unknown_username_exception(don)
@@ -679,20 +917,24 @@ class DebitHandler:
         if amount_of_mults == 0:
             return True
 
-        for i in recs:
-            state[i] += -1 * round(money * (recs[i] / amount_of_mults), 2)
-        state[don] += round(money * (amount_of_mults - don_mult) / amount_of_mults, 2)
+        # shares add up exactly to money, donor pays their own share
+        shares = split_cents(money, [don_mult] + list(recs.values()))
+        deltas = dict()
+        for i, share in zip(recs, shares[1:]):
+            deltas[i] = -1 * share
+        deltas[don] = deltas.get(don, 0) + money - shares[0]
 
-        self.data_instance.save_state(state, chat_id)
+        self.apply_deltas(deltas, chat_id)
+        self.record_transaction(chat_id, "td", don, recs, money, deltas)
         return True
 
 
     def division_transaction_excluding(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
 
         don = args[0].capitalize()
         recs = list(map(lambda x: x.capitalize(), args[1:-1]))
-        money = float(args[-1])
+        money = to_cents(args[-1])
 
         if don not in state:
             raise DebitHandler.unknown_username_exception(don)
@@ -701,67 +943,71 @@ class DebitHandler:
             if i not in state:
                 raise DebitHandler.unknown_username_exception(i)
         
-        money_per_person = round(money / len(recs), 2)
+        shares = split_cents(money, [1] * len(recs))
 
-        for i in recs:
-            state[i.capitalize()] += -1 * money_per_person
-        state[don] += money_per_person * len(recs)
+        deltas = dict()
+        for i, share in zip(recs, shares):
+            deltas[i] = deltas.get(i, 0) - share
+        deltas[don] = deltas.get(don, 0) + money
 
-        self.data_instance.save_state(state, chat_id)
+        self.apply_deltas(deltas, chat_id)
+        self.record_transaction(chat_id, "tdex", don, recs, money, deltas)
         return True
 
     def transaction_group(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
 
         # parsing arguments
         don = args[0].capitalize()
         group_name = args[1].upper()
-        money = float(args[2])
+        money = to_cents(args[2])
 
         # checking arguments
         if don not in state:
             raise DebitHandler.unknown_username_exception(don)
 
-        groups = self.data_instance.load_groups(chat_id)
+        groups = self.load_groups(chat_id)
         if group_name not in groups:
             raise DebitHandler.unknown_group_exception(group_name)
 
-        members = groups[group_name]
+        members = list(groups[group_name])
 
         for i in members:
             if i not in state:
                 raise DebitHandler.unknown_username_exception(i)
 
-        # updating state
-        money_per_person = round(money / len(members), 2)
+        # updating state, donor's share stays with the donor
+        shares = dict(zip(members, split_cents(money, [1] * len(members))))
 
         members.remove(don)
 
+        deltas = dict()
         for i in members:
-            state[i] += -1 * money_per_person
+            deltas[i] = -1 * shares[i]
 
-        state[don] += money_per_person * len(members)
+        deltas[don] = sum(shares[i] for i in members)
 
-        self.data_instance.save_state(state, chat_id)
+        self.apply_deltas(deltas, chat_id)
+        self.record_transaction(chat_id, "tg", don, members, money, deltas)
         return True
     
     def transaction_group_excluding(self, args, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
 
         # parsing arguments
         don = args[0].capitalize()
         group_name = args[1].upper()
-        money = float(args[2])
+        money = to_cents(args[2])
 
         # checking arguments
         if don not in state:
             raise DebitHandler.unknown_username_exception(don)
 
-        groups = self.data_instance.load_groups(chat_id)
+        groups = self.load_groups(chat_id)
         if group_name not in groups:
             raise DebitHandler.unknown_group_exception(group_name)
 
-        members = groups[group_name]
+        members = list(groups[group_name])
 
         for i in members:
             if i not in state:
@@ -770,70 +1016,135 @@ class DebitHandler:
         # updating state
         members.remove(don)
 
-        money_per_person = round(money / len(members), 2)
+        shares = split_cents(money, [1] * len(members))
 
-        for i in members:
-            state[i] += -1 * money_per_person
+        deltas = dict()
+        for i, share in zip(members, shares):
+            deltas[i] = -1 * share
 
-        state[don] += money_per_person * len(members)
+        deltas[don] = money
 
-        self.data_instance.save_state(state, chat_id)
+        self.apply_deltas(deltas, chat_id)
+        self.record_transaction(chat_id, "tgex", don, members, money, deltas)
         return True
 
     def get_random_name(self, chat_id):
-        state = self.data_instance.load_state(chat_id)
+        state = self.load_state(chat_id)
         if len(state) == 0:
             raise DebitHandler.data_missing_exception()
         keys = list(state.keys())
         return (random.choice(keys), 0)
 
-    def undo(self, chat_id):
-        log = self.data_instance.load_log(chat_id, 0)
-        command = log["command"].split(" ")
-        command_code = command[0]
-        args = command[1:]
+    def undo(self, args, chat_id):
+        '''
+        /u undoes the newest transaction that wasn't undone yet, /u N the newest N of them
+        and /u id [log id] a single transaction by its log id.
+        Stored deltas are inverted, so the result doesn't depend on groups or names changed since.
+        '''
+        if len(args) == 2 and str(args[0]).lower() == "id" and self.is_num(args[1]):
+            log = self.data_instance.load_log_by_seq(chat_id, int(args[1]))
+            if not log:
+                raise DebitHandler.invalid_arguments_exception("Unknown log id", args[1])
+            if log.get("undone"):
+                raise DebitHandler.forbidden_action_exception("Transaction was already undone")
+            if transaction_record(log) is None:
+                raise DebitHandler.forbidden_action_exception("Only transactions can be undone")
+            logs = [log]
+
+        elif len(args) <= 1:
+            count = int(args[0]) if args and self.is_num(args[0]) else 1
+            if args and not self.is_num(args[0]):
+                raise DebitHandler.invalid_command_format_exception()
+            if not 1 <= count <= MAX_UNDO:
+                raise DebitHandler.invalid_arguments_exception(f"Number of transactions must be 1 to {MAX_UNDO}", args[0])
+
+            logs = [i for i in self.data_instance.load_logs(chat_id, UNDO_SEARCH_LOGS) if transaction_record(i) is not None]
+            if len(logs) == 0:
+                raise DebitHandler.forbidden_action_exception("Nothing to undo")
+            if len(logs) < count:
+                raise DebitHandler.forbidden_action_exception(f"Only {len(logs)} transactions can be undone")
+            logs = logs[:count]
 
-        if command_code not in ["t", "tg", "td", "tgex", "tdex"]:
-            raise DebitHandler.forbidden_action_exception("Only transactions can be undone")
+        else:
+            raise DebitHandler.invalid_command_format_exception()
 
-        if len(args) == 0:
-            raise DebitHandler.forbidden_action_exception("Transaction was invalid")
+        # text file logs have no log ids to mark
+        if any("seq" not in log for log in logs):
+            raise DebitHandler.forbidden_action_exception("Undo is not supported on this storage")
 
-        args = DebitHandler.resolvingAlgebraFormations(args)
-        args = DebitHandler.invertNumberSignFromArray(args)
+        state = self.load_state(chat_id)
+        deltas = dict()
+        for log in logs:
+            for name, delta in self.transaction_deltas(log, chat_id).items():
+                deltas[name] = deltas.get(name, 0) - delta
 
-        if self.commands[command_code](args, chat_id):
-            #self.data_instance.remove_log(chat_id, 0)
-            return True
-        else:
-            raise DebitHandler.forbidden_action_exception("Undo failed")
+        for name in deltas:
+            if name not in state:
+                raise DebitHandler.unknown_username_exception(name)
+
+        # markers and balances are written together, a log can't be undone twice
+        seqs = [log["seq"] for log in logs]
+        try:
+            applied = self.data_instance.apply_undo(chat_id, seqs, deltas)
+        except NotImplementedError:
+            raise DebitHandler.forbidden_action_exception("Undo is not supported on this storage")
+        if not applied:
+            raise DebitHandler.forbidden_action_exception("Transaction was already undone")
+
+        # the reply shows the new state without reading it again
+        for name, delta in deltas.items():
+            state[name] += delta
+
+        snapshot = self.snapshots[chat_id]
+        snapshot.transaction = {"type": "u", "undoes": seqs, "deltas": deltas}
+        snapshot.undone = [transaction_record(log) for log in logs]
+
+        undone = "\n".join(f"{log['seq']}: {log['command']}" for log in logs)
+        return "Undo successful\n" + undone + STATE_SEPARATOR + self.get_state_string(chat_id)
+
+    def transaction_deltas(self, log, chat_id) -> dict:
+        '''Balance changes (cents) a transaction log made'''
+        record = transaction_record(log)
+        if record["deltas"] is not None:
+            return record["deltas"]
+
+        # logs saved before transaction records: the command runs again on a copy of the chat, nothing is written
+        self.load_state(chat_id)
+        snapshot = self.snapshots[chat_id]
+        import copy
+        scratch = ChatSnapshot(self.data_instance, chat_id, copy.deepcopy(snapshot.data))
+        self.snapshots[chat_id] = scratch
+        try:
+            command = parse_command(log["command"])
+            self.commands[command[0]](list(command[1:]), chat_id)
+        finally:
+            self.snapshots[chat_id] = snapshot
+        return scratch.transaction["deltas"] if scratch.transaction else dict()
 
     def get_state_sum(self, chat_id=None, state=None):
         if not state:
-            state = self.data_instance.load_state(chat_id)
+            state = self.load_state(chat_id)
 
-        L = state.values()
-        L = [float(i) for i in L]
-        return (round(sum(L), 4), 0)
+        return (from_cents(sum(state.values())), 0)
 
     def state_multiply(self, args:list, chat_id):
-        multiplier = float(args[0])
-        state = self.data_instance.load_state(chat_id)
-        name: str
-        for name in state.keys():
-            state[name] = state[name] * multiplier
-        
-        state = self.fix_state_imbalance(state)
-        self.data_instance.save_state(state, chat_id)
+        multiplier = args[0]
+        state = self.load_state(chat_id)
+
+        # rounded so a balanced state stays balanced
+        state = scale_cents(state, multiplier)
+        self.save_state(state, chat_id)
 
         return True
     
     def get_specific_stat(self, args, chat_id):
-        """Get a specific statistic by type"""
-        if len(args) != 1:
-            raise DebitHandler.invalid_arguments_exception("Usage: /stat <stat_type>", " ".join(args))
+        """Get a specific statistic by type, /stat <stat_type> [window] limits it to a time window"""
+        import MaterializedStats
+        if len(args) not in (1, 2):
+            raise DebitHandler.invalid_arguments_exception("Usage: /stat <stat_type> [window]", " ".join(args))
         
         stat_type = args[0].lower()
+        window = self.parse_stats_window(args[1]) if len(args) == 2 else None
         
         # Check if calculator exists first
         stat_class = self.stats_manager.get_stat_instance(stat_type)
@@ -842,46 +1153,182 @@ class DebitHandler:
             raise DebitHandler.invalid_arguments_exception(
                 f"Unknown stat type '{stat_type}'. Available: {available_stats}", stat_type
             )
+        if window is not None and not stat_class.supports_window():
+            raise DebitHandler.invalid_arguments_exception(f"{stat_type} can't be limited to a time window", args[1])
         
+        # built-in log stats come from the materialized aggregate, it covers the whole history
+        if window is None and self.is_materialized(stat_type):
+            result = MaterializedStats.result(self.load_stats_aggregate(chat_id), stat_type)
+            if result is not None:
+                return stat_class.format_result(result)
+
         # Load only required data
         logs = None
         state = None
-        
-        if stat_class.requires_logs():
-           logs = self.data_instance.load_logs(chat_id, False)
-             
+        summaries = None
+        key = None
+
         if stat_class.requires_state():
-            state = self.data_instance.load_state(chat_id)
+            state = {k: from_cents(v) for k, v in self.load_state(chat_id).items()}
+
+        if stat_class.requires_logs():
+            # repeated reads cost one version check, stats of the state only aren't worth caching
+            key = self.stats_cache_key(chat_id, stat_type, window, state)
+            cached = self.stats_cache.get(key) if key is not None else None
+            if cached is not None:
+                return cached
+
+            logs, summaries, archived_logs = self.load_stats_logs(chat_id, [stat_type], window)
+            if archived_logs:
+                logs = logs + archived_logs
 
         # Calculate the statistic
-        result = self.stats_manager.calculate_stat(stat_type, logs, state)
+        result = self.stats_manager.calculate_stat(stat_type, logs, state, summaries, window)
         
         if result is None:
             raise DebitHandler.data_missing_exception(f"Failed to calculate {stat_type}")
-        
+
+        if key is not None and not result.startswith("❌"):
+            self.stats_cache.put(key, result)
         return result
     
-    def get_all_stats(self, chat_id):
-        """Get all available statistics"""
-        logs = self.data_instance.load_logs(chat_id, False)
-        if len(logs) == 0:
-            raise DebitHandler.data_missing_exception("No logs found")
-        
-        state = self.data_instance.load_state(chat_id)
-        return self.stats_manager.calculate_all_stats(logs, state)
+    def get_all_stats(self, args, chat_id):
+        """Get all available statistics, /statsall [window] limits them to a time window"""
+        import MaterializedStats
+        if len(args) > 1:
+            raise DebitHandler.invalid_arguments_exception("Usage: /statsall [window]", " ".join(args))
+        window = self.parse_stats_window(args[0]) if args else None
+
+        results = dict()
+        if window is None:
+            aggregate = self.load_stats_aggregate(chat_id)
+            if not aggregate["commands"]:
+                raise DebitHandler.data_missing_exception("No logs found")
+
+            for name in self.stats_manager.calculators:
+                if self.is_materialized(name):
+                    result = MaterializedStats.result(aggregate, name)
+                    if result is not None:
+                        results[name] = result
+
+        # logs are only loaded for calculators the aggregate doesn't cover
+        remaining = [name for name, calculator in self.stats_manager.calculators.items()
+                     if name not in results and calculator.requires_logs()]
+        logs = list()
+        summaries = None
+        archived_logs = None
+        key = None
+        state = {k: from_cents(v) for k, v in self.load_state(chat_id).items()}
+        if remaining:
+            key = self.stats_cache_key(chat_id, "statsall", window, state)
+            cached = self.stats_cache.get(key) if key is not None else None
+            if cached is not None:
+                return cached
+
+            logs, summaries, archived_logs = self.load_stats_logs(chat_id, remaining, window)
+            if window is not None and not logs and not summaries and not archived_logs:
+                raise DebitHandler.data_missing_exception(f"No logs in {window.text}")
+
+        result = self.stats_manager.calculate_all_stats(logs, state, summaries, archived_logs, results, window)
+        if window is not None:
+            result = f"Stats for {window.text}" + result
+        # only the log calculators are worth caching, and not their errors
+        if key is not None and "❌" not in result:
+            self.stats_cache.put(key, result)
+        return result
+
+    def load_stats_logs(self, chat_id, names, window=None) -> tuple:
+        """Logs the named calculators need, returns (logs, summaries, archived_logs)
+
+        Archived segments are served from their summaries when all of names can use them and
+        decompressed otherwise (archived_logs, older than logs). With a window only the logs inside it
+        are queried and only segments overlapping it are read, so the cost follows the size of the window.
+        """
+        if window is None:
+            logs = self.data_instance.load_logs(chat_id, False)
+        else:
+            logs = self.data_instance.load_log_after_time(chat_id, window.after, window.end)
+
+        summaries = self.data_instance.load_log_segments(chat_id)
+        if window is not None:
+            summaries = [i for i in summaries if window.overlaps(i["from"], i["to"])]
+        if not summaries:
+            return logs, None, None
+
+        # summaries of segments partly outside the window count logs that don't belong to it
+        partial = window is not None and not all(window.covers(i["from"], i["to"]) for i in summaries)
+        if not partial and all(self.stats_manager.can_use_summaries(name, summaries) for name in names):
+            return logs, summaries, None
+
+        archived_logs = self.log_compactor.load_archived_logs(chat_id, summaries)
+        if window is not None:
+            archived_logs = [i for i in archived_logs if window.contains(i["date_time"])]
+        return logs, None, archived_logs
+
+    @staticmethod
+    def parse_stats_window(text):
+        # imported here like the stats modules, not at cold start
+        from Util.time_window import parse_window
+        try:
+            return parse_window(text)
+        except ValueError as e:
+            raise DebitHandler.invalid_arguments_exception(
+                f"{e}. Windows look like 30d, 2w, 2025-01 or 2025-01..2025-03", text
+            )
+
+    def rebuild_stats(self, chat_id):
+        """Rebuild the materialized stats from the logs, reports what the stored ones got wrong"""
+        import MaterializedStats
+        stored = self.data_instance.load_stats(chat_id)
+        aggregate, count = self.build_stats_aggregate(chat_id)
+        self.data_instance.save_stats(aggregate, chat_id)
+
+        if not MaterializedStats.usable(stored):
+            return f"Stats built from {count} logs"
+        differences = MaterializedStats.differences(stored, aggregate)
+        if differences:
+            return f"Stats rebuilt from {count} logs, corrected: {', '.join(differences)}"
+        return f"Stats rebuilt from {count} logs, no differences"
     
     def get_available_stats(self, chat_id):
         """Get list of available statistic types"""
         available = self.stats_manager.get_available_stats()
         return "Available statistics:\n" + "\n".join(f"• {stat}" for stat in available)
 
-    @staticmethod
-    def invertNumberSignFromArray(args:list):
-        for i in args:
-            if DebitHandler.is_num(i):
-                args[args.index(i)] = str(float(i) * -1)
-
-        return args
+@lru_cache(maxsize=4096)
+def parse_command(command: str) -> tuple:
+    '''
+    Logged command ("t karlo jura 10+5") split into tokens with amounts evaluated.
+    Cached, stats calculators go through the same logs many times.
+    '''
+    return tuple(DebitHandler.resolvingAlgebraFormations(command.split(" ")))
+
+def transaction_record(log: dict) -> dict:
+    '''
+    Structured record of a transaction log (type, donor, recipients, total, amounts and deltas in cents),
+    None for other commands and undone transactions.
+    Logs saved before records existed get one derived from the command text,
+    with deltas None and, for group commands, recipients None (the groups may have changed since).
+    '''
+    command_code = log["command"].split(" ", 1)[0]
+    # undone transactions don't count anymore
+    if command_code not in TRANSACTION_COMMANDS or log.get("undone"):
+        return None
+    if log.get("transaction"):
+        return log["transaction"]
+
+    command = parse_command(log["command"])
+    record = {"type": command_code, "donor": command[1].capitalize(), "recipients": None, "deltas": None}
+    if command_code == "t":
+        record["recipients"] = [i.capitalize() for i in command[2::2]]
+        record["amounts"] = [to_cents(i) for i in command[3::2]]
+        record["total"] = sum(record["amounts"])
+    else:
+        record["total"] = to_cents(command[-1])
+        record["amounts"] = [record["total"]]
+        if command_code in ("td", "tdex"):
+            record["recipients"] = [i.capitalize() for i in command[2:-1] if not DebitHandler.is_num(i)]
+    return record
 
 if __name__ == '__main__':
     # test format_table
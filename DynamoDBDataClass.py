@@ -1,10 +1,9 @@
-import boto3
 import os
 import datetime
 from decimal import Decimal
-import json
+from functools import cached_property
 
-from AbstractDatabase import AbstractDatabase
+from AbstractDatabase import AbstractDatabase, SNAPSHOT_PARTS, LOG_DATE_FORMAT, format_log_time
 
 # Load environment variables if not already loaded
 if "DYNAMODB_TABLE_NAME" not in os.environ:
@@ -13,161 +12,554 @@ if "DYNAMODB_TABLE_NAME" not in os.environ:
 
 table_name = os.environ["DYNAMODB_TABLE_NAME"]
 table_name_trans = os.environ["CODES_TABLE_NAME"]
+# logs table: partition key chat_id (N), sort key seq (N),
+# local secondary index LOGS_TIME_INDEX on chat_id + date_time (S)
+table_name_logs = os.environ["LOGS_TABLE_NAME"]
+LOGS_TIME_INDEX = "date_time-index"
+# archived log segments: partition key chat_id (N), sort key first_seq (N)
+table_name_archive = os.environ["LOG_ARCHIVE_TABLE_NAME"]
+# optional, shared rate limit counters: partition key key (S), TTL attribute expires_at
+table_name_rate = os.environ.get("RATE_LIMIT_TABLE_NAME")
+# optional, processed update markers: partition key key (S), TTL attribute expires_at
+table_name_updates = os.environ.get("UPDATES_TABLE_NAME")
+BATCH_WRITE_LIMIT = 25 # items per BatchWriteItem request
+STATS_UPDATE_ATTEMPTS = 5 # conditional writes of the stats aggregate before it is dropped, see update_stats
 
 class DynamoDBDataClass(AbstractDatabase):
+    '''
+    Uses the low-level DynamoDB client, boto3 is imported and the client created on first use.
+    Constructing the class is free, so a Lambda cold start only pays for boto3 when a command reaches storage.
+    '''
     def __init__(self):
-        region = os.environ.get("AWS_REGION", "eu-central-1")  # fallback if not set
-        self.dynamodb = boto3.resource("dynamodb", region_name=region)
-        self.table = self.dynamodb.Table(table_name)
-        self.table_trans = self.dynamodb.Table(table_name_trans)
+        self.region = os.environ.get("AWS_REGION", "eu-central-1")  # fallback if not set
+
+    @cached_property
+    def client(self):
+        import boto3
+        return boto3.client("dynamodb", region_name=self.region)
+
+    @cached_property
+    def serializer(self):
+        from boto3.dynamodb.types import TypeSerializer
+        return TypeSerializer()
+
+    @cached_property
+    def deserializer(self):
+        from boto3.dynamodb.types import TypeDeserializer
+        return TypeDeserializer()
+
+    # python values -> attribute values, numbers must be int or Decimal
+    def to_item(self, values: dict) -> dict:
+        return {k: self.serializer.serialize(v) for k, v in values.items()}
+
+    # attribute values -> python values, numbers come back as Decimal
+    def from_item(self, item: dict) -> dict:
+        return {k: self.deserializer.deserialize(v) for k, v in item.items()}
+
+    # resource tables, only used by the migration scripts in Util
+    @cached_property
+    def dynamodb(self):
+        import boto3
+        return boto3.resource("dynamodb", region_name=self.region)
+
+    @cached_property
+    def table(self):
+        return self.dynamodb.Table(table_name)
+
+    @cached_property
+    def table_logs(self):
+        return self.dynamodb.Table(table_name_logs)
 
     def load_state(self, chat_id: int) -> dict:
-        response = self.table.get_item(
-            Key={"chat_id": chat_id},
+        response = self.client.get_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
             AttributesToGet = ["state"]
         )
-        if "Item" in response and "state" in response["Item"]:
-            low_level_data = response["Item"]["state"]
-            python_data = {k: float(v) for k,v in low_level_data.items()}
+        item = self.from_item(response.get("Item", {}))
+        if "state" in item:
+            # balances are integer cents
+            python_data = {k: int(v) for k,v in item["state"].items()}
             return python_data
         else:
             return dict()
 
     def save_state(self, state, chat_id: int):
-        # convert float to Decimal
-        state = json.loads(json.dumps(state), parse_float=Decimal)
-
-        self.table.update_item(
-            Key={"chat_id": chat_id},
+        self.client.update_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
             AttributeUpdates={
                 'state': {
-                    'Value': state,
+                    'Value': self.serializer.serialize(state),
                     'Action': 'PUT'
                 }
             }
         )
 
     def load_groups(self, chat_id: int) -> dict:
-        response = self.table.get_item(
-            Key={"chat_id": chat_id},
+        response = self.client.get_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
             AttributesToGet = ["groups"]
         )
-
-        if "Item" in response and "groups" in response["Item"]:
-            return response["Item"]["groups"]
+        item = self.from_item(response.get("Item", {}))
+        if "groups" in item:
+            return item["groups"]
         else:
             return dict()
 
     def save_groups(self, groups, chat_id: int):
-        self.table.update_item(
-            Key={"chat_id": chat_id},
+        self.client.update_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
             AttributeUpdates={
                 'groups': {
-                    'Value': groups,
+                    'Value': self.serializer.serialize(groups),
                     'Action': 'PUT'
                 }
             }
         )
-    # get the last log in the list
-    def load_log(self, chat_id: int, reverse_index: int) -> dict:
-        response = self.table.get_item(
-            Key={"chat_id": chat_id},
-            ProjectionExpression = f"logs[{reverse_index}]"
+    # numbers of the stats aggregate and of transaction records come back as Decimal, they are all ints
+    @staticmethod
+    def int_values(value):
+        if isinstance(value, dict):
+            return {k: DynamoDBDataClass.int_values(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [DynamoDBDataClass.int_values(i) for i in value]
+        if isinstance(value, Decimal):
+            return int(value)
+        return value
+
+    # the stored aggregate has a revision, incremented by every write, that conditional writes check
+    def stats_from_item(self, item: dict) -> tuple:
+        if "stats" not in item:
+            return None, None
+        stats = self.int_values(item["stats"])
+        return stats, stats.pop("revision", 0)
+
+    def load_stats(self, chat_id: int) -> dict:
+        return self.load_chat_snapshot(chat_id, ("stats",))["stats"]
+
+    def save_stats(self, stats, chat_id: int):
+        self.update_stats(chat_id, lambda stored: stats)
+
+    # optimistic read-modify-write, the write fails if another one came in between and is tried again
+    def update_stats(self, chat_id: int, change):
+        for _ in range(STATS_UPDATE_ATTEMPTS):
+            response = self.client.get_item(
+                TableName=table_name,
+                Key=self.to_item({"chat_id": chat_id}),
+                ProjectionExpression="#stats",
+                ExpressionAttributeNames={"#stats": "stats"},
+                ConsistentRead=True
+            )
+            stats, revision = self.stats_from_item(self.from_item(response.get("Item", {})))
+            stats = change(stats)
+            if stats is None:
+                return
+
+            names = {"#stats": "stats"}
+            values = {":stats": dict(stats, revision=(revision or 0) + 1)}
+            if revision is None:
+                condition = "attribute_not_exists(#stats)"
+            elif revision == 0:
+                # saved before aggregates had a revision
+                condition = "attribute_exists(#stats) AND attribute_not_exists(#stats.#revision)"
+                names["#revision"] = "revision"
+            else:
+                condition = "#stats.#revision = :revision"
+                names["#revision"] = "revision"
+                values[":revision"] = revision
+
+            try:
+                self.client.update_item(
+                    TableName=table_name,
+                    Key=self.to_item({"chat_id": chat_id}),
+                    UpdateExpression="SET #stats = :stats",
+                    ConditionExpression=condition,
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=self.to_item(values)
+                )
+                return
+            except self.client.exceptions.ConditionalCheckFailedException:
+                continue
+
+        # still changing after every attempt, the next /stat* command builds it again from the logs
+        self.client.update_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
+            UpdateExpression="REMOVE #stats",
+            ExpressionAttributeNames={"#stats": "stats"}
         )
-        index = reverse_index
-        if "Item" in response and "logs" in response["Item"]:
 
-            return response["Item"]["logs"][0]
-        else:
+    # counters added in place with SET x = if_not_exists(x, 0) + :n, without reading the aggregate
+    def add_stats_counts(self, chat_id: int, counts: dict):
+        # imported here like boto3, not at cold start
+        from MaterializedStats import AGGREGATE_VERSION
+        assignments = ["#stats.#revision = if_not_exists(#stats.#revision, :zero) + :one"]
+        names = {"#stats": "stats", "#revision": "revision", "#version": "version"}
+        values = {":zero": 0, ":one": 1, ":version": AGGREGATE_VERSION}
+        counters = [(field, key, count) for field, keys in counts.items() for key, count in keys.items()]
+        for i, (field, key, count) in enumerate(counters):
+            assignments.append(f"#stats.#f{i}.#k{i} = if_not_exists(#stats.#f{i}.#k{i}, :zero) + :c{i}")
+            names[f"#f{i}"] = field
+            names[f"#k{i}"] = key
+            values[f":c{i}"] = count
+
+        try:
+            self.client.update_item(
+                TableName=table_name,
+                Key=self.to_item({"chat_id": chat_id}),
+                UpdateExpression="SET " + ", ".join(assignments),
+                ConditionExpression="#stats.#version = :version",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=self.to_item(values)
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # no current aggregate, built from the logs by the first /stat* command
+            pass
+
+    # state, groups and stats in one GetItem, the log (if requested) comes from the logs table
+    def load_chat_snapshot(self, chat_id: int, parts=SNAPSHOT_PARTS, log_index: int = 0) -> dict:
+        projection = list()
+        names = dict()
+        for part in parts:
+            if part != "log":
+                projection.append(f"#{part}")
+                names[f"#{part}"] = part
+
+        item = dict()
+        if projection:
+            response = self.client.get_item(
+                TableName=table_name,
+                Key=self.to_item({"chat_id": chat_id}),
+                ProjectionExpression=", ".join(projection),
+                ExpressionAttributeNames=names
+            )
+            item = self.from_item(response.get("Item", {}))
+
+        snapshot = dict()
+        if "state" in parts:
+            snapshot["state"] = {k: int(v) for k, v in item.get("state", {}).items()}
+        if "groups" in parts:
+            snapshot["groups"] = item.get("groups", dict())
+        if "stats" in parts:
+            snapshot["stats"] = self.stats_from_item(item)[0]
+        if "log" in parts:
+            snapshot["log"] = self.load_log(chat_id, log_index)
+        return snapshot
+
+    # state, groups and stats in one UpdateItem
+    def save_chat_snapshot(self, snapshot, chat_id: int):
+        assignments = list()
+        names = dict()
+        values = dict()
+        for part in ("state", "groups", "stats"):
+            if part not in snapshot:
+                continue
+            assignments.append(f"#{part} = :{part}")
+            names[f"#{part}"] = part
+            values[f":{part}"] = snapshot[part]
+
+        if not assignments:
+            return
+
+        self.client.update_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
+            UpdateExpression="SET " + ", ".join(assignments),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=self.to_item(values)
+        )
+
+    # update of the listed members only, every member must exist
+    @staticmethod
+    def balance_deltas_update(chat_id: int, deltas: dict) -> dict:
+        assignments = list()
+        conditions = list()
+        names = {"#state": "state"}
+        values = dict()
+        for i, (name, delta) in enumerate(deltas.items()):
+            # ADD only works on top-level attributes, nested map values need SET x = x + :d
+            assignments.append(f"#state.#n{i} = #state.#n{i} + :d{i}")
+            conditions.append(f"attribute_exists(#state.#n{i})")
+            names[f"#n{i}"] = name
+            values[f":d{i}"] = {"N": str(int(delta))}
+
+        return {
+            "TableName": table_name,
+            "Key": {"chat_id": {"N": str(int(chat_id))}},
+            "UpdateExpression": "SET " + ", ".join(assignments),
+            "ConditionExpression": " AND ".join(conditions),
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+        }
+
+    # one atomic UpdateItem touching only the listed members
+    def apply_balance_deltas(self, chat_id: int, deltas: dict) -> dict:
+        if not deltas:
             return dict()
-        
-    # load all logs in the list
-    def load_logs(self, chat_id: int, reverse_index: int) -> list:
-        response = self.table.get_item(
-            Key={"chat_id": chat_id},
-            AttributesToGet = ["logs"]
+
+        response = self.client.update_item(
+            **self.balance_deltas_update(chat_id, deltas),
+            ReturnValues="UPDATED_NEW"
         )
+        updated = self.from_item(response.get("Attributes", {})).get("state", {})
+        return {k: int(v) for k, v in updated.items()}
 
-        if "Item" in response and "logs" in response["Item"]:
-            logs = response["Item"]["logs"]
-            if reverse_index < 0:
+    # amounts of the transaction record back to int cents
+    def log_from_item(self, item: dict) -> dict:
+        log = self.from_item(item)
+        if "transaction" in log:
+            # records hold whole cents and seqs (undo records have undoes instead of a total)
+            log["transaction"] = self.int_values(log["transaction"])
+        return log
+
+    # query logs of a chat, newest first
+    def query_logs(self, chat_id: int, limit: int = None, after_time: str = None, end_time: str = None) -> list:
+        values = {":c": chat_id}
+        kwargs = {
+            "TableName": table_name_logs,
+            "KeyConditionExpression": "chat_id = :c",
+            "ScanIndexForward": False,
+        }
+        if after_time is not None and end_time is not None:
+            # key conditions can't have two bounds, BETWEEN is inclusive so the bounds are filtered out
+            kwargs["IndexName"] = LOGS_TIME_INDEX
+            kwargs["KeyConditionExpression"] += " AND date_time BETWEEN :t AND :e"
+            kwargs["FilterExpression"] = "date_time <> :t AND date_time <> :e"
+            values[":t"] = after_time
+            values[":e"] = end_time
+        elif after_time is not None:
+            kwargs["IndexName"] = LOGS_TIME_INDEX
+            kwargs["KeyConditionExpression"] += " AND date_time > :t"
+            values[":t"] = after_time
+        kwargs["ExpressionAttributeValues"] = self.to_item(values)
+
+        logs = list()
+        while True:
+            if limit is not None:
+                kwargs["Limit"] = limit - len(logs)
+            response = self.client.query(**kwargs)
+            logs.extend(self.log_from_item(i) for i in response.get("Items", []))
+
+            if "LastEvaluatedKey" not in response or (limit is not None and len(logs) >= limit):
                 return logs
-            else:
-                return logs[-reverse_index:]
-        
-    # get logs created after datetime
-    def load_log_after_time(self, chat_id: int, time: str) -> list:
-        response = self.table.get_item(
-            Key={"chat_id": chat_id},
-            AttributesToGet = ["logs"],
-            ProjectionExpression="date_time > :time",
-        )
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
-        if "Item" in response and "logs" in response["Item"]:
-            logs = response["Item"]["logs"]
-            logs_after_time = [log for log in logs if log["date_time"] > time]
-            return logs_after_time
+    # get a single log, reverse_index 0 is the newest
+    def load_log(self, chat_id: int, reverse_index: int) -> dict:
+        logs = self.query_logs(chat_id, limit=reverse_index + 1)
+        if len(logs) > reverse_index:
+            return logs[reverse_index]
         else:
-            return list()
+            return dict()
+
+    # load newest reverse_index logs, all logs if reverse_index is False or negative
+    def load_logs(self, chat_id: int, reverse_index: int) -> list:
+        if not reverse_index or reverse_index < 0:
+            return self.query_logs(chat_id)
+        return self.query_logs(chat_id, limit=reverse_index)
 
-    # append log to the end of the list in dynamodb
-    def save_log(self, chat_id: int, sender_id: int, command: str):
+    def load_log_by_seq(self, chat_id: int, seq: int) -> dict:
+        response = self.client.get_item(
+            TableName=table_name_logs,
+            Key=self.to_item({"chat_id": int(chat_id), "seq": int(seq)})
+        )
+        return self.log_from_item(response["Item"]) if "Item" in response else dict()
+
+    # get logs created in a time window, key condition on the date_time index
+    def load_log_after_time(self, chat_id: int, time, end_time=None) -> list:
+        if end_time is not None:
+            end_time = format_log_time(end_time)
+        return self.query_logs(chat_id, after_time=format_log_time(time), end_time=end_time)
+
+    # logs are numbered per chat by the log_seq counter in the chat item
+    def save_log(self, chat_id: int, sender_id: int, command: str, transaction: dict = None):
         # convert args to string
         sender_id = int(sender_id)
         chat_id = int(chat_id)
-        dateTimeStr = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        dateTimeStr = datetime.datetime.now().strftime(LOG_DATE_FORMAT)
+
+        response = self.client.update_item(
+            TableName=table_name,
+            Key=self.to_item({"chat_id": chat_id}),
+            UpdateExpression="ADD log_seq :one",
+            ExpressionAttributeValues=self.to_item({":one": 1}),
+            ReturnValues="UPDATED_NEW"
+        )
         item = {
+            "chat_id": chat_id,
+            "seq": int(self.from_item(response["Attributes"])["log_seq"]),
             "date_time": dateTimeStr,
             "sender_id": sender_id,
             "command": command
         }
-        try:
-            self.table.update_item(
-                Key={"chat_id": chat_id},
-                UpdateExpression="SET logs = list_append(:i, logs)",
-                ExpressionAttributeValues={
-                    ':i': [item]
-                }
-            )
-        except Exception as e:
-            # create logs list
-            self.table.update_item(
-                Key={"chat_id": chat_id},
-                AttributeUpdates={
-                    'logs': {
-                        'Value': [item],
-                        'Action': 'PUT'
-                    }
-                }
-            )
+        if transaction is not None:
+            item["transaction"] = transaction
+        self.client.put_item(TableName=table_name_logs, Item=self.to_item(item))
+        return item
 
     def remove_log(self, chat_id: int, reverse_index: int):
-        index = reverse_index
-        self.table.update_item(
-            Key={"chat_id": chat_id},
-            UpdateExpression="REMOVE logs[{}]".format(index)
+        log = self.load_log(chat_id, reverse_index)
+        if log:
+            self.client.delete_item(TableName=table_name_logs, Key=self.to_item({"chat_id": chat_id, "seq": log["seq"]}))
+
+    def remove_logs(self, chat_id: int, seqs: list):
+        deletes = [{"DeleteRequest": {"Key": self.to_item({"chat_id": chat_id, "seq": seq})}} for seq in seqs]
+        while deletes:
+            batch, deletes = deletes[:BATCH_WRITE_LIMIT], deletes[BATCH_WRITE_LIMIT:]
+            response = self.client.batch_write_item(RequestItems={table_name_logs: batch})
+            # throttled deletes are retried with the next batch
+            deletes.extend(response.get("UnprocessedItems", {}).get(table_name_logs, []))
+
+    # summaries only, compressed data stays in the table
+    def load_log_segments(self, chat_id: int) -> list:
+        kwargs = {
+            "TableName": table_name_archive,
+            "KeyConditionExpression": "chat_id = :c",
+            "ExpressionAttributeValues": self.to_item({":c": chat_id}),
+            "ProjectionExpression": "summary",
+        }
+        # segments are rare, json and LogCompactor are imported on first use
+        import json
+        from LogCompactor import decimal_default
+
+        summaries = list()
+        while True:
+            response = self.client.query(**kwargs)
+            summaries.extend(self.from_item(item)["summary"] for item in response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+        return json.loads(json.dumps(summaries, default=decimal_default))
+
+    def load_log_segment_data(self, chat_id: int, first_seq: int) -> bytes:
+        response = self.client.get_item(
+            TableName=table_name_archive,
+            Key=self.to_item({"chat_id": chat_id, "first_seq": first_seq}),
+            ProjectionExpression="#data",
+            ExpressionAttributeNames={"#data": "data"}
         )
+        return self.from_item(response["Item"])["data"].value
+
+    def save_log_segment(self, chat_id: int, summary: dict, data: bytes):
+        import json
+        from LogCompactor import decimal_default
+
+        self.client.put_item(TableName=table_name_archive, Item=self.to_item({
+            "chat_id": chat_id,
+            "first_seq": summary["first_seq"],
+            "summary": json.loads(json.dumps(summary, default=decimal_default), parse_float=Decimal),
+            "data": data
+        }))
 
     def save_transfer(self, code, chat_id, date_time) -> None:
-        date_time_str = date_time.strftime("%Y-%m-%d %H:%M:%S")
+        date_time_str = date_time.strftime(LOG_DATE_FORMAT)
         item = {
             "code": code,
             "chat_id": chat_id,
             "date_time": date_time_str,
             "used": False
         }
-        self.table_trans.put_item(Item=item)
+        self.client.put_item(TableName=table_name_trans, Item=self.to_item(item))
 
     def load_transfer(self, code) -> dict:
-        response = self.table_trans.get_item(
-            Key={"code": code}
+        response = self.client.get_item(
+            TableName=table_name_trans,
+            Key=self.to_item({"code": code})
         )
         # change date_time string to python datetime
-        item = response.get("Item", {})
+        item = self.from_item(response.get("Item", {}))
         if item and "date_time" in item:
-            item["date_time"] = datetime.datetime.strptime(item["date_time"], "%Y-%m-%d %H:%M:%S")
+            item["date_time"] = datetime.datetime.strptime(item["date_time"], LOG_DATE_FORMAT)
         return item
 
+    # code, destination and source in one TransactWriteItems
+    def apply_state_transfer(self, code, chat_id: int, deltas: dict, source_chat_id: int, source_deltas: dict) -> bool:
+        items = [{
+            "Update": {
+                "TableName": table_name_trans,
+                "Key": self.to_item({"code": code}),
+                "UpdateExpression": "SET used = :true",
+                "ConditionExpression": "used = :false",
+                "ExpressionAttributeValues": self.to_item({":true": True, ":false": False}),
+            }
+        }]
+        if deltas:
+            items.append({"Update": self.balance_deltas_update(chat_id, deltas)})
+        if source_deltas:
+            items.append({"Update": self.balance_deltas_update(int(source_chat_id), source_deltas)})
+
+        try:
+            self.client.transact_write_items(TransactItems=items)
+        except self.client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons", [])
+            # first item is the transfer code
+            if reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+                return False
+            raise
+        return True
+
+    # undo markers and balances in one TransactWriteItems (at most 100 items, see DebitHandler.MAX_UNDO)
+    def apply_undo(self, chat_id: int, seqs: list, deltas: dict) -> bool:
+        items = [{
+            "Update": {
+                "TableName": table_name_logs,
+                "Key": self.to_item({"chat_id": int(chat_id), "seq": int(seq)}),
+                "UpdateExpression": "SET undone = :true",
+                "ConditionExpression": "attribute_exists(seq) AND attribute_not_exists(undone)",
+                "ExpressionAttributeValues": self.to_item({":true": True}),
+            }
+        } for seq in seqs]
+        if deltas:
+            items.append({"Update": self.balance_deltas_update(chat_id, deltas)})
+
+        try:
+            self.client.transact_write_items(TransactItems=items)
+        except self.client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons", [])
+            # the first len(seqs) items are the markers
+            if any(i.get("Code") == "ConditionalCheckFailed" for i in reasons[:len(seqs)]):
+                return False
+            raise
+        return True
+
+    # conditional ADD, the counter only grows while it is below limit
+    def increment_rate_counter(self, key: str, limit: int, expires_at: int) -> bool:
+        if table_name_rate is None:
+            raise NotImplementedError("RATE_LIMIT_TABLE_NAME is not set")
+
+        try:
+            self.client.update_item(
+                TableName=table_name_rate,
+                Key=self.to_item({"key": key}),
+                UpdateExpression="ADD #count :one SET expires_at = :expires",
+                ConditionExpression="attribute_not_exists(#count) OR #count < :limit",
+                ExpressionAttributeNames={"#count": "count"},
+                ExpressionAttributeValues=self.to_item({":one": 1, ":limit": limit, ":expires": expires_at})
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    # conditional put, fails if another delivery of the update already wrote the marker
+    def mark_update(self, key: str, expires_at: int) -> bool:
+        if table_name_updates is None:
+            raise NotImplementedError("UPDATES_TABLE_NAME is not set")
+
+        try:
+            self.client.put_item(
+                TableName=table_name_updates,
+                Item=self.to_item({"key": key, "expires_at": expires_at}),
+                ConditionExpression="attribute_not_exists(#key)",
+                ExpressionAttributeNames={"#key": "key"}
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
     def get_id_by_name(self, chat_name) -> str:
         return 0
 
@@ -181,8 +573,9 @@ class DynamoDBDataClass(AbstractDatabase):
                 self.convert_decimal_to_float(low_level_data[k])
         
     def covert_float_to_decimal(self, python_data):
+        import json
         return json.loads(json.dumps(python_data), parse_float=Decimal)
 
 if __name__ == "__main__":
     data = DynamoDBDataClass()
-    print(data.load_log_after_time(1217535067, "2025-10-01 00:00:00"))
\ No newline at end of file
+    print(data.load_log_after_time(1217535067, "2025-10-01 00:00:00"))
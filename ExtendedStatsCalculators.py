@@ -1,31 +1,27 @@
-from StatsCalculator import StatCalculator
-from typing import Dict, List, Any
+from StatsCalculator import StatCalculator, LogEvent
+from typing import Dict, Any, Optional
 from collections import defaultdict
-import datetime
+from Util.money import from_cents
 
 class AverageTransactionCalculator(StatCalculator):
     """Calculates average transaction size for each user"""
     
-    def calculate(self, logs: List[Dict], state: Dict[str, float]) -> Dict[str, Any]:
-        user_totals = defaultdict(float)
-        user_counts = defaultdict(int)
-        
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] == "t":
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                don = command[1].capitalize()
-                amounts = command[3::2]
-                
-                for amount in amounts:
-                    user_totals[don] += float(amount)
-                    user_counts[don] += 1
-        
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.user_totals = defaultdict(float)
+        self.user_counts = defaultdict(int)
+
+    def update(self, event: LogEvent):
+        record = event.transaction
+        if record is not None and record["type"] == "t":
+            # average over the single amounts, one per recipient
+            self.user_totals[record["donor"]] += from_cents(record["total"])
+            self.user_counts[record["donor"]] += len(record["recipients"])
+
+    def finalize(self) -> Dict[str, Any]:
         averages = {}
-        for user in user_totals:
-            if user_counts[user] > 0:
-                averages[user] = user_totals[user] / user_counts[user]
+        for user in self.user_totals:
+            if self.user_counts[user] > 0:
+                averages[user] = self.user_totals[user] / self.user_counts[user]
         
         return averages
     
@@ -43,27 +39,29 @@ class AverageTransactionCalculator(StatCalculator):
 class BiggestSpenderCalculator(StatCalculator):
     """Finds who made the largest single transaction"""
     
-    def calculate(self, logs: List[Dict], state: Dict[str, float]) -> Dict[str, Any]:
-        biggest_transaction = {"user": None, "amount": 0, "timestamp": None}
-        
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] == "t":
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                don = command[1].capitalize()
-                amounts = command[3::2]
-                
-                total_amount = sum(float(amount) for amount in amounts)
-                if total_amount > biggest_transaction["amount"]:
-                    biggest_transaction = {
-                        "user": don,
-                        "amount": total_amount,
-                        "timestamp": log.get("timestamp", "Unknown")
-                    }
-        
-        return biggest_transaction
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.biggest_transaction = {"user": None, "amount": 0, "timestamp": None}
+
+    def update(self, event: LogEvent):
+        record = event.transaction
+        if record is not None and record["type"] == "t":
+            total_amount = from_cents(record["total"])
+            if total_amount > self.biggest_transaction["amount"]:
+                self.biggest_transaction = {
+                    "user": record["donor"],
+                    "amount": total_amount,
+                    "timestamp": event.log.get("timestamp", "Unknown")
+                }
+
+    def finalize(self) -> Dict[str, Any]:
+        return self.biggest_transaction
     
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        return other if other["amount"] > result["amount"] else result
+
     def get_display_name(self) -> str:
         return "Biggest Spender"
     
@@ -76,33 +74,44 @@ class BiggestSpenderCalculator(StatCalculator):
 class ActivityFrequencyCalculator(StatCalculator):
     """Calculates how active each user is (commands per day/week)"""
     
-    def calculate(self, logs: List[Dict], state: Dict[str, float]) -> Dict[str, Any]:
-        user_activity = defaultdict(int)
-        
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.user_activity = defaultdict(int)
+
+    def update(self, event: LogEvent):
         # Count all command usage per user
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            if len(command_parts) > 1:
-                user = command_parts[1].capitalize()
-                user_activity[user] += 1
-        
+        if event.user is not None:
+            self.user_activity[event.user] += 1
+
+    def finalize(self) -> Dict[str, Any]:
         # Convert to activity level description
         activity_levels = {}
-        for user, count in user_activity.items():
-            if count >= 50:
-                level = "Very Active"
-            elif count >= 20:
-                level = "Active"
-            elif count >= 10:
-                level = "Moderate"
-            elif count >= 5:
-                level = "Low"
-            else:
-                level = "Minimal"
-            
-            activity_levels[user] = {"count": count, "level": level}
+        for user, count in self.user_activity.items():
+            activity_levels[user] = {"count": count, "level": self.activity_level(count)}
         
         return activity_levels
+
+    @staticmethod
+    def activity_level(count: int) -> str:
+        if count >= 50:
+            return "Very Active"
+        elif count >= 20:
+            return "Active"
+        elif count >= 10:
+            return "Moderate"
+        elif count >= 5:
+            return "Low"
+        else:
+            return "Minimal"
+
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        combined = {user: dict(data) for user, data in result.items()}
+        for user, data in other.items():
+            count = combined.get(user, {"count": 0})["count"] + data["count"]
+            combined[user] = {"count": count, "level": self.activity_level(count)}
+        return combined
     
     def get_display_name(self) -> str:
         return "User Activity Levels"
@@ -119,8 +128,15 @@ class ActivityFrequencyCalculator(StatCalculator):
 class DebtorCreditorCalculator(StatCalculator):
     """Identifies the biggest debtors and creditors"""
     
-    def calculate(self, logs: List[Dict], state: Dict[str, float]) -> Dict[str, Any]:
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.state = state
+
+    def update(self, event: LogEvent):
+        pass
+
+    def finalize(self) -> Dict[str, Any]:
         # Current state already contains the net balance
+        state = self.state
         debtors = {user: balance for user, balance in state.items() if balance < 0}
         creditors = {user: balance for user, balance in state.items() if balance > 0}
         
@@ -135,6 +151,10 @@ class DebtorCreditorCalculator(StatCalculator):
             "debt_count": len(debtors),
             "credit_count": len(creditors)
         }
+
+    def requires_logs(self) -> bool:
+        # balances only, logs aren't loaded for it
+        return False
     
     def get_display_name(self) -> str:
         return "Debt & Credit Analysis"
@@ -0,0 +1,106 @@
+import importlib
+import json
+from decimal import Decimal
+
+from AbstractDatabase import AbstractDatabase
+
+SEGMENT_SIZE = 1000 # logs per archive segment
+HOT_LOGS = 500 # newest logs are never archived
+COMPACT_EVERY_LOGS = SEGMENT_SIZE # how often main triggers compaction (by log seq)
+
+# modules with compress() and decompress(), imported when a segment is written or read, not at cold start
+CODECS = ("zlib", "lzma")
+
+def decimal_default(x):
+    if isinstance(x, Decimal):
+        return int(x) if x == int(x) else float(x)
+    raise TypeError(f"Object of type {type(x).__name__} is not JSON serializable")
+
+class LogCompactor:
+    '''
+    Moves old logs of a chat into compressed archive segments.
+
+    Each segment has a small summary next to the compressed data:
+        first_seq, last_seq, from, to - range of archived logs
+        count - number of logs in the segment
+        stats - partial results of stat calculators that can combine results,
+                so stats can be served without decompressing the segment
+    '''
+    def __init__(self, data_instance: AbstractDatabase, stats_manager=None,
+                 segment_size=SEGMENT_SIZE, hot_logs=HOT_LOGS, codec="zlib"):
+        self.data_instance = data_instance
+        self.stats_manager = stats_manager
+        self.segment_size = segment_size
+        self.hot_logs = hot_logs
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}")
+        self.codec = codec
+
+    def compact(self, chat_id) -> int:
+        '''
+        Archives full segments of logs older than hot_logs, returns number of created segments.
+        A segment and the removal of its logs are written in one atomic(). Backends without transactions
+        can be left with archived logs that weren't removed, those are removed by the next compaction.
+        '''
+        logs = self.data_instance.load_logs(chat_id, False)
+        # segments are the oldest logs, anything up to the last archived seq is already in one
+        last_archived = max((int(i["last_seq"]) for i in self.data_instance.load_log_segments(chat_id)), default=0)
+        archived = [log["seq"] for log in logs if log["seq"] <= last_archived]
+        if archived:
+            self.data_instance.remove_logs(chat_id, archived)
+            logs = logs[:len(logs) - len(archived)]
+
+        cold = list(reversed(logs[self.hot_logs:])) # oldest first
+        if len(cold) < self.segment_size:
+            return 0
+
+        segments = 0
+        while len(cold) >= self.segment_size:
+            chunk, cold = cold[:self.segment_size], cold[self.segment_size:]
+            summary = self.summarize(chunk)
+            with self.data_instance.atomic():
+                self.data_instance.save_log_segment(chat_id, summary, self.compress(chunk))
+                self.data_instance.remove_logs(chat_id, [log["seq"] for log in chunk])
+            segments += 1
+
+        return segments
+
+    def summarize(self, chunk: list) -> dict:
+        summary = {
+            "first_seq": int(chunk[0]["seq"]),
+            "last_seq": int(chunk[-1]["seq"]),
+            "from": chunk[0]["date_time"],
+            "to": chunk[-1]["date_time"],
+            "count": len(chunk),
+            "codec": self.codec,
+            "stats": dict(),
+        }
+        if self.stats_manager is not None:
+            names = [name for name, calculator in self.stats_manager.calculators.items()
+                     if calculator.can_combine() and not calculator.requires_state()]
+            results = self.stats_manager.run_calculators(names, list(reversed(chunk)), None)
+            for name in names:
+                if isinstance(results[name], Exception):
+                    raise results[name]
+                summary["stats"][name] = results[name]
+        return summary
+
+    def compress(self, chunk: list) -> bytes:
+        compress = importlib.import_module(self.codec).compress
+        return compress(json.dumps(chunk, default=decimal_default).encode("utf-8"))
+
+    @staticmethod
+    def decompress(summary: dict, data: bytes) -> list:
+        decompress = importlib.import_module(summary.get("codec", "zlib")).decompress
+        return json.loads(decompress(bytes(data)).decode("utf-8"))
+
+    def load_archived_logs(self, chat_id, summaries: list = None) -> list:
+        '''Decompresses all segments of a chat, newest log first (same order as load_logs)'''
+        if summaries is None:
+            summaries = self.data_instance.load_log_segments(chat_id)
+
+        logs = list()
+        for summary in sorted(summaries, key=lambda x: x["first_seq"], reverse=True):
+            data = self.data_instance.load_log_segment_data(chat_id, summary["first_seq"])
+            logs.extend(reversed(self.decompress(summary, data)))
+        return logs
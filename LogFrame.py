@@ -0,0 +1,184 @@
+'''
+Columnar view of a chat history for the stats of big chats, built once per request from the logs (newest first).
+
+    command       int32   index into commands (command codes)
+    kind          int8    index into TRANSACTION_COMMANDS, -1 for other commands and undone transactions
+    donor         int32   index into names, -1 if kind is -1
+    total         int64   cents
+    transferred   int64   sum of |amount| in cents (every amount of t)
+    rec_offsets   int64   recipients of log i are rec_ids[rec_offsets[i]:rec_offsets[i + 1]] (CSR)
+    rec_ids       int32   index into names
+
+The vectorized stats below give the same results as the calculators they stand in for (VECTORIZED),
+which stay the reference: Util/logframe_check.py compares the two. StatsCalculatorManager.run_calculators
+uses them for histories of at least VECTORIZED_MIN_LOGS logs. NumPy is optional, without it
+available() is False and the calculators are used.
+'''
+try:
+    import numpy as np
+except ImportError:
+    # optional, stats fall back to the calculators
+    np = None
+
+from DebitHandler import TRANSACTION_COMMANDS, transaction_record
+from Util.money import from_cents
+
+def available() -> bool:
+    return np is not None
+
+class LogFrame:
+    def __init__(self, logs: list, names: list, commands: list, columns: dict):
+        self.logs = logs
+        self.names = names # donor and recipient ids -> name
+        self.commands = commands # command ids -> command code
+        for column, values in columns.items():
+            setattr(self, column, values)
+
+    def __len__(self):
+        return len(self.kind)
+
+    @classmethod
+    def from_logs(cls, logs: list) -> "LogFrame":
+        '''Goes through the logs once, every other operation works on the arrays'''
+        names = dict()
+        commands = dict()
+        command = list()
+        kind = list()
+        donor = list()
+        total = list()
+        transferred = list()
+        rec_counts = list()
+        rec_ids = list()
+
+        for log in logs:
+            command.append(commands.setdefault(log.get("command", "").split(" ", 1)[0], len(commands)))
+            record = transaction_record(log)
+            if record is None:
+                kind.append(-1)
+                donor.append(-1)
+                total.append(0)
+                transferred.append(0)
+                rec_counts.append(0)
+                continue
+
+            kind.append(TRANSACTION_COMMANDS.index(record["type"]))
+            donor.append(names.setdefault(record["donor"], len(names)))
+            total.append(record["total"])
+            transferred.append(sum(abs(i) for i in record["amounts"]))
+            recipients = record["recipients"] or ()
+            rec_counts.append(len(recipients))
+            rec_ids.extend(names.setdefault(i, len(names)) for i in recipients)
+
+        columns = {
+            "command": np.array(command, dtype=np.int32),
+            "kind": np.array(kind, dtype=np.int8),
+            "donor": np.array(donor, dtype=np.int32),
+            "total": np.array(total, dtype=np.int64),
+            "transferred": np.array(transferred, dtype=np.int64),
+            "rec_offsets": offsets(rec_counts),
+            "rec_ids": np.array(rec_ids, dtype=np.int32),
+        }
+        return cls(logs, list(names), list(commands), columns)
+
+    def head(self, count: int) -> "LogFrame":
+        '''The newest count logs, the arrays are views of this frame's'''
+        rec_end = self.rec_offsets[count]
+        return LogFrame(self.logs[:count], self.names, self.commands, {
+            "command": self.command[:count],
+            "kind": self.kind[:count],
+            "donor": self.donor[:count],
+            "total": self.total[:count],
+            "transferred": self.transferred[:count],
+            "rec_offsets": self.rec_offsets[:count + 1],
+            "rec_ids": self.rec_ids[:rec_end],
+        })
+
+    def rec_counts(self):
+        return np.diff(self.rec_offsets)
+
+def offsets(counts: list):
+    result = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=result[1:])
+    return result
+
+def first_seen(ids, size: int):
+    '''ids that occur in ids, in the order of their first occurrence (dicts of the calculators keep that order)'''
+    first = np.full(size, len(ids), dtype=np.int64)
+    np.minimum.at(first, ids, np.arange(len(ids)))
+    present = np.flatnonzero(first < len(ids))
+    return present[np.argsort(first[present], kind="stable")]
+
+# stats, same result as the calculator's calculate()
+
+def volume(frame: LogFrame) -> dict:
+    rows = frame.kind == 0
+    donors = frame.donor[rows]
+    # float sums of int cents are exact below 2**53
+    sums = np.bincount(donors, weights=frame.total[rows], minlength=len(frame.names))
+    return {frame.names[i]: from_cents(int(sums[i])) for i in first_seen(donors, len(frame.names))}
+
+def count(frame: LogFrame) -> dict:
+    donors = frame.donor[frame.kind >= 0]
+    counts = np.bincount(donors, minlength=len(frame.names))
+    return {frame.names[i]: int(counts[i]) for i in first_seen(donors, len(frame.names))}
+
+def average(frame: LogFrame) -> dict:
+    # one amount per recipient
+    rows = frame.kind == 0
+    donors = frame.donor[rows]
+    sums = np.bincount(donors, weights=frame.total[rows], minlength=len(frame.names))
+    amounts = np.bincount(donors, weights=frame.rec_counts()[rows], minlength=len(frame.names))
+    return {frame.names[i]: from_cents(int(sums[i])) / int(amounts[i])
+            for i in first_seen(donors, len(frame.names)) if amounts[i] > 0}
+
+def biggest(frame: LogFrame) -> dict:
+    candidates = np.flatnonzero((frame.kind == 0) & (frame.total > 0))
+    if len(candidates) == 0:
+        return {"user": None, "amount": 0, "timestamp": None}
+    # argmax takes the first of equal amounts, the newest like the calculator
+    row = candidates[np.argmax(frame.total[candidates])]
+    return {
+        "user": frame.names[frame.donor[row]],
+        "amount": from_cents(int(frame.total[row])),
+        "timestamp": frame.logs[row].get("timestamp", "Unknown"),
+    }
+
+def total(frame: LogFrame) -> dict:
+    return {"total": from_cents(int(frame.transferred.sum()))}
+
+def interactions(frame: LogFrame) -> dict:
+    counts = frame.rec_counts()
+    rows = frame.kind == 0
+    # one entry per recipient of a t transaction
+    entries = np.repeat(rows, counts)
+    donors = np.repeat(frame.donor, counts)[entries]
+    recipients = frame.rec_ids[entries]
+    # donor -> recipient and recipient -> donor, in the order the calculator counts them
+    users = np.stack([donors, recipients], axis=1).ravel()
+    others = np.stack([recipients, donors], axis=1).ravel()
+
+    # sparse pair counts, only pairs that occur (names x names can be big)
+    size = len(frame.names)
+    pairs = users.astype(np.int64) * size + others
+    unique, first, pair_counts = np.unique(pairs, return_index=True, return_counts=True)
+
+    result = dict()
+    for i in np.argsort(first, kind="stable"):
+        user, other = divmod(int(unique[i]), size)
+        result.setdefault(frame.names[user], dict())[frame.names[other]] = int(pair_counts[i])
+    return result
+
+def commands(frame: LogFrame) -> dict:
+    counts = np.bincount(frame.command, minlength=len(frame.commands))
+    return {frame.commands[i]: int(counts[i]) for i in first_seen(frame.command, len(frame.commands))}
+
+# class of the calculator -> vectorized stat, custom calculators replacing them are run as they are
+VECTORIZED = {
+    "TransactionVolumeCalculator": volume,
+    "TransactionCountCalculator": count,
+    "AverageTransactionCalculator": average,
+    "BiggestSpenderCalculator": biggest,
+    "TotalAmountTransferredCalculator": total,
+    "UserInteractionCalculator": interactions,
+    "CommandUsageCalculator": commands,
+}
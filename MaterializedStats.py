@@ -0,0 +1,148 @@
+'''
+Per-chat aggregates of the built-in log statistics, stored next to the state and updated with every logged command,
+so /stat doesn't have to go through the whole history.
+
+An aggregate is a JSON-like dict of ints (amounts in cents):
+    volume        {donor: [cents, transactions]}      t transactions
+    count         {donor: transactions}               all transactions
+    interactions  {member: {member: count}}           t transactions, both directions
+    commands      {command code: count}
+    total         cents                               sum of |amount| of all transactions, every amount of t
+    average       {donor: [cents, amounts]}           t transactions, one amount per recipient
+    biggest       {"top": [[cents, donor], ...], "complete": bool}
+                  biggest t transactions, newest first among equal ones. complete is False once smaller ones were
+                  dropped, if undo then empties top the biggest transaction is unknown until a rebuild.
+    activity      {member: commands}                  commands with at least one argument, by first argument
+
+Results have the shape the matching calculator's calculate() returns, so its format_result() can display them.
+Undone transactions are subtracted (commands and activity still count them, like the calculators do).
+'''
+from Util.money import from_cents
+
+AGGREGATE_VERSION = 1
+# stat type -> class of the built-in calculator the aggregate stands in for
+MATERIALIZED_STATS = {
+    "volume": "TransactionVolumeCalculator",
+    "count": "TransactionCountCalculator",
+    "interactions": "UserInteractionCalculator",
+    "commands": "CommandUsageCalculator",
+    "total": "TotalAmountTransferredCalculator",
+    "average": "AverageTransactionCalculator",
+    "biggest": "BiggestSpenderCalculator",
+    "activity": "ActivityFrequencyCalculator",
+}
+BIGGEST_KEPT = 10 # transactions kept for biggest, more of them survive undo
+
+def empty() -> dict:
+    return {
+        "version": AGGREGATE_VERSION,
+        "volume": dict(),
+        "count": dict(),
+        "interactions": dict(),
+        "commands": dict(),
+        "total": 0,
+        "average": dict(),
+        "biggest": {"top": list(), "complete": True},
+        "activity": dict(),
+    }
+
+def usable(aggregate) -> bool:
+    '''False for chats without an aggregate (not backfilled yet) or with one of an older version'''
+    return aggregate is not None and aggregate.get("version") == AGGREGATE_VERSION
+
+def add_count(counts: dict, key, value):
+    counts[key] = counts.get(key, 0) + value
+    if counts[key] == 0:
+        del counts[key]
+
+def add_pair(pairs: dict, key, cents, count):
+    cents_total, count_total = pairs.get(key, (0, 0))
+    if count_total + count == 0:
+        pairs.pop(key, None)
+    else:
+        pairs[key] = [cents_total + cents, count_total + count]
+
+def log_counts(command: str) -> dict:
+    '''Counters a logged command adds 1 to, {field: {key: 1}}'''
+    parts = command.split(" ", 2)
+    counts = {"commands": {parts[0]: 1}}
+    if len(parts) > 1:
+        counts["activity"] = {parts[1].capitalize(): 1}
+    return counts
+
+def add_counts(aggregate: dict, counts: dict):
+    for field, values in counts.items():
+        for key, value in values.items():
+            add_count(aggregate[field], key, value)
+
+def add_log(aggregate: dict, command: str, record: dict = None):
+    '''
+    Adds a logged command to the aggregate.
+    record: DebitHandler.transaction_record of the log, None if it isn't a transaction
+    '''
+    add_counts(aggregate, log_counts(command))
+    if record is not None:
+        add_transaction(aggregate, record, 1)
+
+def add_transaction(aggregate: dict, record: dict, sign: int):
+    '''Adds (sign 1) or subtracts (sign -1, undo) a transaction record'''
+    donor = record["donor"]
+    add_count(aggregate["count"], donor, sign)
+    aggregate["total"] += sign * sum(abs(i) for i in record["amounts"])
+    if record["type"] != "t":
+        return
+
+    add_pair(aggregate["volume"], donor, sign * record["total"], sign)
+    add_pair(aggregate["average"], donor, sign * record["total"], sign * len(record["recipients"]))
+    interactions = aggregate["interactions"]
+    for rec in record["recipients"]:
+        add_count(interactions.setdefault(donor, dict()), rec, sign)
+        add_count(interactions.setdefault(rec, dict()), donor, sign)
+        for member in {donor, rec}:
+            if not interactions[member]:
+                del interactions[member]
+
+    biggest = aggregate["biggest"]
+    entry = [record["total"], donor]
+    if sign > 0 and record["total"] > 0:
+        # newest goes before older ones of the same amount
+        position = next((i for i, top in enumerate(biggest["top"]) if top[0] <= record["total"]), len(biggest["top"]))
+        biggest["top"].insert(position, entry)
+        if len(biggest["top"]) > BIGGEST_KEPT:
+            biggest["top"].pop()
+            biggest["complete"] = False
+    elif sign < 0 and entry in biggest["top"]:
+        biggest["top"].remove(entry)
+
+def result(aggregate: dict, stat_type: str):
+    '''Result of stat_type in the shape its calculator returns, None if the aggregate can't tell'''
+    if stat_type == "volume":
+        return {user: from_cents(cents) for user, (cents, _) in aggregate["volume"].items()}
+    elif stat_type == "count":
+        return dict(aggregate["count"])
+    elif stat_type == "interactions":
+        return {user: dict(interactions) for user, interactions in aggregate["interactions"].items()}
+    elif stat_type == "commands":
+        return dict(aggregate["commands"])
+    elif stat_type == "total":
+        return {"total": from_cents(aggregate["total"])}
+    elif stat_type == "average":
+        return {user: from_cents(cents) / count for user, (cents, count) in aggregate["average"].items() if count > 0}
+    elif stat_type == "biggest":
+        top = aggregate["biggest"]["top"]
+        if not top:
+            return {"user": None, "amount": 0, "timestamp": None} if aggregate["biggest"]["complete"] else None
+        # logs have no "timestamp", the calculator shows "Unknown" as well
+        return {"user": top[0][1], "amount": from_cents(top[0][0]), "timestamp": "Unknown"}
+    elif stat_type == "activity":
+        # imported here, the stats modules are loaded on the first /stat* command
+        from ExtendedStatsCalculators import ActivityFrequencyCalculator
+        return {user: {"count": count, "level": ActivityFrequencyCalculator.activity_level(count)}
+                for user, count in aggregate["activity"].items()}
+    return None
+
+def differences(aggregate: dict, other: dict) -> list:
+    '''Stats whose results differ between two aggregates'''
+    if not usable(aggregate):
+        return list(MATERIALIZED_STATS)
+    return [i for i in MATERIALIZED_STATS if result(aggregate, i) != result(other, i)]
@@ -0,0 +1,182 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+
+from DebitHandler import STATE_SEPARATOR
+from TelegramClient import TelegramClient
+
+# Telegram limits: about 30 messages per second overall and 1 per second in a chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+REPORT_EVERY = 100 # sent messages between metric reports
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        '''Seconds until a token is available, 0 if one is available now'''
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        '''No tokens for seconds, used after a 429'''
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class OutboundQueue:
+    '''
+    Sends replies from a background thread within a global and a per-chat token bucket.
+
+    Chats are served round robin, a burst in one chat doesn't delay replies in others.
+    A full-state reply (type 1 in DebitHandler.succ_respond) queued right after another one
+    for the same chat is merged into it: success messages are listed together and only the newest state is sent.
+    '''
+    def __init__(self, client: TelegramClient, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 report=None, clock=time.monotonic):
+        self.client = client
+        self.chat_rate = chat_rate
+        self.report = report # called with metrics() every REPORT_EVERY sent messages
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock)
+        self.chat_buckets = dict() # chat_id -> TokenBucket, dropped when the chat is idle
+        self.pending = OrderedDict() # chat_id -> deque of replies, oldest first
+        self.condition = threading.Condition()
+        self.metrics_data = {"sent": 0, "coalesced": 0, "throttled": 0, "failed": 0,
+                             "max_depth": 0, "delay_total": 0.0, "delay_max": 0.0}
+
+    def depth(self) -> int:
+        return sum(len(i) for i in self.pending.values())
+
+    def put(self, chat_id, text, message_id, parse_mode="HTML"):
+        header, state = text, None
+        if STATE_SEPARATOR in text:
+            header, state = text.split(STATE_SEPARATOR, 1)
+
+        with self.condition:
+            replies = self.pending.setdefault(chat_id, deque())
+            last = replies[-1] if replies else None
+            if state is not None and last is not None and last["state"] is not None and last["parse_mode"] == parse_mode:
+                last["headers"].append(header)
+                last["state"] = state
+                last["message_id"] = message_id
+                self.metrics_data["coalesced"] += 1
+            else:
+                replies.append({
+                    "chat_id": chat_id,
+                    "headers": [header],
+                    "state": state,
+                    "message_id": message_id,
+                    "parse_mode": parse_mode,
+                    "enqueued": self.clock(),
+                })
+            self.metrics_data["max_depth"] = max(self.metrics_data["max_depth"], self.depth())
+            self.condition.notify()
+
+    @staticmethod
+    def render(reply) -> str:
+        # "Transaction successful (x3)" instead of the same line three times
+        lines = list()
+        for header in reply["headers"]:
+            if lines and lines[-1][0] == header:
+                lines[-1][1] += 1
+            else:
+                lines.append([header, 1])
+        text = "\n".join(header if count == 1 else f"{header} (x{count})" for header, count in lines)
+
+        if reply["state"] is not None:
+            text += STATE_SEPARATOR + reply["state"]
+        return text
+
+    def next_reply(self):
+        '''Takes the next reply that can be sent now, or returns (None, seconds to wait)'''
+        wait = self.global_bucket.wait_time()
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for chat_id in list(self.pending):
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, 1, self.clock))
+            chat_wait = bucket.wait_time()
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+
+            reply = self.pending[chat_id].popleft()
+            # served chat goes to the end of the round
+            if self.pending[chat_id]:
+                self.pending.move_to_end(chat_id)
+            else:
+                del self.pending[chat_id]
+            bucket.take()
+            self.global_bucket.take()
+            return reply, 0
+
+        # buckets of chats without pending replies are only needed until they refill
+        for chat_id in [i for i, bucket in self.chat_buckets.items() if i not in self.pending and bucket.wait_time() == 0]:
+            del self.chat_buckets[chat_id]
+        return None, wait
+
+    def send(self, reply):
+        params = {
+            "chat_id": reply["chat_id"],
+            "text": self.render(reply),
+            "parse_mode": reply["parse_mode"],
+            "reply_to_message_id": reply["message_id"],
+        }
+        try:
+            # flood waits are handled here, the sender thread never sleeps in the client
+            response = self.client.call("sendMessage", params, max_retry_after=0)
+        except Exception:
+            self.metrics_data["failed"] += 1
+            print("ERROR:", traceback.format_exc())
+            return
+
+        if response.status_code == 429:
+            with self.condition:
+                self.metrics_data["throttled"] += 1
+                self.chat_buckets.setdefault(reply["chat_id"], TokenBucket(self.chat_rate, 1, self.clock)) \
+                    .pause(self.client.retry_after(response))
+                # back to the front, still ahead of newer replies of the chat
+                self.pending.setdefault(reply["chat_id"], deque()).appendleft(reply)
+            return
+
+        delay = self.clock() - reply["enqueued"]
+        self.metrics_data["sent"] += 1
+        self.metrics_data["delay_total"] += delay
+        self.metrics_data["delay_max"] = max(self.metrics_data["delay_max"], delay)
+        if self.report is not None and self.metrics_data["sent"] % REPORT_EVERY == 0:
+            self.report(self.metrics())
+
+    def metrics(self) -> dict:
+        '''Queue depth and delay between put and send (seconds)'''
+        with self.condition:
+            metrics = dict(self.metrics_data, depth=self.depth())
+        metrics["delay_avg"] = metrics["delay_total"] / metrics["sent"] if metrics["sent"] else 0.0
+        return metrics
+
+    def run(self):
+        while True:
+            with self.condition:
+                reply, wait = self.next_reply()
+                while reply is None:
+                    self.condition.wait(timeout=wait)
+                    reply, wait = self.next_reply()
+            self.send(reply)
+
+    def start(self):
+        threading.Thread(target=self.run, name="outbound-queue", daemon=True).start()
+        return self
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from AbstractDatabase import AbstractDatabase
+
+MAX_KEYS = 10000 # tracked chats and senders, least recently used ones are dropped
+
+class SlidingWindowLimiter:
+    '''
+    Allows at most limit events per key in any window_seconds long window, without touching storage.
+
+    Every key keeps the times of its last limit accepted events, an event is rejected while the oldest
+    of them is younger than the window. Rejected events are not recorded, so spam costs one lookup.
+
+    With a store (AbstractDatabase implementing increment_rate_counter) accepted events are also counted
+    in fixed windows shared by all instances, so several Lambdas together stay within the same limit.
+    '''
+    def __init__(self, limit: int, window_seconds: float, max_keys=MAX_KEYS, store: AbstractDatabase = None, clock=time.time):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self.store = store
+        self.clock = clock
+        self.events = OrderedDict() # key -> deque of accepted event times, oldest first
+        self.lock = threading.Lock()
+
+    def is_full(self, key, now) -> bool:
+        events = self.events.get(key)
+        return events is not None and len(events) == self.limit and now - events[0] < self.window_seconds
+
+    def allow_shared(self, keys, now) -> bool:
+        window = int(now // self.window_seconds)
+        expires_at = int((window + 2) * self.window_seconds)
+        return all(
+            self.store.increment_rate_counter(f"{key}:{window}", self.limit, expires_at)
+            for key in keys
+        )
+
+    def allow(self, *keys) -> bool:
+        '''Checks all keys (e.g. chat and sender), the event is recorded only if every key allows it'''
+        now = self.clock()
+        # checked and recorded under one lock, concurrent events of a key can't both take its last slot
+        with self.lock:
+            if any(self.is_full(key, now) for key in keys):
+                return False
+
+            if self.store is not None and not self.allow_shared(keys, now):
+                return False
+
+            for key in keys:
+                if key not in self.events:
+                    self.events[key] = deque(maxlen=self.limit)
+                self.events[key].append(now)
+                self.events.move_to_end(key)
+
+            while len(self.events) > self.max_keys:
+                self.events.popitem(last=False)
+            return True
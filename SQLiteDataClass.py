@@ -0,0 +1,348 @@
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from AbstractDatabase import AbstractDatabase, SNAPSHOT_PARTS, LOG_DATE_FORMAT, format_log_time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    log_seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS balances (
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    balance INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, name)
+);
+CREATE TABLE IF NOT EXISTS groups (
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    members TEXT NOT NULL,
+    PRIMARY KEY (chat_id, name)
+);
+CREATE TABLE IF NOT EXISTS chat_stats (
+    chat_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS logs (
+    chat_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    date_time TEXT NOT NULL,
+    sender_id INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+);
+CREATE INDEX IF NOT EXISTS logs_chat_time ON logs (chat_id, date_time);
+CREATE TABLE IF NOT EXISTS log_segments (
+    chat_id INTEGER NOT NULL,
+    first_seq INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (chat_id, first_seq)
+);
+CREATE TABLE IF NOT EXISTS transfers (
+    code TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    date_time TEXT NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS updates (
+    key TEXT PRIMARY KEY,
+    expires_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS updates_expires ON updates (expires_at);
+"""
+
+# PRAGMA user_version, each step upgrades a database from the previous version
+MIGRATIONS = [
+    # 1: balances in integer cents instead of REAL units
+    [
+        "CREATE TABLE balances_cents (chat_id INTEGER NOT NULL, name TEXT NOT NULL, "
+        "balance INTEGER NOT NULL, PRIMARY KEY (chat_id, name))",
+        "INSERT INTO balances_cents SELECT chat_id, name, CAST(round(balance * 100) AS INTEGER) FROM balances ORDER BY rowid",
+        "DROP TABLE balances",
+        "ALTER TABLE balances_cents RENAME TO balances",
+    ],
+    # 2: structured transaction record of a log, JSON
+    [
+        "ALTER TABLE logs ADD COLUMN txn TEXT",
+    ],
+    # 3: undo marker, 1 once the log was undone
+    [
+        "ALTER TABLE logs ADD COLUMN undone INTEGER NOT NULL DEFAULT 0",
+    ],
+]
+LOG_COLUMNS = "seq, date_time, sender_id, command, txn, undone"
+
+class SQLiteDataClass(AbstractDatabase):
+    '''
+    Local database for self-hosted deployments, one file shared by all chats.
+    Every thread gets its own connection, WAL mode lets readers run next to a writer.
+    '''
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("SQLITE_PATH", "debitbot.db")
+        self.local = threading.local()
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "connection"):
+            # isolation_level=None: transactions are started explicitly in atomic()
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=30, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.depth = 0
+        return self.local.connection
+
+    def migrate(self):
+        with self.atomic():
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            for i, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    self.connection.execute(statement)
+                self.connection.execute(f"PRAGMA user_version = {i}")
+
+    @contextlib.contextmanager
+    def atomic(self):
+        connection = self.connection
+        if self.local.depth > 0:
+            # already inside a transaction
+            self.local.depth += 1
+            try:
+                yield
+            finally:
+                self.local.depth -= 1
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        self.local.depth = 1
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self.local.depth = 0
+
+    def load_state(self, chat_id) -> dict:
+        rows = self.connection.execute(
+            "SELECT name, balance FROM balances WHERE chat_id = ? ORDER BY rowid", (chat_id,)
+        )
+        return {row["name"]: row["balance"] for row in rows}
+
+    def save_state(self, state, chat_id):
+        with self.atomic():
+            self.connection.execute("DELETE FROM balances WHERE chat_id = ?", (chat_id,))
+            self.connection.executemany(
+                "INSERT INTO balances (chat_id, name, balance) VALUES (?, ?, ?)",
+                [(chat_id, name, value) for name, value in state.items()]
+            )
+
+    def apply_balance_deltas(self, chat_id, deltas) -> dict:
+        new_balances = dict()
+        with self.atomic():
+            for name, delta in deltas.items():
+                row = self.connection.execute(
+                    "UPDATE balances SET balance = balance + ? WHERE chat_id = ? AND name = ? RETURNING balance",
+                    (delta, chat_id, name)
+                ).fetchone()
+                if row is None:
+                    raise KeyError(name)
+                new_balances[name] = row["balance"]
+        return new_balances
+
+    def load_groups(self, chat_id) -> dict:
+        rows = self.connection.execute(
+            "SELECT name, members FROM groups WHERE chat_id = ? ORDER BY rowid", (chat_id,)
+        )
+        return {row["name"]: json.loads(row["members"]) for row in rows}
+
+    def save_groups(self, groups, chat_id):
+        with self.atomic():
+            self.connection.execute("DELETE FROM groups WHERE chat_id = ?", (chat_id,))
+            self.connection.executemany(
+                "INSERT INTO groups (chat_id, name, members) VALUES (?, ?, ?)",
+                [(chat_id, name, json.dumps(members)) for name, members in groups.items()]
+            )
+
+    def load_stats(self, chat_id) -> dict:
+        row = self.connection.execute("SELECT data FROM chat_stats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def save_stats(self, stats, chat_id):
+        self.connection.execute(
+            "INSERT INTO chat_stats (chat_id, data) VALUES (?, ?) ON CONFLICT (chat_id) DO UPDATE SET data = excluded.data",
+            (chat_id, json.dumps(stats))
+        )
+
+    # read and write all parts in one transaction so they are consistent with each other
+    def load_chat_snapshot(self, chat_id, parts=SNAPSHOT_PARTS, log_index=0) -> dict:
+        with self.atomic():
+            return super().load_chat_snapshot(chat_id, parts, log_index)
+
+    def save_chat_snapshot(self, snapshot, chat_id):
+        with self.atomic():
+            super().save_chat_snapshot(snapshot, chat_id)
+
+    @staticmethod
+    def log_from_row(row) -> dict:
+        log = dict(row)
+        txn = log.pop("txn")
+        if txn is not None:
+            log["transaction"] = json.loads(txn)
+        if log.pop("undone"):
+            log["undone"] = True
+        return log
+
+    # get a single log, reverse_index 0 is the newest
+    def load_log(self, chat_id, reverse_index) -> dict:
+        row = self.connection.execute(
+            f"SELECT {LOG_COLUMNS} FROM logs WHERE chat_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?",
+            (chat_id, reverse_index)
+        ).fetchone()
+        return self.log_from_row(row) if row else dict()
+
+    # load newest reverse_index logs, all logs if reverse_index is False or negative
+    def load_logs(self, chat_id, reverse_index) -> list:
+        limit = reverse_index if reverse_index and reverse_index > 0 else -1
+        rows = self.connection.execute(
+            f"SELECT {LOG_COLUMNS} FROM logs WHERE chat_id = ? ORDER BY seq DESC LIMIT ?",
+            (chat_id, limit)
+        )
+        return [self.log_from_row(row) for row in rows]
+
+    def load_log_by_seq(self, chat_id, seq) -> dict:
+        row = self.connection.execute(
+            f"SELECT {LOG_COLUMNS} FROM logs WHERE chat_id = ? AND seq = ?", (chat_id, seq)
+        ).fetchone()
+        return self.log_from_row(row) if row else dict()
+
+    # get logs created in a time window, newest first (range scan on logs_chat_time)
+    def load_log_after_time(self, chat_id, time, end_time=None) -> list:
+        end_time = format_log_time(end_time) if end_time is not None else "9999"
+        rows = self.connection.execute(
+            f"SELECT {LOG_COLUMNS} FROM logs WHERE chat_id = ? AND date_time > ? AND date_time < ? "
+            "ORDER BY date_time DESC, seq DESC",
+            (chat_id, format_log_time(time), end_time)
+        )
+        return [self.log_from_row(row) for row in rows]
+
+    def save_log(self, chat_id, sender_id, command, transaction=None):
+        chat_id = int(chat_id)
+        item = {
+            "date_time": datetime.datetime.now().strftime(LOG_DATE_FORMAT),
+            "sender_id": int(sender_id),
+            "command": command
+        }
+        if transaction is not None:
+            item["transaction"] = transaction
+        with self.atomic():
+            self.connection.execute(
+                "INSERT INTO chats (chat_id, log_seq) VALUES (?, 1) "
+                "ON CONFLICT (chat_id) DO UPDATE SET log_seq = log_seq + 1",
+                (chat_id,)
+            )
+            item["seq"] = self.connection.execute(
+                "SELECT log_seq FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()["log_seq"]
+            self.connection.execute(
+                "INSERT INTO logs (chat_id, seq, date_time, sender_id, command, txn) VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, item["seq"], item["date_time"], item["sender_id"], item["command"],
+                 json.dumps(transaction) if transaction is not None else None)
+            )
+        return item
+
+    def remove_log(self, chat_id, reverse_index):
+        log = self.load_log(chat_id, reverse_index)
+        if log:
+            self.remove_logs(chat_id, [log["seq"]])
+
+    def remove_logs(self, chat_id, seqs: list):
+        with self.atomic():
+            self.connection.executemany(
+                "DELETE FROM logs WHERE chat_id = ? AND seq = ?", [(chat_id, seq) for seq in seqs]
+            )
+
+    def load_log_segments(self, chat_id) -> list:
+        rows = self.connection.execute(
+            "SELECT summary FROM log_segments WHERE chat_id = ? ORDER BY first_seq", (chat_id,)
+        )
+        return [json.loads(row["summary"]) for row in rows]
+
+    def load_log_segment_data(self, chat_id, first_seq) -> bytes:
+        row = self.connection.execute(
+            "SELECT data FROM log_segments WHERE chat_id = ? AND first_seq = ?", (chat_id, first_seq)
+        ).fetchone()
+        return row["data"]
+
+    def save_log_segment(self, chat_id, summary, data: bytes):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO log_segments (chat_id, first_seq, summary, data) VALUES (?, ?, ?, ?)",
+            (chat_id, summary["first_seq"], json.dumps(summary), data)
+        )
+
+    def save_transfer(self, code, chat_id, date_time) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO transfers (code, chat_id, date_time, used) VALUES (?, ?, ?, 0)",
+            (code, chat_id, date_time.strftime(LOG_DATE_FORMAT))
+        )
+
+    def load_transfer(self, code) -> dict:
+        row = self.connection.execute(
+            "SELECT code, chat_id, date_time, used FROM transfers WHERE code = ?", (code,)
+        ).fetchone()
+        if row is None:
+            return dict()
+        item = dict(row)
+        item["date_time"] = datetime.datetime.strptime(item["date_time"], LOG_DATE_FORMAT)
+        item["used"] = bool(item["used"])
+        return item
+
+    def apply_state_transfer(self, code, chat_id, deltas, source_chat_id, source_deltas) -> bool:
+        with self.atomic():
+            used = self.connection.execute(
+                "UPDATE transfers SET used = 1 WHERE code = ? AND used = 0", (code,)
+            ).rowcount
+            if used == 0:
+                return False
+            self.apply_balance_deltas(chat_id, deltas)
+            self.apply_balance_deltas(source_chat_id, source_deltas)
+        return True
+
+    def apply_undo(self, chat_id, seqs, deltas) -> bool:
+        with self.atomic():
+            placeholders = ", ".join("?" * len(seqs))
+            undone = self.connection.execute(
+                f"SELECT count(*) FROM logs WHERE chat_id = ? AND seq IN ({placeholders}) AND undone = 1",
+                (chat_id, *seqs)
+            ).fetchone()[0]
+            if undone:
+                return False
+            self.connection.execute(
+                f"UPDATE logs SET undone = 1 WHERE chat_id = ? AND seq IN ({placeholders})", (chat_id, *seqs)
+            )
+            self.apply_balance_deltas(chat_id, deltas)
+        return True
+
+    def mark_update(self, key, expires_at) -> bool:
+        now = int(time.time())
+        with self.atomic():
+            self.connection.execute("DELETE FROM updates WHERE expires_at < ?", (now,))
+            inserted = self.connection.execute(
+                "INSERT OR IGNORE INTO updates (key, expires_at) VALUES (?, ?)", (key, expires_at)
+            ).rowcount
+        return inserted == 1
+
+    # chats have no names in this database
+    def get_id_by_name(self, chat_name) -> str:
+        return None
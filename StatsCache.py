@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 256 # cached results, least recently used ones are dropped
+REPORT_EVERY = 100 # lookups between metric reports
+
+class StatsCache:
+    '''
+    Formatted /stat and /statsall results keyed by (chat_id, stat_type, version).
+
+    The version changes whenever something the result depends on changes (see DebitHandler.stats_version),
+    so entries are never invalidated explicitly: a new log makes the old key unreachable and LRU eviction drops it.
+    '''
+    def __init__(self, max_entries=MAX_ENTRIES, report=None):
+        self.max_entries = max_entries
+        self.report = report # called with metrics() every REPORT_EVERY lookups, never by two threads at once
+        self.entries = OrderedDict() # key -> result, least recently used first
+        self.lock = threading.Lock()
+        self.report_lock = threading.Lock() # separate, a slow report doesn't hold back lookups
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''Cached result or None'''
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            lookups = self.hits + self.misses
+
+        report = self.report
+        if report is not None and lookups % REPORT_EVERY == 0:
+            with self.report_lock:
+                report(self.metrics())
+        return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+            }
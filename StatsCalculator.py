@@ -1,19 +1,89 @@
+import copy
 from abc import ABC, abstractmethod
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, NamedTuple
 from collections import defaultdict, Counter
+from DebitHandler import transaction_record
+from Util.money import from_cents
+
+# histories from this size go through LogFrame if NumPy is installed,
+# it is optional (pip install numpy) and not in requirements.txt, the Lambda package stays small without it
+VECTORIZED_MIN_LOGS = 2000
+
+class LogEvent(NamedTuple):
+    """A log entry parsed once and shared by all calculators of a pass"""
+    command: str  # command code ("t", "s", ...)
+    user: Optional[str]  # first argument capitalized (donor of a transaction), None without arguments
+    transaction: Optional[Dict]  # see DebitHandler.transaction_record, None for other commands
+    date_time: Optional[str]
+    log: Dict  # the log itself
+
+def parse_event(log: Dict) -> LogEvent:
+    """Parse a log entry into a LogEvent"""
+    command = log.get("command", "")
+    parts = command.split(" ", 2)
+    return LogEvent(
+        command=parts[0],
+        user=parts[1].capitalize() if len(parts) > 1 else None,
+        transaction=transaction_record(log) if command else None,
+        date_time=log.get("date_time"),
+        log=log,
+    )
+
+def add_values(result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """Add two {key: number} results together"""
+    combined = dict(result)
+    for key, value in other.items():
+        combined[key] = combined.get(key, 0) + value
+    return combined
 
 class StatCalculator(ABC):
-    """Abstract base class for all stat calculators"""
-    
-    @abstractmethod
+    """Abstract base class for all stat calculators
+
+    A calculator either implements reset()/update()/finalize(), so one pass over the logs
+    can feed every calculator (see StatsCalculatorManager.run_calculators), or only calculate().
+    """
+
+    window = None  # Util.time_window.TimeWindow of the pass, None for the whole history
+
+    def start(self, state: Optional[Dict[str, float]] = None, window=None) -> "StatCalculator":
+        """Fresh copy of this calculator for one pass, feed it with update() and get the result from finalize()
+
+        window: time window the pass is limited to, only logs inside it are fed and self.window is set
+        before reset(), so calculators can take it into account (e.g. for rates)
+        """
+        running = copy.copy(self)
+        running.window = window
+        running.reset(state)
+        return running
+
+    def reset(self, state: Optional[Dict[str, float]]):
+        """Clear the running values of a pass, calculators implementing only calculate() collect the logs"""
+        self.state = state
+        self.logs = []
+
+    def update(self, event: LogEvent):
+        """Add one log entry, newest first like load_logs"""
+        self.logs.append(event.log)
+
+    def finalize(self) -> Dict[str, Any]:
+        """Result of the pass"""
+        if type(self).calculate is StatCalculator.calculate:
+            raise NotImplementedError(f"{type(self).__name__} must implement update() and finalize() or calculate()")
+        return self.calculate(self.logs if self.requires_logs() else None, self.state)
+
     def calculate(self, logs: Optional[List[Dict]] = None, state: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
         """Calculate the statistic from logs and/or current state
         
         Args:
             logs: Command logs (optional, pass None if not needed)
             state: Current user balances (optional, pass None if not needed)
+
+        Calculators with update()/finalize() get this for compatibility, it runs a pass over logs.
         """
-        pass
+        running = self.start(state)
+        for log in logs or []:
+            running.update(parse_event(log))
+        return running.finalize()
     
     @abstractmethod
     def get_display_name(self) -> str:
@@ -33,28 +103,32 @@ class StatCalculator(ABC):
         """Override this to return False if calculator doesn't need state"""
         return True
 
+    def supports_window(self) -> bool:
+        """Override this to return False if results limited to a time window make no sense for this calculator"""
+        # calculators of the current state can't be limited to past logs
+        return self.requires_logs()
+
+    def can_combine(self) -> bool:
+        """Override this to return True if results of two log ranges can be combined with combine()"""
+        return False
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        """Combine results calculated on two separate log ranges (used for archived log summaries)"""
+        raise NotImplementedError
+
 class TransactionVolumeCalculator(StatCalculator):
     """Calculates total transaction volume for each user"""
     
-    def calculate(self, logs: Optional[List[Dict]] = None, state: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
-        if logs is None:
-            return {}
-            
-        stats = defaultdict(float)
-        
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] == "t":
-                # Parse transaction command
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                don = command[1].capitalize()
-                amounts = command[3::2]
-                
-                total_amount = sum(float(amount) for amount in amounts)
-                stats[don] += total_amount
-        
-        return dict(stats)
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.stats = defaultdict(float)
+
+    def update(self, event: LogEvent):
+        record = event.transaction
+        if record is not None and record["type"] == "t":
+            self.stats[record["donor"]] += from_cents(record["total"])
+
+    def finalize(self) -> Dict[str, Any]:
+        return dict(self.stats)
     
     def requires_logs(self) -> bool:
         return True
@@ -62,6 +136,12 @@ class TransactionVolumeCalculator(StatCalculator):
     def requires_state(self) -> bool:
         return False
     
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        return add_values(result, other)
+
     def get_display_name(self) -> str:
         return "Transaction Volume"
     
@@ -76,21 +156,15 @@ class TransactionVolumeCalculator(StatCalculator):
 class TransactionCountCalculator(StatCalculator):
     """Calculates number of transactions each user made"""
     
-    def calculate(self, logs: Optional[List[Dict]] = None, state: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
-        if logs is None:
-            return {}
-            
-        stats = defaultdict(int)
-        
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] in ["t", "td", "tg", "tdex", "tgex"]:
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                don = command[1].capitalize()
-                stats[don] += 1
-        
-        return dict(stats)
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.stats = defaultdict(int)
+
+    def update(self, event: LogEvent):
+        if event.transaction is not None:
+            self.stats[event.transaction["donor"]] += 1
+
+    def finalize(self) -> Dict[str, Any]:
+        return dict(self.stats)
     
     def requires_logs(self) -> bool:
         return True
@@ -98,6 +172,12 @@ class TransactionCountCalculator(StatCalculator):
     def requires_state(self) -> bool:
         return False
     
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        return add_values(result, other)
+
     def get_display_name(self) -> str:
         return "Transaction Count"
     
@@ -112,26 +192,19 @@ class TransactionCountCalculator(StatCalculator):
 class UserInteractionCalculator(StatCalculator):
     """Calculates who interacts with whom most frequently"""
     
-    def calculate(self, logs: Optional[List[Dict]] = None, state: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
-        if logs is None:
-            return {}
-            
-        interactions = defaultdict(lambda: defaultdict(int))
-        
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            if command_parts[0] == "t":
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                don = command[1].capitalize()
-                recs = command[2::2]
-                
-                for rec in recs:
-                    rec = rec.capitalize()
-                    interactions[don][rec] += 1
-                    interactions[rec][don] += 1
-        
-        return {user: dict(user_interactions) for user, user_interactions in interactions.items()}
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.interactions = defaultdict(lambda: defaultdict(int))
+
+    def update(self, event: LogEvent):
+        record = event.transaction
+        if record is not None and record["type"] == "t":
+            don = record["donor"]
+            for rec in record["recipients"]:
+                self.interactions[don][rec] += 1
+                self.interactions[rec][don] += 1
+
+    def finalize(self) -> Dict[str, Any]:
+        return {user: dict(user_interactions) for user, user_interactions in self.interactions.items()}
     
     def requires_logs(self) -> bool:
         return True
@@ -139,6 +212,17 @@ class UserInteractionCalculator(StatCalculator):
     def requires_state(self) -> bool:
         return False
     
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        combined = {user: dict(user_interactions) for user, user_interactions in result.items()}
+        for user, user_interactions in other.items():
+            for rec, count in user_interactions.items():
+                combined.setdefault(user, {})
+                combined[user][rec] = combined[user].get(rec, 0) + count
+        return combined
+
     def get_display_name(self) -> str:
         return "User Interactions"
     
@@ -158,27 +242,16 @@ class UserInteractionCalculator(StatCalculator):
 class TotalAmountTransferredCalculator(StatCalculator):
     """Calculates total amount transferred by each user"""
     
-    def calculate(self, logs: Optional[List[Dict]] = None, state: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
-        if logs is None:
-            return {"total": 0}
-            
-        total = 0
-        for log in logs:
-            if "command" not in log:
-                continue
-            command_parts = log["command"].split(" ")
-            if command_parts[0] == "t":
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                amounts = command[3::2]
-                total += sum(abs(float(amount)) for amount in amounts)
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.total = 0
 
-            elif command_parts[0] in ["td", "tg", "tdex", "tgex"]:
-                from DebitHandler import DebitHandler
-                command = DebitHandler.resolvingAlgebraFormations(command_parts)
-                total += abs(float(command[-1]))
+    def update(self, event: LogEvent):
+        if event.transaction is not None:
+            # every amount counts, a t command paying one member and charging another moved both
+            self.total += sum(abs(i) for i in event.transaction["amounts"])
 
-        return {"total": total}
+    def finalize(self) -> Dict[str, Any]:
+        return {"total": from_cents(self.total)}
 
     def requires_logs(self) -> bool:
         return True
@@ -186,6 +259,12 @@ class TotalAmountTransferredCalculator(StatCalculator):
     def requires_state(self) -> bool:
         return False
 
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        return {"total": result.get("total", 0) + other.get("total", 0)}
+
     def get_display_name(self) -> str:
         return "Total Amount Transferred"
     
@@ -197,18 +276,14 @@ class TotalAmountTransferredCalculator(StatCalculator):
 class CommandUsageCalculator(StatCalculator):
     """Calculates usage frequency of different commands"""
     
-    def calculate(self, logs: Optional[List[Dict]] = None, state: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
-        if logs is None:
-            return {}
-            
-        command_count = Counter()
-        
-        for log in logs:
-            command_parts = log["command"].split(" ")
-            command = command_parts[0]
-            command_count[command] += 1
-        
-        return dict(command_count)
+    def reset(self, state: Optional[Dict[str, float]]):
+        self.command_count = Counter()
+
+    def update(self, event: LogEvent):
+        self.command_count[event.command] += 1
+
+    def finalize(self) -> Dict[str, Any]:
+        return dict(self.command_count)
     
     def requires_logs(self) -> bool:
         return True
@@ -216,6 +291,12 @@ class CommandUsageCalculator(StatCalculator):
     def requires_state(self) -> bool:
         return False
     
+    def can_combine(self) -> bool:
+        return True
+
+    def combine(self, result: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        return add_values(result, other)
+
     def get_display_name(self) -> str:
         return "Command Usage"
     
@@ -256,8 +337,27 @@ class StatsCalculatorManager:
         """Get list of available stat types"""
         return list(self.calculators.keys())
     
-    def calculate_stat(self, stat_type: str, logs: Optional[List[Dict]], state: Optional[Dict[str, float]]) -> Optional[str]:
-        """Calculate a specific statistic with improved parameter handling"""
+    def can_use_summaries(self, stat_type: str, summaries: Optional[List[Dict]]) -> bool:
+        """Check if a statistic can be served from archived segment summaries (without decompressing them)"""
+        calculator = self.calculators.get(stat_type)
+        if calculator is None or not calculator.can_combine():
+            return False
+        return all(stat_type in summary.get("stats", {}) for summary in summaries or [])
+
+    def combine_summaries(self, stat_type: str, result: Dict[str, Any], summaries: Optional[List[Dict]]) -> Dict[str, Any]:
+        """Add partial results stored in segment summaries to a result calculated on the hot logs"""
+        calculator = self.calculators[stat_type]
+        for summary in summaries or []:
+            result = calculator.combine(result, summary["stats"][stat_type])
+        return result
+
+    def calculate_stat(self, stat_type: str, logs: Optional[List[Dict]], state: Optional[Dict[str, float]],
+                       summaries: Optional[List[Dict]] = None, window=None) -> Optional[str]:
+        """Calculate a specific statistic with improved parameter handling
+
+        summaries: archived segment summaries not included in logs, the calculator must be able to use them
+        window: time window logs (and summaries) are limited to, passed on to the calculator
+        """
 
         if stat_type not in self.calculators:
             return None
@@ -276,28 +376,130 @@ class StatsCalculatorManager:
         state_param = state if calculator.requires_state() else None
         
         try:
-            result = calculator.calculate(logs_param, state_param)
+            result = self.run_calculators([stat_type], logs_param, state_param, window=window)[stat_type]
+            if isinstance(result, Exception):
+                raise result
+            if summaries and calculator.requires_logs():
+                result = self.combine_summaries(stat_type, result, summaries)
             return calculator.format_result(result)
         except Exception as e:
             return f"❌ {calculator.get_display_name()}: Error calculating ({str(e)})"
     
-    def calculate_all_stats(self, logs: List[Dict], state: Dict[str, float]) -> str:
-        """Calculate all available statistics with improved error handling"""
+    def calculate_all_stats(self, logs: List[Dict], state: Dict[str, float],
+                            summaries: Optional[List[Dict]] = None, archived_logs: Optional[List[Dict]] = None,
+                            known_results: Optional[Dict[str, Any]] = None, window=None) -> str:
+        """Calculate all available statistics with improved error handling, in one pass over the logs
+
+        summaries: archived segment summaries, used by calculators that can combine results
+        archived_logs: decompressed archived logs (older than logs) for calculators that can't
+        known_results: complete results of some calculators (e.g. materialized stats), they are not calculated
+        window: time window logs are limited to, calculators that don't support windows are left out
+        """
+        known_results = known_results or {}
+        calculators = {name: calculator for name, calculator in self.calculators.items()
+                       if window is None or calculator.supports_window()}
+        names = [name for name in calculators if name not in known_results]
+        use_summaries = {name: bool(summaries) and self.can_use_summaries(name, summaries) for name in names}
+        all_results = self.run_calculators(names, logs, state, archived_logs,
+                                           [name for name, use in use_summaries.items() if not use], window)
+        all_results.update(known_results)
         results = []
         
-        for name, calculator in self.calculators.items():
-            try:                
-                # Only pass the data that the calculator actually needs
-                logs_param = logs if calculator.requires_logs() else None
-                state_param = state if calculator.requires_state() else None
-                
-                result = calculator.calculate(logs_param, state_param)
+        for name, calculator in calculators.items():
+            try:
+                result = all_results[name]
+                if isinstance(result, Exception):
+                    raise result
+                if use_summaries.get(name) and calculator.requires_logs():
+                    result = self.combine_summaries(name, result, summaries)
                 formatted = calculator.format_result(result)
                 results.append(f"📊 {calculator.get_display_name()}:\n{formatted}")
             except Exception as e:
                 results.append(f"❌ {calculator.get_display_name()}: Error calculating ({str(e)})")
         
         return "\n\n" + "="*30 + "\n\n".join(results)
+
+    def run_calculators(self, names: List[str], logs: Optional[List[Dict]], state: Optional[Dict[str, float]],
+                        older_logs: Optional[List[Dict]] = None, older_names: List[str] = (),
+                        window=None) -> Dict[str, Any]:
+        """Run the named calculators in one pass, every log is parsed into a LogEvent once and fed to all of them
+
+        older_logs: logs older than logs, fed only to older_names
+        window: time window the logs were limited to, see StatCalculator.start
+        Returns name -> result, or the exception a calculator raised (the others keep running).
+        """
+        vectorized = self.run_vectorized(names, logs, older_logs, older_names)
+
+        running = {}
+        failed = {}
+        for name in names:
+            if name in vectorized:
+                continue
+            calculator = self.calculators[name]
+            try:
+                running[name] = calculator.start(state if calculator.requires_state() else None, window)
+            except Exception as e:
+                failed[name] = e
+
+        readers = [name for name in running if self.calculators[name].requires_logs()]
+        self.feed(running, failed, readers, logs)
+        if older_logs:
+            self.feed(running, failed, [name for name in readers if name in older_names], older_logs)
+
+        results = dict(failed)
+        results.update(vectorized)
+        for name, calculator in running.items():
+            if name in failed:
+                continue
+            try:
+                results[name] = calculator.finalize()
+            except Exception as e:
+                results[name] = e
+        return {name: results[name] for name in names}
+
+    def run_vectorized(self, names: List[str], logs: Optional[List[Dict]], older_logs: Optional[List[Dict]] = None,
+                       older_names: List[str] = ()) -> Dict[str, Any]:
+        """Results of the named built-in calculators that have a vectorized version in LogFrame, for big histories
+
+        Returns name -> result or exception, calculators left out are run by run_calculators as usual.
+        """
+        logs = logs or []
+        older_logs = older_logs or []
+        if len(logs) + len(older_logs) < VECTORIZED_MIN_LOGS:
+            return {}
+        # NumPy is loaded only for big histories
+        import LogFrame
+        if not LogFrame.available():
+            return {}
+        functions = {name: LogFrame.VECTORIZED[type(self.calculators[name]).__name__] for name in names
+                     if type(self.calculators[name]).__name__ in LogFrame.VECTORIZED}
+        if not functions:
+            return {}
+
+        frame = LogFrame.LogFrame.from_logs(logs + older_logs)
+        hot = frame.head(len(logs))
+        results = {}
+        for name, function in functions.items():
+            try:
+                results[name] = function(frame if name in older_names else hot)
+            except Exception as e:
+                results[name] = e
+        return results
+
+    @staticmethod
+    def feed(running: Dict[str, StatCalculator], failed: Dict[str, Exception], names: List[str], logs: Optional[List[Dict]]):
+        updates = [(name, running[name].update) for name in names if name not in failed]
+        if not updates:
+            # nothing left to feed, don't parse the logs
+            return
+        for log in logs or []:
+            event = parse_event(log)
+            for name, update in updates:
+                try:
+                    update(event)
+                except Exception as e:
+                    failed[name] = e
+                    updates = [i for i in updates if i[0] != name]
     
     def get_stats_summary(self, logs: Optional[List[Dict]], state: Optional[Dict[str, float]]) -> str:
         """Get a summary of key statistics with improved handling"""
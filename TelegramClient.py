@@ -0,0 +1,73 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = "https://api.telegram.org/bot{}/"
+POOL_SIZE = 8 # kept-alive connections to api.telegram.org
+CONNECT_TIMEOUT = 5 # seconds
+READ_TIMEOUT = 10 # seconds, long polling adds its own timeout on top
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5 # doubled on every retry of a failed connection or 5xx
+MAX_RETRY_AFTER = 30 # seconds, longer flood waits are returned to the caller instead of slept through
+
+class TelegramClient:
+    '''
+    Bot API client over one keep-alive requests.Session, so replies reuse open TLS connections
+    instead of a new handshake per call. Created once per process, a warm Lambda keeps it between invocations.
+    '''
+    def __init__(self, token, pool_size=POOL_SIZE):
+        self.url = API_URL.format(token)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def retry_after(response) -> int:
+        '''Seconds to wait after a 429, sent by Telegram as parameters.retry_after'''
+        try:
+            return int(response.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return 1
+
+    def call(self, method, params, http_method="POST", timeout=READ_TIMEOUT, max_retry_after=MAX_RETRY_AFTER):
+        for attempt in range(MAX_RETRIES + 1):
+            last = attempt == MAX_RETRIES
+            try:
+                response = self.session.request(
+                    http_method,
+                    self.url + method,
+                    params=params if http_method == "GET" else None,
+                    data=params if http_method != "GET" else None,
+                    timeout=(CONNECT_TIMEOUT, timeout)
+                )
+            except requests.ConnectionError:
+                # pooled connections closed by the server fail here, the retry opens a new one
+                if last:
+                    raise
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+                continue
+
+            if response.status_code == 429 and not last:
+                retry_after = self.retry_after(response)
+                if retry_after > max_retry_after:
+                    return response
+                time.sleep(retry_after)
+            elif response.status_code >= 500 and not last:
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+            else:
+                return response
+        return response
+
+    def get_updates(self, offset=0, timeout=30) -> list:
+        params = {"timeout": timeout, "offset": offset}
+        resp = self.call("getUpdates", params, http_method="GET", timeout=timeout + READ_TIMEOUT)
+        return resp.json()["result"]
+
+    def send_message(self, chat_id, text, parse_mode="HTML"):
+        params = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+        return self.call("sendMessage", params)
+
+    def reply_to_message(self, chat_id, text, message_id, parse_mode="HTML"):
+        params = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "reply_to_message_id": message_id}
+        return self.call("sendMessage", params)
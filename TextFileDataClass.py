@@ -1,8 +1,103 @@
-import os, time
+import os, time, codecs, json
 from DebitHandler import DebitHandler
-import glob
 
-from AbstractDatabase import AbstractDatabase
+from AbstractDatabase import AbstractDatabase, format_log_time
+from Util.money import to_cents, format_cents
+
+LOG_READ_BLOCK = 4096 # bytes read per step when reading logs from the end
+LOG_DATE_LENGTH = len("2024/01/31_12:00:00") # logs start with a fixed width date
+
+# old version were using utf-8, newer files are utf-16 with BOM
+def detect_encoding(head: bytes) -> str:
+    if head.startswith(codecs.BOM_UTF16_LE):
+        return "utf-16-le"
+    elif head.startswith(codecs.BOM_UTF16_BE):
+        return "utf-16-be"
+    return "utf-8"
+
+def read_lines(path) -> list:
+    with open(path, "rb") as f:
+        data = f.read()
+    encoding = detect_encoding(data[:2])
+    if encoding != "utf-8":
+        data = data[2:]
+    return data.decode(encoding).splitlines()
+
+def read_last_lines(path, count) -> list:
+    '''
+    Reads last count lines of a file by seeking backwards from the end,
+    cost depends on count and not on the size of the file.
+    '''
+    with open(path, "rb") as f:
+        encoding = detect_encoding(f.read(2))
+        start = 0 if encoding == "utf-8" else 2
+        newline = "\n".encode(encoding)
+
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # one newline more than needed so the first line is complete
+        while position > start and data.count(newline) <= count:
+            step = min(LOG_READ_BLOCK, position - start)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+
+    lines = data.decode(encoding, errors="replace").splitlines()
+    if position > start:
+        lines = lines[1:]
+    return lines[-count:] if count > 0 else []
+
+def read_lines_after_time(path, time) -> list:
+    '''
+    Reads lines whose leading date is greater than time (in the log file date format).
+    Dates grow through the file, so the first such line is found with a binary search over byte offsets.
+    '''
+    with open(path, "rb") as f:
+        encoding = detect_encoding(f.read(2))
+        start = 0 if encoding == "utf-8" else 2
+        width = len("\n".encode(encoding))
+        newline = "\n".encode(encoding)
+        size = f.seek(0, os.SEEK_END)
+
+        # offset of the first line starting at or after position
+        def line_start(position):
+            if position <= start:
+                return start
+            offset = position - width
+            f.seek(offset)
+            while True:
+                block = f.read(LOG_READ_BLOCK)
+                if not block:
+                    return size
+                i = block.find(newline)
+                # blocks start at aligned offsets, skip matches spanning two characters
+                while i != -1 and i % width:
+                    i = block.find(newline, i + 1)
+                if i != -1:
+                    return offset + i + width
+                offset += len(block)
+
+        def line_after_time(position):
+            position = line_start(position)
+            if position >= size:
+                return True
+            f.seek(position)
+            date = f.read(LOG_DATE_LENGTH * width).decode(encoding, errors="replace")
+            return date > time
+
+        low, high = start, size
+        while low < high:
+            middle = start + ((low + high) // 2 - start) // width * width
+            if line_after_time(middle):
+                high = middle
+            else:
+                low = middle + width
+
+        f.seek(line_start(low))
+        data = f.read()
+
+    return data.decode(encoding).splitlines()
 
 class TextFileDataClass(AbstractDatabase):
     def __init__(self):
@@ -10,103 +105,104 @@ class TextFileDataClass(AbstractDatabase):
         self.groups_path = os.path.join(os.environ["WRITING_ROOT"], "Groups")
         self.logs_path = os.path.join(os.environ["WRITING_ROOT"], "Logs")
 
-    def load_state(self, chat_id) -> dict:
-        state = dict()  
-        chat_id = str(chat_id)
-        # open any file with the chat_id upfront
-        path_list = glob.glob(os.path.join(self.states_path, chat_id + "*.txt"))
-        if len(path_list) == 1:
-
-            # old version were using utf-8
-            try:
-                with open(path_list[0], "r", encoding="utf-16") as f:
-                    data = f.readlines()
-            except UnicodeError:
-                with open(path_list[0], "r", encoding="utf-8") as f:
-                    data = f.readlines()
-
-            for i in data:
-                i = i.split(" ")
-                state[i[0]] = float(i[1])
-
-        elif len(path_list) == 0:
-            # create file
-            chat_state_path = os.path.join(self.states_path, chat_id + ".txt")
-            with open(chat_state_path, "w") as f:
+        # chat_id -> file path, files are named "<chat_id>.txt" or "<chat_id>_<chat name>.txt"
+        self.states_index = self.build_index(self.states_path)
+        self.groups_index = self.build_index(self.groups_path)
+
+    @staticmethod
+    def build_index(directory) -> dict:
+        index = dict()
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(".txt"):
+                continue
+            chat_id = entry.name[:-len(".txt")].split("_")[0]
+            if chat_id in index:
+                raise DebitHandler.duplicate_name_exception("More than one file with the same chat id", chat_id)
+            index[chat_id] = entry.path
+        return index
+
+    @staticmethod
+    def get_path(index, directory, chat_id) -> str:
+        # create file on first use
+        if chat_id not in index:
+            path = os.path.join(directory, chat_id + ".txt")
+            with open(path, "w") as f:
                 pass
-                
-        else:
-            raise DebitHandler.duplicate_name_exception("More than one file with the same chat id")
+            index[chat_id] = path
+        return index[chat_id]
+
+    def load_state(self, chat_id) -> dict:
+        state = dict()
+        path = self.get_path(self.states_index, self.states_path, str(chat_id))
+
+        # balances are written in units with two decimals, read exactly into cents
+        for i in read_lines(path):
+            i = i.split(" ")
+            state[i[0]] = to_cents(i[1])
 
         return state
 
     def save_state(self, state, chat_id):
-        chat_id = str(chat_id)
-        chat_state_path = glob.glob(os.path.join(self.states_path, chat_id + "*.txt"))[0]
+        chat_state_path = self.get_path(self.states_index, self.states_path, str(chat_id))
 
         with open(chat_state_path, "w", encoding="utf-16") as f:
             for key in state.keys():
-                f.write("{} {}\n".format(key, state[key]))
+                f.write("{} {}\n".format(key, format_cents(state[key])))
 
     def load_groups(self, chat_id) -> dict:
-        chat_id = str(chat_id)
         groups = dict()
+        path = self.get_path(self.groups_index, self.groups_path, str(chat_id))
 
-        # open any file with the chat_id infront
-        path_list = glob.glob(os.path.join(self.groups_path, chat_id + "*.txt"))
-        if len(path_list) == 1:
-            path = path_list[0]
-            
-            # old version were using utf-8
-            try:     
-                with open(path, "r", encoding="utf-16") as f:
-                    text = f.readlines()
-            except UnicodeError:
-                with open(path, "r", encoding="utf-8") as f:
-                    text = f.readlines()
-
-            for i in text:
-                x = i.strip().split("-")
-                groups[x[0]] = x[1].split(" ")
-
-        elif len(path_list) == 0:
-            chat_groups_path = os.path.join(self.groups_path, chat_id + ".txt")
-
-            # create file
-            with open(chat_groups_path, "w") as f:
-                pass
-
-        else:
-            raise DebitHandler.duplicate_name_exception("More than one file with the same chat id")
+        for i in read_lines(path):
+            x = i.strip().split("-")
+            groups[x[0]] = x[1].split(" ")
 
         return groups
 
     def save_groups(self, groups, chat_id):
-        chat_id = str(chat_id)
-        chat_groups_path = glob.glob(os.path.join(self.groups_path, chat_id + "*.txt"))[0]
+        chat_groups_path = self.get_path(self.groups_index, self.groups_path, str(chat_id))
 
         with open(chat_groups_path, "w", encoding="utf-16") as f:
             for key in groups.keys():
                 f.write("{}-{}\n".format(key, " ".join(groups[key])))
 
-    def load_log(self, chat_id, index_reverse = 0) -> tuple:
-        chat_id = str(chat_id)
-        index = -1 - index_reverse
-        path = os.path.join(self.logs_path, chat_id + ".txt")
-
-        with open(path, "r", encoding="utf-16") as f:
-            log_list = f.readlines()[index].strip().split(" ")
-
-        return log_list
-
-    def save_log(self, chat_id, sender_id, message):
+    # log line: "2024/01/31_12:00:00|sender_id|command", transaction logs end with "\t<transaction JSON>"
+    # (commands never contain tabs, they are replaced before commands run)
+    @staticmethod
+    def parse_log(line) -> dict:
+        line, _, transaction = line.strip().partition("\t")
+        date, sender_id, command = line.split("|", 2)
+        log = {
+            "date_time": date.replace("/", "-").replace("_", " "),
+            "sender_id": sender_id,
+            "command": command
+        }
+        if transaction:
+            log["transaction"] = json.loads(transaction)
+        return log
+
+    def load_log(self, chat_id, reverse_index = 0) -> dict:
+        path = os.path.join(self.logs_path, str(chat_id) + ".txt")
+        if not os.path.exists(path):
+            return dict()
+
+        lines = read_last_lines(path, reverse_index + 1)
+        if len(lines) <= reverse_index:
+            return dict()
+
+        return self.parse_log(lines[0])
+
+    def save_log(self, chat_id, sender_id, command, transaction=None):
         chat_id = str(chat_id)
         sender_id = str(sender_id)
 
         date = time.localtime()
         strdate = time.strftime("%Y/%m/%d_%H:%M:%S", date)
-        
-        log = "{}|{}|{}".format(strdate, sender_id, message)
+
+        log = "{}|{}|{}".format(strdate, sender_id, command)
+        if transaction is not None:
+            log += "\t" + json.dumps(transaction, ensure_ascii=False)
 
         path = os.path.join(self.logs_path, chat_id + ".txt")
 
@@ -114,32 +210,46 @@ class TextFileDataClass(AbstractDatabase):
             f.write(log + "\n")
 
     def get_id_by_name(self, chat_name):
-        path = os.path.join(self.states_path, "*" + chat_name + ".txt")
-        num_of_files = glob.glob(path)
+        paths = [i for i in self.states_index.values() if os.path.basename(i).endswith(chat_name + ".txt")]
 
-        if len(num_of_files) == 0:
+        if len(paths) == 0:
             return None
-        elif len(num_of_files) == 1:
-            file_name = os.path.basename(num_of_files[0])
+        elif len(paths) == 1:
+            file_name = os.path.basename(paths[0])
             return file_name.split("_")[0]
         else:
             raise DebitHandler.duplicate_name_exception("There are multiple groups with the same name", chat_name)
 
-    def load_logs(cls, path):
-        try:
-            with open(path, "r", encoding="utf-16") as f:
-                logs = f.readlines()
-                logs = [i.strip() for i in logs]
+    # newest first, all logs if reverse_index is False or negative
+    def load_logs(self, chat_id, reverse_index) -> list:
+        path = os.path.join(self.logs_path, str(chat_id) + ".txt")
+        if not os.path.exists(path):
+            return list()
 
-        except FileNotFoundError:
-            with open(path, "w") as f:
-                pass    
-            logs = list()
+        if not reverse_index or reverse_index < 0:
+            lines = read_lines(path)
+        else:
+            lines = read_last_lines(path, reverse_index)
+
+        return [self.parse_log(i) for i in reversed(lines) if i.strip()]
+
+    # logs in a time window, newest first
+    def load_log_after_time(self, chat_id, time, end_time=None) -> list:
+        path = os.path.join(self.logs_path, str(chat_id) + ".txt")
+        if not os.path.exists(path):
+            return list()
+
+        # log files use "2024/01/31_12:00:00"
+        time = format_log_time(time).replace("-", "/").replace(" ", "_")
+        logs = [self.parse_log(i) for i in reversed(read_lines_after_time(path, time)) if i.strip()]
 
+        if end_time is not None:
+            end_time = format_log_time(end_time)
+            logs = [i for i in logs if i["date_time"] < end_time]
         return logs
 
 # test get_id_by_name
 if __name__ == "__main__":
     t = TextFileDataClass()
     print(t.save_log("-568234974", "3", "/t vrljo tomas 40 miha 30"))
-    print(t.get_id_by_name("Ciovo"))
\ No newline at end of file
+    print(t.get_id_by_name("Ciovo"))
@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+
+from AbstractDatabase import AbstractDatabase
+
+MAX_UPDATES = 10000 # remembered updates, least recently seen ones are dropped
+MARKER_TTL_SECONDS = 60 * 60 * 24 # Telegram stops retrying an update long before this
+
+class UpdateDeduplicator:
+    '''
+    Recognizes updates that were already processed (Telegram webhook retries, Lambda re-invocations).
+
+    An update is identified by chat_id:message_id, or by update_id when it has no message.
+    Seen keys are kept in a bounded LRU, so a retry costs one dictionary lookup.
+    With a store (AbstractDatabase implementing mark_update) the first instance to see an update
+    also writes a conditional marker with a TTL, so retries delivered to another instance are caught too.
+    Updates are marked before they run, a command is applied at most once.
+    '''
+    def __init__(self, max_updates=MAX_UPDATES, store: AbstractDatabase = None,
+                 ttl_seconds=MARKER_TTL_SECONDS, clock=time.time):
+        self.max_updates = max_updates
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def update_key(update) -> str:
+        if "message" in update and "message_id" in update["message"]:
+            return f"{update['message']['chat']['id']}:{update['message']['message_id']}"
+        return f"update:{update['update_id']}"
+
+    def first_seen(self, update) -> bool:
+        '''True the first time an update is seen, False for every repeated delivery'''
+        key = self.update_key(update)
+        with self.lock:
+            if key in self.seen:
+                self.seen.move_to_end(key)
+                return False
+            self.seen[key] = True
+            while len(self.seen) > self.max_updates:
+                self.seen.popitem(last=False)
+
+        if self.store is not None:
+            return self.store.mark_update(key, int(self.clock() + self.ttl_seconds))
+        return True
@@ -0,0 +1,73 @@
+'''
+Evaluates the arithmetic users type in amounts ("30+12.5", "(100-20)/3") without eval.
+Supports + - * / with the usual precedence, unary signs, parentheses and decimal numbers.
+Results have the same type and value eval gave: int unless a decimal number or / is involved.
+'''
+import functools
+import re
+
+PRECEDENCE = {"+": 1, "-": 1, "*": 2, "/": 2}
+TOKEN = re.compile(r"\d+\.?\d*|\.\d+|[-+*/()]")
+
+class ExpressionError(ValueError):
+    pass
+
+def tokenize(expression: str) -> list:
+    tokens = list()
+    position = 0
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise ExpressionError(f"Unexpected character {expression[position]!r}")
+        tokens.append(match.group())
+        position = match.end()
+    return tokens
+
+def apply(operator, left, right):
+    if operator == "+":
+        return left + right
+    elif operator == "-":
+        return left - right
+    elif operator == "*":
+        return left * right
+    return left / right
+
+def parse_operand(tokens: list, position: int) -> tuple:
+    '''Number, signed operand or parenthesized expression starting at position, returns (value, next position)'''
+    if position >= len(tokens):
+        raise ExpressionError("Unexpected end of expression")
+
+    token = tokens[position]
+    if token == "-" or token == "+":
+        value, position = parse_operand(tokens, position + 1)
+        return (-value if token == "-" else value), position
+    elif token == "(":
+        value, position = parse_expression(tokens, position + 1, 1)
+        if position >= len(tokens) or tokens[position] != ")":
+            raise ExpressionError("Missing )")
+        return value, position + 1
+    elif token in PRECEDENCE or token == ")":
+        raise ExpressionError(f"Unexpected {token}")
+
+    return (float(token) if "." in token else int(token)), position + 1
+
+def parse_expression(tokens: list, position: int, min_precedence: int) -> tuple:
+    '''Precedence climbing, operators of equal precedence are applied left to right'''
+    left, position = parse_operand(tokens, position)
+    while position < len(tokens) and PRECEDENCE.get(tokens[position], 0) >= min_precedence:
+        operator = tokens[position]
+        right, position = parse_expression(tokens, position + 1, PRECEDENCE[operator] + 1)
+        left = apply(operator, left, right)
+    return left, position
+
+@functools.lru_cache(maxsize=4096)
+def evaluate(expression: str):
+    '''
+    Value of expression, raises ExpressionError if it isn't valid arithmetic
+    and ZeroDivisionError when dividing by zero. Results are cached, amounts repeat a lot.
+    '''
+    tokens = tokenize(expression)
+    value, position = parse_expression(tokens, 0, 1)
+    if position != len(tokens):
+        raise ExpressionError(f"Unexpected {tokens[position]}")
+    return value
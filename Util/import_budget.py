@@ -0,0 +1,87 @@
+'''
+Checks that the Lambda entry modules import within a time budget and without the heavy
+modules that are meant to load on first use (boto3, stats calculators, materialized stats, lzma).
+
+Measured with python -X importtime in a fresh interpreter, run from the project root:
+    python -m Util.import_budget
+Exits with 1 when a module is over budget or pulls in a deferred module.
+'''
+import os
+import re
+import subprocess
+import sys
+
+# cumulative import time in milliseconds, about 1.5x of what CPython 3.11 measures locally
+BUDGETS_MS = {
+    "DebitHandler": 30,
+    "DynamoDBDataClass": 25,
+    "main": 200,
+}
+# modules that must not be imported at cold start
+DEFERRED = ["boto3", "botocore", "StatsCalculator", "ExtendedStatsCalculators", "LogFrame", "numpy",
+            "MaterializedStats", "lzma"]
+RUNS = 3 # best of, first run also warms the bytecode cache
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# tables are not touched on import, any name will do
+ENVIRONMENT = {
+    "TELEGRAM_TOKEN": "0:budget",
+    "DYNAMODB_TABLE_NAME": "budget",
+    "CODES_TABLE_NAME": "budget",
+    "LOGS_TABLE_NAME": "budget",
+    "LOG_ARCHIVE_TABLE_NAME": "budget",
+}
+
+# "import time:       123 |        456 | module"
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def measure(module) -> tuple:
+    '''Returns (cumulative milliseconds, set of imported module names)'''
+    env = dict(os.environ)
+    for name, value in ENVIRONMENT.items():
+        env.setdefault(name, value)
+    # Lambda packages ship compiled bytecode, measure with it
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=ROOT
+    )
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+
+    cumulative = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        imported.add(match.group(4))
+        # top level line of the measured module
+        if match.group(4) == module and match.group(3) == " ":
+            cumulative = int(match.group(2))
+    return cumulative / 1000, imported
+
+def check(budgets=BUDGETS_MS) -> list:
+    errors = list()
+    for module, budget in budgets.items():
+        try:
+            runs = [measure(module) for _ in range(RUNS)]
+        except ImportError as e:
+            errors.append(f"{module}: {e}")
+            continue
+
+        best = min(i[0] for i in runs)
+        deferred = sorted(i for i in runs[0][1] if i.split(".")[0] in DEFERRED)
+        print(f"{module:<20} {best:8.1f} ms  (budget {budget} ms)")
+        if best > budget:
+            errors.append(f"{module}: {best:.1f} ms over budget of {budget} ms")
+        if deferred:
+            errors.append(f"{module}: imports deferred modules {', '.join(deferred)}")
+    return errors
+
+if __name__ == "__main__":
+    errors = check()
+    for i in errors:
+        print("FAIL", i)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,63 @@
+'''
+Checks the vectorized stats of LogFrame against the calculators they stand in for (the reference)
+on generated chat histories, and times both.
+
+Run from the project root (needs NumPy):
+    python -m Util.logframe_check [number of logs]
+Histories are checked with derived and with stored transaction records, some transactions undone.
+Exits with 1 if a vectorized stat gives a different result than its calculator.
+'''
+import random
+import sys
+
+import LogFrame
+from StatsCalculator import StatsCalculatorManager
+from ExtendedStatsCalculators import add_extended_calculators
+from Util.stats_benchmark import generate, best_of, same
+
+LOGS = 50000
+UNDONE = 0.05 # share of logs marked undone
+
+def calculators(manager) -> dict:
+    '''stat name -> (calculator, vectorized stat)'''
+    return {name: (calculator, LogFrame.VECTORIZED[type(calculator).__name__])
+            for name, calculator in manager.calculators.items() if type(calculator).__name__ in LogFrame.VECTORIZED}
+
+if __name__ == "__main__":
+    if not LogFrame.available():
+        sys.exit("NumPy is not installed, LogFrame can't be checked")
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else LOGS
+    manager = StatsCalculatorManager()
+    add_extended_calculators(manager)
+    stats = calculators(manager)
+    rng = random.Random(2)
+
+    failed = False
+    for records in (False, True):
+        logs = generate(count, records)
+        for log in logs:
+            if rng.random() < UNDONE:
+                log["undone"] = 1
+
+        reference_time, reference = best_of(lambda: {name: calculator.calculate(logs, None)
+                                                     for name, (calculator, _) in stats.items()})
+        frame_time, frame = best_of(lambda: LogFrame.LogFrame.from_logs(logs))
+        vectorized_time, vectorized = best_of(lambda: {name: function(frame) for name, (_, function) in stats.items()})
+        head = frame.head(count // 3)
+        head_reference = {name: calculator.calculate(logs[:count // 3], None) for name, (calculator, _) in stats.items()}
+
+        print(f"{count} logs, {'stored' if records else 'derived'} transaction records, {len(stats)} stats")
+        print(f"  calculators       {reference_time * 1000:8.1f} ms")
+        print(f"  LogFrame build    {frame_time * 1000:8.1f} ms")
+        print(f"  vectorized stats  {vectorized_time * 1000:8.1f} ms  "
+              f"({reference_time / (frame_time + vectorized_time):.1f}x with the build)")
+        for name, (_, function) in stats.items():
+            if not same(reference[name], vectorized[name]):
+                failed = True
+                print(f"  FAIL {name}: {reference[name]!r:.200} != {vectorized[name]!r:.200}")
+            if not same(head_reference[name], function(head)):
+                failed = True
+                print(f"  FAIL {name} on the newest {count // 3} logs")
+    print("FAIL" if failed else "all stats equal")
+    sys.exit(1 if failed else 0)
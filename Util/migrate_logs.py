@@ -0,0 +1,75 @@
+'''
+One-off migration of command logs from the "logs" list inside each chat item
+into the logs table (chat_id, seq).
+
+Run from the project root, before deploying the version that writes to the logs table
+(new logs would otherwise take the same seq numbers). Stop the bot while it runs:
+a chat that gets a command during its migration is copied again, up to MIGRATE_ATTEMPTS times.
+    python -m Util.migrate_logs
+Seqs follow the position in the list (the oldest log is 1), so an interrupted run can simply be started again.
+'''
+from DynamoDBDataClass import DynamoDBDataClass
+
+MIGRATE_ATTEMPTS = 5 # copies of a chat that keeps changing before the migration gives up
+
+def migrate_chat(data: DynamoDBDataClass, chat_id: int, logs: list) -> int:
+    '''
+    Writes logs of one chat to the logs table and removes them from the chat item.
+    Logs in the chat item are stored newest first, so the oldest one gets seq 1.
+    Returns number of migrated logs.
+    '''
+    for _ in range(MIGRATE_ATTEMPTS):
+        with data.table_logs.batch_writer() as batch:
+            for seq, log in enumerate(reversed(logs), start=1):
+                batch.put_item(Item={
+                    "chat_id": chat_id,
+                    "seq": seq,
+                    "date_time": log["date_time"],
+                    "sender_id": log["sender_id"],
+                    "command": log["command"]
+                })
+
+        try:
+            # only drop the list if nobody changed it in the meantime
+            data.table.update_item(
+                Key={"chat_id": chat_id},
+                UpdateExpression="SET log_seq = :n REMOVE logs",
+                ConditionExpression="size(logs) = :n",
+                ExpressionAttributeValues={":n": len(logs)}
+            )
+            return len(logs)
+        except data.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+        # the chat got a command (or lost a log): copy it again from the fresh list,
+        # rows the fresh list doesn't cover anymore are deleted
+        item = data.table.get_item(Key={"chat_id": chat_id}, ProjectionExpression="logs", ConsistentRead=True)
+        fresh = item.get("Item", {}).get("logs", [])
+        with data.table_logs.batch_writer() as batch:
+            for seq in range(len(fresh) + 1, len(logs) + 1):
+                batch.delete_item(Key={"chat_id": chat_id, "seq": seq})
+        if not fresh:
+            return 0
+        logs = fresh
+
+    raise RuntimeError(f"Chat {chat_id} kept changing during its migration, stop the bot and run it again")
+
+def migrate_all(data: DynamoDBDataClass) -> dict:
+    migrated = dict()
+    kwargs = {"ProjectionExpression": "chat_id, logs"}
+    while True:
+        response = data.table.scan(**kwargs)
+        for item in response.get("Items", []):
+            if item.get("logs"):
+                chat_id = int(item["chat_id"])
+                migrated[chat_id] = migrate_chat(data, chat_id, item["logs"])
+
+        if "LastEvaluatedKey" not in response:
+            return migrated
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+if __name__ == "__main__":
+    migrated = migrate_all(DynamoDBDataClass())
+    for chat_id, count in migrated.items():
+        print(f"{chat_id:>14}: {count} logs")
+    print(f"Migrated {sum(migrated.values())} logs from {len(migrated)} chats")
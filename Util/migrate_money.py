@@ -0,0 +1,44 @@
+'''
+One-off migration of DynamoDB balances from units (Decimal 12.34) to integer cents (1234).
+Migrated chat items get money_version = 1, so running it again skips them.
+
+Stop the bot, run from the project root, then deploy the version that reads cents:
+    python -m Util.migrate_money
+
+SQLite databases migrate themselves on open, text files keep units and need nothing.
+'''
+from DynamoDBDataClass import DynamoDBDataClass
+from Util.money import to_cents
+
+MONEY_VERSION = 1
+
+def migrate_all(data: DynamoDBDataClass) -> int:
+    migrated = 0
+    kwargs = {
+        "ProjectionExpression": "chat_id, #state, money_version",
+        "ExpressionAttributeNames": {"#state": "state"},
+    }
+    while True:
+        response = data.table.scan(**kwargs)
+        for item in response.get("Items", []):
+            if "state" not in item or item.get("money_version", 0) >= MONEY_VERSION:
+                continue
+
+            data.table.update_item(
+                Key={"chat_id": item["chat_id"]},
+                UpdateExpression="SET #state = :state, money_version = :v",
+                ConditionExpression="attribute_not_exists(money_version)",
+                ExpressionAttributeNames={"#state": "state"},
+                ExpressionAttributeValues={
+                    ":state": {name: to_cents(value) for name, value in item["state"].items()},
+                    ":v": MONEY_VERSION
+                }
+            )
+            migrated += 1
+
+        if "LastEvaluatedKey" not in response:
+            return migrated
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+if __name__ == "__main__":
+    print(f"Migrated balances of {migrate_all(DynamoDBDataClass())} chats")
@@ -0,0 +1,49 @@
+'''
+Balances are integer cents everywhere (handler, storage and deltas).
+Amounts typed by users are converted once with to_cents and converted back only for display.
+'''
+import math
+from decimal import Decimal, ROUND_HALF_UP
+from fractions import Fraction
+
+def to_cents(amount) -> int:
+    '''Converts an amount in units (str, int, float or Decimal) to cents, rounding half up'''
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+def format_cents(cents: int) -> str:
+    '''12345 -> "123.45", -5 -> "-0.05"'''
+    sign = "-" if cents < 0 else ""
+    return "{}{}.{:02d}".format(sign, abs(cents) // 100, abs(cents) % 100)
+
+def allocate(quotas: list, total: int) -> list:
+    '''
+    Rounds exact quotas to whole cents so they add up to total.
+    Every part is rounded down and the leftover cents go to the parts with the largest remainders
+    (earlier parts win ties). Negative totals are allocated like positive ones with the sign flipped,
+    so an inverted command (undo) produces exactly the inverted parts.
+    '''
+    if total < 0:
+        return [-i for i in allocate([-q for q in quotas], -total)]
+
+    parts = [math.floor(q) for q in quotas]
+    leftover = total - sum(parts)
+    order = sorted(range(len(parts)), key=lambda i: quotas[i] - parts[i], reverse=True)
+    for i in order[:leftover]:
+        parts[i] += 1
+    return parts
+
+def split_cents(total: int, weights: list) -> list:
+    '''Splits total cents into parts proportional to weights, parts add up exactly to total'''
+    weights = [Fraction(str(w)) for w in weights]
+    weight_sum = sum(weights)
+    return allocate([total * w / weight_sum for w in weights], total)
+
+def scale_cents(values: dict, multiplier) -> dict:
+    '''Multiplies every value, the result adds up to the rounded product of the original sum'''
+    multiplier = Fraction(str(multiplier))
+    quotas = [v * multiplier for v in values.values()]
+    total = round(sum(quotas))
+    return dict(zip(values.keys(), allocate(quotas, total)))
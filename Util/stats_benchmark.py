@@ -0,0 +1,109 @@
+'''
+Times /statsall on a generated chat history: every calculator going through the logs on its own
+(what calculate_all_stats did before) against the one-pass engine, where each log is parsed once.
+
+Run from the project root:
+    python -m Util.stats_benchmark [number of logs]
+Logs without stored transaction records (saved before records existed) are the expensive case,
+their records are derived from the command text. Exits with 1 if the two ways give different results.
+With NumPy installed, histories from VECTORIZED_MIN_LOGS logs use the LogFrame stats in the one pass.
+'''
+import math
+import random
+import sys
+import time
+
+from DebitHandler import parse_command, transaction_record
+from StatsCalculator import StatsCalculatorManager
+from ExtendedStatsCalculators import add_extended_calculators
+
+LOGS = 50000
+NAMES = ["Karlo", "Jura", "Grgur", "Tvrtko", "Miha", "Ana", "Iva", "Luka"]
+RUNS = 3 # best of
+
+def amount(rng) -> str:
+    # some amounts are typed as arithmetic
+    if rng.random() < 0.2:
+        return f"{rng.randint(1, 200)}+{rng.randint(1, 99)}.{rng.randint(0, 99):02d}"
+    return f"{rng.randint(1, 500)}.{rng.randint(0, 99):02d}"
+
+def command(rng) -> str:
+    names = [i.lower() for i in rng.sample(NAMES, rng.randint(2, 4))]
+    kind = rng.random()
+    if kind < 0.45:
+        return "t " + names[0] + "".join(f" {i} {amount(rng)}" for i in names[1:])
+    elif kind < 0.65:
+        return "td " + " ".join(names) + " " + amount(rng)
+    elif kind < 0.75:
+        return "tdex " + " ".join(names) + " " + amount(rng)
+    elif kind < 0.85:
+        return f"tg {names[0]} party {amount(rng)}"
+    elif kind < 0.95:
+        return "s"
+    return "u"
+
+def generate(count, records=False, seed=1) -> list:
+    '''count logs, newest first like load_logs; with records transaction logs carry a stored record'''
+    rng = random.Random(seed)
+    logs = list()
+    for seq in range(count, 0, -1):
+        log = {
+            "seq": seq,
+            "date_time": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1700000000 + seq * 600)),
+            "sender_id": 1,
+            "command": command(rng),
+        }
+        if records:
+            record = transaction_record(log)
+            if record is not None:
+                log["transaction"] = record
+        logs.append(log)
+    return logs
+
+def best_of(function) -> tuple:
+    '''Returns (best seconds, result of the last run)'''
+    times = list()
+    for _ in range(RUNS):
+        # parsed commands are cached, every run starts cold
+        parse_command.cache_clear()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def same(reference, result) -> bool:
+    '''Equal up to float rounding: the calculators add amounts as floats, LogFrame adds cents'''
+    if isinstance(reference, dict) and isinstance(result, dict):
+        return list(reference) == list(result) and all(same(reference[i], result[i]) for i in reference)
+    if isinstance(reference, float) or isinstance(result, float):
+        return math.isclose(reference, result, rel_tol=1e-9, abs_tol=1e-9)
+    return reference == result
+
+def separate_passes(manager, logs, state) -> dict:
+    return {name: calculator.calculate(logs, state if calculator.requires_state() else None)
+            for name, calculator in manager.calculators.items()}
+
+def one_pass(manager, logs, state) -> dict:
+    return manager.run_calculators(list(manager.calculators), logs, state)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else LOGS
+    manager = StatsCalculatorManager()
+    add_extended_calculators(manager)
+    state = {name: 0.0 for name in NAMES}
+
+    failed = False
+    for records in (False, True):
+        logs = generate(count, records)
+        separate, separate_results = best_of(lambda: separate_passes(manager, logs, state))
+        single, single_results = best_of(lambda: one_pass(manager, logs, state))
+        statsall, _ = best_of(lambda: manager.calculate_all_stats(logs, state))
+
+        print(f"{count} logs, {'stored' if records else 'derived'} transaction records, {len(manager.calculators)} calculators")
+        print(f"  separate passes   {separate * 1000:8.1f} ms")
+        print(f"  one pass          {single * 1000:8.1f} ms  ({separate / single:.1f}x)")
+        print(f"  /statsall         {statsall * 1000:8.1f} ms  (one pass and formatting)")
+        if not same(separate_results, single_results):
+            failed = True
+            print("  FAIL results differ:", [i for i in separate_results if not same(separate_results[i], single_results.get(i))])
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,88 @@
+'''
+Time windows of /stat and /statsall ("30d", "2025-01", "2025-01..2025-03").
+
+    30d, 2w               today and the days before it (30 days, 2 weeks), from midnight
+    2025, 2025-01, 2025-01-15
+                          that whole year, month or day
+    A..B                  from the start of period A to the end of period B (both like above),
+                          either side can be left out: "2025-03.." or "..2024"
+
+A window covers start <= date_time < end, end None means up to now.
+Times are naive local times, like the date_time of logs.
+'''
+import datetime
+import re
+from typing import NamedTuple, Optional
+
+from AbstractDatabase import LOG_DATE_FORMAT
+
+RELATIVE = re.compile(r"^(\d+)([dw])$")
+PERIOD = re.compile(r"^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$")
+MAX_DAYS = 100 * 366
+
+class TimeWindow(NamedTuple):
+    start: Optional[datetime.datetime]  # None from the first log
+    end: Optional[datetime.datetime]  # None up to now
+    text: str  # as the user typed it
+
+    @property
+    def after(self) -> str:
+        '''Start for load_log_after_time, which excludes it (log times have whole seconds)'''
+        if self.start is None:
+            return "0000-00-00 00:00:00"
+        return (self.start - datetime.timedelta(seconds=1)).strftime(LOG_DATE_FORMAT)
+
+    def contains(self, date_time: str) -> bool:
+        '''date_time: LOG_DATE_FORMAT string of a log'''
+        return ((self.start is None or date_time >= self.start.strftime(LOG_DATE_FORMAT))
+                and (self.end is None or date_time < self.end.strftime(LOG_DATE_FORMAT)))
+
+    def covers(self, first: str, last: str) -> bool:
+        '''True if logs from first to last (date_time strings) are all inside the window'''
+        return self.contains(first) and self.contains(last)
+
+    def overlaps(self, first: str, last: str) -> bool:
+        '''True if some of the logs from first to last can be inside the window'''
+        return ((self.start is None or last >= self.start.strftime(LOG_DATE_FORMAT))
+                and (self.end is None or first < self.end.strftime(LOG_DATE_FORMAT)))
+
+def period(text: str) -> tuple:
+    '''"2025-01" -> (start, end) of that month, raises ValueError for anything else'''
+    match = PERIOD.match(text)
+    if match is None:
+        raise ValueError(f"Unknown date {text!r}")
+    year, month, day = (int(i) if i else None for i in match.groups())
+    if month is None:
+        return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+    if day is None:
+        start = datetime.datetime(year, month, 1)
+        return start, (start + datetime.timedelta(days=32)).replace(day=1)
+    start = datetime.datetime(year, month, day)
+    return start, start + datetime.timedelta(days=1)
+
+def parse_window(text: str, now: datetime.datetime = None) -> TimeWindow:
+    '''Window described by text, raises ValueError if it isn't one'''
+    text = text.lower()
+    now = now or datetime.datetime.now()
+
+    match = RELATIVE.match(text)
+    if match is not None:
+        days = int(match.group(1)) * (7 if match.group(2) == "w" else 1)
+        if not 0 < days <= MAX_DAYS:
+            raise ValueError(f"Window of {days} days")
+        # whole days, so the window (and results cached for it) only moves at midnight
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return TimeWindow(today - datetime.timedelta(days=days - 1), None, text)
+
+    if ".." in text:
+        first, last = text.split("..", 1)
+        if not first and not last:
+            raise ValueError("Empty window")
+        start = period(first)[0] if first else None
+        end = period(last)[1] if last else None
+        if start is not None and end is not None and start >= end:
+            raise ValueError(f"Window {text!r} ends before it starts")
+        return TimeWindow(start, end, text)
+
+    start, end = period(text)
+    return TimeWindow(start, end, text)
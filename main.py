@@ -1,49 +1,83 @@
 # -*- coding: UTF8 -*-
-import requests, datetime
+import datetime
 import json
 import os
+import time
 import traceback
 
-from dotenv import load_dotenv
-load_dotenv()
+# Lambda gets its environment from the function config, .env is only read for local runs
+if "TELEGRAM_TOKEN" not in os.environ:
+    from dotenv import load_dotenv
+    load_dotenv()
 
 from DebitHandler import DebitHandler
 from CustomCommandsHandler import CCHandler
-from DynamoDBDataClass import DynamoDBDataClass
+from LogCompactor import COMPACT_EVERY_LOGS
+from TelegramClient import TelegramClient
+from RateLimiter import SlidingWindowLimiter
+from OutboundQueue import OutboundQueue
+from UpdateDeduplicator import UpdateDeduplicator
+from BufferedLogger import BufferedLogger
 
 TOKEN = os.environ["TELEGRAM_TOKEN"]
 LOG_PATH = os.environ.get("LOGS_PATH", "logs/logs.txt")
 ERROR_LOG_PATH = os.environ.get("ERROR_LOGS_PATH", "logs/errors.txt")
+# JSON lines, written in the background
+message_logger = BufferedLogger(LOG_PATH)
+error_logger = BufferedLogger(ERROR_LOG_PATH)
 
-url = "https://api.telegram.org/bot{}/".format(TOKEN)
+# module level, so warm Lambda invocations reuse its connections
+bot = TelegramClient(TOKEN)
+# polling sends replies through the outbound queue, Lambda sends them directly
+outbox = None
 
 testerId = 1217535067
 NUM_COMM_BEFORE_CAP = 50 # how many commands before the cap is applied
 MAX_COMM_PER_MIN = 2 # max commands per minute after the cap is applied
-
-t = DynamoDBDataClass()
+# INLINE_REPLY=1: webhook replies go back in the Lambda response body instead of a separate sendMessage call
+INLINE_REPLY = os.environ.get("INLINE_REPLY", "0") == "1"
+
+# DATABASE=sqlite for self-hosted polling (SQLITE_PATH sets the file), DynamoDB otherwise
+if os.environ.get("DATABASE", "dynamodb").lower() == "sqlite":
+    from SQLiteDataClass import SQLiteDataClass
+    t = SQLiteDataClass()
+else:
+    from DynamoDBDataClass import DynamoDBDataClass
+    t = DynamoDBDataClass()
 DH = DebitHandler(t)
 CC = CCHandler()
 
+# more than NUM_COMM_BEFORE_CAP commands in the window are capped to MAX_COMM_PER_MIN,
+# SHARED_RATE_LIMIT=1 also counts commands in storage for deployments with several instances
+limiter = SlidingWindowLimiter(
+    limit=NUM_COMM_BEFORE_CAP + 1,
+    window_seconds=NUM_COMM_BEFORE_CAP * 60 / MAX_COMM_PER_MIN,
+    store=t if os.environ.get("SHARED_RATE_LIMIT", "0") == "1" else None
+)
+# SHARED_DEDUPLICATION=1 also marks processed updates in storage, for retries that reach another instance
+deduplicator = UpdateDeduplicator(store=t if os.environ.get("SHARED_DEDUPLICATION", "0") == "1" else None)
+
 
 def get_updates(offset=0, timeout=30):  # 30
-    method = "getUpdates"
-    params = {"timeout": timeout, "offset": offset}
-    resp = requests.get(url + method, params)
-    result_json = resp.json()["result"]
-    return result_json
+    return bot.get_updates(offset, timeout=timeout)
 
 def send_message(chat_id, text):
-    params = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
-    method = "sendMessage"
-    resp = requests.post(url + method, params)
-    return resp
+    return bot.send_message(chat_id, text)
 
 def reply_to_message(chat_id, text, message_id, parse_mode="HTML"):
-    params = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "reply_to_message_id": message_id}
-    method = "sendMessage"
-    resp = requests.post(url + method, params)
-    return resp
+    if outbox is not None:
+        return outbox.put(chat_id, text, message_id, parse_mode=parse_mode)
+    return bot.reply_to_message(chat_id, text, message_id, parse_mode=parse_mode)
+
+# Bot API call Telegram executes when a webhook answers with it
+def reply_payload(chat_id, text, message_id, parse_mode="HTML") -> dict:
+    return {
+        "method": "sendMessage",
+        "chat_id": chat_id,
+        "reply_to_message_id": message_id,
+        "parse_mode": parse_mode,
+        "text": text
+    }
 
 def get_user_name(current_update):
     if "username" in current_update["message"]["from"]:
@@ -59,12 +93,23 @@ def get_user_name(current_update):
     return user
 
 def log_message(text):
-    try:
-        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
-        with open(LOG_PATH, "a") as f:
-            f.write(f"{text}\n")
-    except Exception as e:
-        print("Failed to log message:", e)
+    message_logger.log({"message": text})
+
+# stats cache hit rate, every StatsCache.REPORT_EVERY lookups
+DH.stats_cache.report = lambda metrics: log_message(f"stats cache: {metrics}")
+
+# one record per command: who sent it, how it ended and how long it took
+def log_update(update, outcome, started, command_code=None):
+    message = update["message"]
+    if command_code is None:
+        command_code = message["text"].split()[0][1:]
+    message_logger.log({
+        "chat_id": message["chat"]["id"],
+        "sender": get_user_name(update) if "from" in message else None,
+        "command": command_code,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        "outcome": outcome,
+    })
 
 def show(current_update):
     if "message" not in current_update or "text" not in current_update["message"]:
@@ -76,9 +121,9 @@ def show(current_update):
     text = current_update["message"]["text"]
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+    # the log file gets a structured record from log_update
     log = f"[{timestamp}] {str(chat_id):>14}: {str(user):>14} - {text}"
     print(log)
-    log_message(log)
 
 def non_commands_filter(funk):
     def inner(update, *args, **kwargs):
@@ -92,6 +137,25 @@ def non_commands_filter(funk):
 
     return inner
 
+def duplicate_filter(funk):
+    def inner(update, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            first_seen = deduplicator.first_seen(update)
+        except Exception:
+            # storage problems shouldn't stop commands, the in-process cache still applies
+            log_error(update["message"]["chat"]["id"], traceback.format_exc())
+            first_seen = True
+
+        # retried delivery of a processed update
+        if not first_seen:
+            log_update(update, "duplicate", started)
+            return False
+
+        return funk(update, *args, **kwargs)
+
+    return inner
+
 def spam_filter(funk):
     def inner(update, *args, **kwargs):
         chat_id = update["message"]["chat"]["id"]
@@ -99,35 +163,28 @@ def spam_filter(funk):
         if "testMode" in kwargs and chat_id == testerId and kwargs["testMode"] == True:
             return funk(update, *args, **kwargs)
 
-        log = t.load_log(chat_id, reverse_index=NUM_COMM_BEFORE_CAP)
-
-        if log == {}:
-            return funk(update, *args, **kwargs)
-        
-        date = log["date_time"]
-        
-        log_date = datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
-        now_date = datetime.datetime.now()
+        keys = [f"chat:{chat_id}"]
+        if "from" in update["message"]:
+            keys.append(f"sender:{update['message']['from']['id']}")
 
-        difference = (now_date - log_date).total_seconds()
-        max_difference = NUM_COMM_BEFORE_CAP * 60 / MAX_COMM_PER_MIN
+        # decided in memory, rejected commands don't reach storage
+        try:
+            allowed = limiter.allow(*keys)
+        except Exception:
+            # shared counters unavailable (storage problems or not supported), commands aren't blocked by it
+            log_error(chat_id, traceback.format_exc())
+            allowed = True
 
-        if difference < max_difference:
+        if not allowed:
+            log_update(update, "rate_limited", time.perf_counter())
             return False
 
-        else:
-            return funk(update, *args, **kwargs)
+        return funk(update, *args, **kwargs)
     
     return inner
 
 def log_error(chat_id, error_message):
-    try:
-        os.makedirs(os.path.dirname(ERROR_LOG_PATH), exist_ok=True)
-        with open(ERROR_LOG_PATH, "a") as f:
-            dateTimeStr = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            f.write(f"[{dateTimeStr}] - {str(chat_id):>12} - {error_message}\n")
-    except Exception as e:
-        print("Failed to log error:", e)
+    error_logger.log({"chat_id": chat_id, "error": error_message})
 
 def test_interrupt_filter(funk):
     def inner(*args, **kwargs):
@@ -156,13 +213,31 @@ def aws_lambda_handler(event, context):
     
     if isinstance(update, str):
         update = json.loads(update)
-    process_event(update)
+    try:
+        reply = process_event(update, inline_reply=INLINE_REPLY)
+    finally:
+        # the loggers write from a daemon thread, Lambda can freeze the process as soon as the handler returns
+        message_logger.flush()
+        error_logger.flush()
+
+    if reply:
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(reply)
+        }
     return {"statusCode": 200}
 
 @non_commands_filter
+@duplicate_filter
 @spam_filter
 # @test_interrupt_filter
-def process_event(event, testMode=False):
+def process_event(event, testMode=False, inline_reply=False):
+    # with inline_reply the reply is returned as a sendMessage payload instead of being sent
+    reply = None
+    started = time.perf_counter()
+    command_code = None
+    outcome = "ok"
     try:
 
         chat_id = event["message"]["chat"]["id"]
@@ -186,11 +261,20 @@ def process_event(event, testMode=False):
         args = message[1:]
         command = " ".join(message)[1:]
 
+        log = None
+
         # custom_commands = CC.load_custom_commands()
         # debit commands
         if command_code in DH.commands:
-            msg_out = DH.commands_API(command_code=command_code, args=args, chat_id=chat_id)
-            t.save_log(command=command,sender_id=sender_id,chat_id=chat_id)
+            # command and its log are written together
+            with t.atomic():
+                msg_out = DH.commands_API(command_code=command_code, args=args, chat_id=chat_id)
+                log = t.save_log(command=command,sender_id=sender_id,chat_id=chat_id,transaction=DH.pop_transaction(chat_id))
+                try:
+                    DH.update_stats_aggregate(chat_id)
+                except Exception:
+                    # the command is applied and logged, /statsrebuild corrects the stats
+                    log_error(chat_id, traceback.format_exc())
 
         # # custom command
         # elif command_code in custom_commands:
@@ -202,15 +286,27 @@ def process_event(event, testMode=False):
 
         else:
             msg_out = "Unknown command"
+            outcome = "unknown_command"
         #send_message(chat_id = chat_id, text = msg_out)
-        reply_to_message(chat_id = chat_id, text = msg_out, message_id = message_id)
+        if inline_reply:
+            reply = reply_payload(chat_id = chat_id, text = msg_out, message_id = message_id)
+        else:
+            reply_to_message(chat_id = chat_id, text = msg_out, message_id = message_id)
+
+        # archive old logs every COMPACT_EVERY_LOGS commands, after the reply is out (or built, with inline_reply)
+        if log and log["seq"] % COMPACT_EVERY_LOGS == 0:
+            try:
+                DH.log_compactor.compact(chat_id)
+            except Exception:
+                log_error(chat_id, traceback.format_exc())
 
     except Exception as e:  #    ERROR
         # check if error is from DebitHandler
         if type(e) in DH.exceptions_list:
             msg_out = str(e)
+            outcome = "user_error"
         else:
-            
+            outcome = "error"
             # full error stack trace for logging
             
             error_message = traceback.format_exc()
@@ -223,15 +319,22 @@ def process_event(event, testMode=False):
                 msg_out = "I'm sorry, Dave. I'm afraid I can't do that."
             else:
                 msg_out = "Invalid command"
-                 
-        reply_to_message(chat_id = chat_id, text = msg_out, message_id = event["message"]["message_id"])
+
+        if inline_reply:
+            reply = reply_payload(chat_id = chat_id, text = msg_out, message_id = event["message"]["message_id"])
+        else:
+            reply_to_message(chat_id = chat_id, text = msg_out, message_id = event["message"]["message_id"])
+
+    log_update(event, outcome, started, command_code)
+    return reply
 
 class BotApi:
-    def __init__(self):
+    def __init__(self, client: TelegramClient = bot):
+        self.client = client
         self.new_offset = 0
 
     def process_updates(self, timeout=30, testMode=False):
-        all_updates = get_updates(self.new_offset, timeout=timeout)
+        all_updates = self.client.get_updates(self.new_offset, timeout=timeout)
 
         if len(all_updates) == 0:
             return False
@@ -252,8 +355,14 @@ if __name__ == "__main__":
         # aws_lambda_handler(event = json.loads(open("event.json", "r").read()), context = None)
 
         send_message(testerId, "Bot started")
-        ap = BotApi()
         print("Start")
+        outbox = OutboundQueue(bot, report=lambda metrics: log_message(f"outbound queue: {metrics}")).start()
+        # ASYNC_POLLING=1: chats are processed concurrently, see AsyncBotApi
+        if os.environ.get("ASYNC_POLLING", "0") == "1":
+            import asyncio
+            from AsyncBotApi import AsyncBotApi
+            asyncio.run(AsyncBotApi(process_event, bot, show=show).run(timeout = 30, testMode=False))
+        ap = BotApi()
         while True:
             ap.process_updates(timeout = 30, testMode=False)
     except KeyboardInterrupt:
@@ -0,0 +1,62 @@
+'''
+Transaction records of DynamoDB logs survive a save and reload with their numbers as ints.
+Runs against an in-memory stand-in for the client (needs boto3 for the attribute value serializers):
+    python -m unittest discover tests
+'''
+import os
+import unittest
+
+for name in ("DYNAMODB_TABLE_NAME", "CODES_TABLE_NAME", "LOGS_TABLE_NAME", "LOG_ARCHIVE_TABLE_NAME"):
+    os.environ.setdefault(name, "test")
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from DynamoDBDataClass import DynamoDBDataClass
+
+class MemoryClient:
+    '''The client calls save_log and the log loaders make, on one chat item and one logs table'''
+    def __init__(self):
+        self.log_seq = 0
+        self.logs = dict() # seq -> item
+
+    def update_item(self, **kwargs):
+        self.log_seq += 1
+        return {"Attributes": {"log_seq": {"N": str(self.log_seq)}}}
+
+    def put_item(self, TableName, Item):
+        self.logs[int(Item["seq"]["N"])] = Item
+
+    def get_item(self, TableName, Key):
+        item = self.logs.get(int(Key["seq"]["N"]))
+        return {"Item": item} if item else dict()
+
+    def query(self, **kwargs):
+        items = [self.logs[seq] for seq in sorted(self.logs, reverse=True)]
+        return {"Items": items[:kwargs.get("Limit", len(items))]}
+
+@unittest.skipIf(boto3 is None, "boto3 is not installed")
+class TransactionRecordTest(unittest.TestCase):
+    def setUp(self):
+        self.db = DynamoDBDataClass()
+        self.db.__dict__["client"] = MemoryClient()
+
+    def test_undo_record(self):
+        transaction = {"type": "t", "donor": "Karlo", "recipients": ["Jura"], "total": 1050, "amounts": [1050],
+                       "deltas": {"Karlo": 1050, "Jura": -1050}}
+        undo = {"type": "u", "undoes": [1], "deltas": {"Karlo": -1050, "Jura": 1050}}
+        self.db.save_log(chat_id=1, sender_id=2, command="t karlo jura 10.5", transaction=transaction)
+        self.db.save_log(chat_id=1, sender_id=2, command="u", transaction=undo)
+
+        logs = self.db.load_logs(1, False)
+        self.assertEqual([log["seq"] for log in logs], [2, 1])
+        self.assertEqual(logs[0]["transaction"], undo)
+        self.assertEqual(logs[1]["transaction"], transaction)
+        self.assertIs(type(logs[0]["transaction"]["undoes"][0]), int)
+        self.assertIs(type(logs[1]["transaction"]["total"]), int)
+        self.assertEqual(self.db.load_log_by_seq(1, 2)["transaction"], undo)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+'''
+The Lambda entry modules import without the modules deferred to first use, and within a loose multiple of their budgets.
+Each import is measured in a fresh interpreter (see Util/import_budget.py):
+    python -m unittest discover tests
+'''
+import unittest
+
+from Util.import_budget import BUDGETS_MS, DEFERRED, RUNS, measure
+
+# wall clock varies a lot between machines and runs, only imports far over budget fail
+MARGIN = 3
+
+class ImportBudgetTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.measured = dict() # module -> (best milliseconds, imported modules of the first run)
+        for module in BUDGETS_MS:
+            try:
+                runs = [measure(module) for _ in range(RUNS)]
+            except ImportError:
+                # e.g. main without requests installed
+                continue
+            cls.measured[module] = (min(i[0] for i in runs), runs[0][1])
+
+    def setUp(self):
+        if not self.measured:
+            self.skipTest("none of the entry modules can be imported here")
+
+    def test_deferred_modules(self):
+        for module, (_, imported) in self.measured.items():
+            with self.subTest(module=module):
+                deferred = sorted(i for i in imported if i.split(".")[0] in DEFERRED)
+                self.assertEqual(deferred, [])
+
+    def test_budgets(self):
+        for module, (milliseconds, _) in self.measured.items():
+            with self.subTest(module=module):
+                self.assertLess(milliseconds, BUDGETS_MS[module] * MARGIN)
+
+if __name__ == "__main__":
+    unittest.main()
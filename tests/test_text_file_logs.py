@@ -0,0 +1,89 @@
+'''
+Text file logs read back the same from old utf-8 files and newer utf-16 files,
+over enough lines that the readers seeking from the end need several blocks:
+    python -m unittest discover tests
+'''
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+from TextFileDataClass import TextFileDataClass
+
+START = datetime.datetime(2024, 1, 31, 12, 0, 0)
+COUNT = 300
+
+def log_lines() -> list:
+    lines = []
+    for i in range(COUNT):
+        date = (START + datetime.timedelta(minutes=i)).strftime("%Y/%m/%d_%H:%M:%S")
+        line = f"{date}|{i % 3}|t karlo jura {i}"
+        if i % 2:
+            line += "\t" + json.dumps({"type": "t", "donor": "Karlo", "recipients": ["Jura"], "total": i * 100})
+        lines.append(line)
+    return lines
+
+class TextFileLogsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        os.environ["WRITING_ROOT"] = self.root.name
+        os.makedirs(os.path.join(self.root.name, "Logs"))
+        self.db = TextFileDataClass()
+
+        # chat 1 in the old utf-8 files, chat 2 in utf-16 with BOM as save_log writes now
+        lines = "".join(i + "\n" for i in log_lines())
+        with open(os.path.join(self.db.logs_path, "1.txt"), "w", encoding="utf-8") as f:
+            f.write(lines)
+        with open(os.path.join(self.db.logs_path, "2.txt"), "w", encoding="utf-16") as f:
+            f.write(lines)
+        # newest first, as the loaders return them
+        self.expected = [TextFileDataClass.parse_log(i) for i in reversed(log_lines())]
+
+    def test_load_log(self):
+        for chat_id in (1, 2):
+            with self.subTest(chat_id=chat_id):
+                self.assertEqual(self.db.load_log(chat_id), self.expected[0])
+                self.assertEqual(self.db.load_log(chat_id, 150), self.expected[150])
+                self.assertEqual(self.db.load_log(chat_id, COUNT - 1), self.expected[-1])
+                self.assertEqual(self.db.load_log(chat_id, COUNT), dict())
+
+    def test_load_logs(self):
+        for chat_id in (1, 2):
+            with self.subTest(chat_id=chat_id):
+                self.assertEqual(self.db.load_logs(chat_id, 10), self.expected[:10])
+                self.assertEqual(self.db.load_logs(chat_id, 200), self.expected[:200])
+                self.assertEqual(self.db.load_logs(chat_id, False), self.expected)
+                self.assertEqual(self.db.load_logs(chat_id, COUNT + 5), self.expected)
+
+    def test_load_log_after_time(self):
+        after = START + datetime.timedelta(minutes=99)
+        end = START + datetime.timedelta(minutes=250)
+        for chat_id in (1, 2):
+            with self.subTest(chat_id=chat_id):
+                # strictly after time, strictly before end_time
+                self.assertEqual(self.db.load_log_after_time(chat_id, after), self.expected[:COUNT - 100])
+                self.assertEqual(self.db.load_log_after_time(chat_id, after, end), self.expected[COUNT - 250:COUNT - 100])
+                self.assertEqual(self.db.load_log_after_time(chat_id, START - datetime.timedelta(days=1)), self.expected)
+                self.assertEqual(self.db.load_log_after_time(chat_id, START + datetime.timedelta(days=1)), [])
+
+    def test_save_log(self):
+        # called with keywords the way main.py does
+        transaction = {"type": "a", "total": 1000, "amounts": [1000]}
+        self.db.save_log(command="a karlo 10", sender_id=5, chat_id=2, transaction=transaction)
+        log = self.db.load_log(2)
+        self.assertEqual((log["sender_id"], log["command"], log["transaction"]), ("5", "a karlo 10", transaction))
+        self.assertEqual(self.db.load_log(2, 1), self.expected[0])
+
+    def test_missing_chat(self):
+        self.assertEqual(self.db.load_log(3), dict())
+        self.assertEqual(self.db.load_logs(3, 10), [])
+        self.assertEqual(self.db.load_log_after_time(3, START), [])
+
+    def test_transfer_not_supported(self):
+        with self.assertRaises(NotImplementedError):
+            self.db.save_transfer("CODE", 1, START)
+
+if __name__ == "__main__":
+    unittest.main()